@@ -5,6 +5,23 @@ import hashlib
 import requests
 import struct
 import os
+import random
+import time
+import math
+import mmap
+import asyncio
+import threading
+import cProfile
+import pstats
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from collections.abc import Iterator
+from itertools import chain
+from operator import itemgetter
+from contextlib import ExitStack, contextmanager
+from urllib.parse import urlparse
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait as wait_futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 #Using the bencodepy library will be much more helpfull in this situation 
 #using the (utf-8 formating of "i23e" to decode and encode the binary charecters of our file )
@@ -12,6 +29,198 @@ import os
 
 # now with the functions
 
+def _as_bytes(bencoded_value):
+    # bytes(b) returns b itself for a bytes object, so the common case does not copy.
+    if isinstance(bencoded_value, bytes):
+        return bencoded_value
+    return bytes(bencoded_value)
+
+def _decode_string_at(data, pos):
+    """
+    Decodes a bencoded string starting at ``pos``.
+
+    Args:
+        data (bytes): The full bencoded buffer.
+        pos (int): The offset of the string's length prefix.
+
+    Returns:
+        tuple: A tuple containing the decoded string and the offset just past it.
+
+    Example:
+        >>> _decode_string_at(b"5:hello", 0)
+        (b'hello', 7)
+    """
+    first_colon_index = data.find(b":", pos)
+    if first_colon_index == -1:
+        raise ValueError("Not a string")
+    length_string = int(data[pos:first_colon_index])
+    start = first_colon_index + 1
+    end = start + length_string
+    if end > len(data):
+        raise ValueError("String runs past the end of the data.")
+    return data[start:end], end
+
+def _decode_int_at(data, pos):
+    """
+    Decodes a bencoded integer starting at ``pos``.
+
+    Args:
+        data (bytes): The full bencoded buffer.
+        pos (int): The offset of the leading ``i``.
+
+    Returns:
+        tuple: A tuple containing the decoded integer and the offset just past it.
+
+    Example:
+        >>> _decode_int_at(b"i23e", 0)
+        (23, 4)
+    """
+    if data[pos] != 0x69:  # "i"
+        raise ValueError("Not an integer")
+    end_int = data.find(b"e", pos)
+    if end_int == -1:
+        raise ValueError("Not an integer")
+    return int(data[pos + 1 : end_int]), end_int + 1
+
+def _decode_list_at(data, pos):
+    """
+    Decodes a bencoded list starting at ``pos``.
+
+    Args:
+        data (bytes): The full bencoded buffer.
+        pos (int): The offset of the leading ``l``.
+
+    Returns:
+        tuple: A tuple containing the decoded list and the offset just past it.
+
+    Example:
+        >>> _decode_list_at(b"li1ei2ei3ee", 0)
+        ([1, 2, 3], 11)
+    """
+    if data[pos] != 0x6C:  # "l"
+        raise ValueError("Not a list")
+    pos += 1
+    decoded_list = []
+    while data[pos] != 0x65:  # "e"
+        decoded_value, pos = _decode_at(data, pos)
+        decoded_list.append(decoded_value)
+    return decoded_list, pos + 1
+
+def _decode_dict_at(data, pos, spans=None):
+    """
+    Decodes a bencoded dictionary starting at ``pos``.
+
+    Args:
+        data (bytes): The full bencoded buffer.
+        pos (int): The offset of the leading ``d``.
+        spans (dict, optional): If given, filled with ``key -> (start, end)``
+            giving the raw byte span of each value in this dictionary.
+
+    Returns:
+        tuple: A tuple containing the decoded dictionary and the offset just past it.
+
+    Example:
+        >>> _decode_dict_at(b"d3:foo3:bare", 0)
+        ({'foo': b'bar'}, 12)
+    """
+    if data[pos] != 0x64:  # "d"
+        raise ValueError("Not a dict")
+    pos += 1
+    decoded_dict = {}
+    while data[pos] != 0x65:  # "e"
+        decoded_key, pos = _decode_string_at(data, pos)
+        value_start = pos
+        decoded_value, pos = _decode_at(data, pos)
+        decoded_dict[decoded_key.decode()] = decoded_value
+        if spans is not None:
+            spans[decoded_key.decode()] = (value_start, pos)
+    return decoded_dict, pos + 1
+
+def _decode_at(data, pos):
+    """
+    Decodes the bencoded value starting at ``pos``.
+
+    The decoder walks a single buffer with an integer cursor, so the only
+    allocations are the decoded values themselves.
+
+    Args:
+        data (bytes): The full bencoded buffer.
+        pos (int): The offset of the value to decode.
+
+    Returns:
+        tuple: A tuple containing the decoded value and the offset just past it.
+
+    Example:
+        >>> _decode_at(b"5:hello", 0)
+        (b'hello', 7)
+    """
+    lead = data[pos]
+    if 0x30 <= lead <= 0x39:  # "0".."9"
+        return _decode_string_at(data, pos)
+    elif lead == 0x69:
+        return _decode_int_at(data, pos)
+    elif lead == 0x6C:
+        return _decode_list_at(data, pos)
+    elif lead == 0x64:
+        return _decode_dict_at(data, pos)
+    else:
+        # Bad input, like every other decoding error, so that callers parsing
+        # what peers send need only catch ValueError.
+        raise ValueError(
+            "We only support strings, integers, lists, and dicts."
+        )
+
+def decode_bencode_at(bencoded_value, pos=0):
+    """
+    Decodes one bencoded value without copying the rest of the input.
+
+    Args:
+        bencoded_value (bytes): The bencoded data.
+        pos (int): The offset to start decoding at.
+
+    Returns:
+        tuple: A tuple containing the decoded value and the offset just past it.
+
+    Raises:
+        ValueError: If the data is not valid bencoding.
+
+    Example:
+        >>> decode_bencode_at(b"i1ei2e", 3)
+        (2, 6)
+    """
+    try:
+        return _decode_at(_as_bytes(bencoded_value), pos)
+    except IndexError:
+        raise ValueError("Unexpected end of bencoded data.") from None
+    except RecursionError:
+        raise ValueError("Bencoded data is nested too deeply.") from None
+
+def decode_bencode_all(bencoded_value):
+    """
+    Decodes a buffer holding exactly one bencoded value.
+
+    Args:
+        bencoded_value (bytes): The bencoded data.
+
+    Returns:
+        The decoded value.
+
+    Raises:
+        ValueError: If anything is left over after the value.
+
+    Example:
+        >>> decode_bencode_all(b"li1ei2ee")
+        [1, 2]
+    """
+    data = _as_bytes(bencoded_value)
+    decoded_value, end = decode_bencode_at(data)
+    if end != len(data):
+        raise ValueError("Undecoded remainder.")
+    return decoded_value
+
+# The functions below keep the original (value, remainder) interface on top of
+# the offset-based decoder; only the final remainder is sliced.
+
 def decode_string(bencoded_value):
     """
     Decodes a bencoded string.
@@ -26,15 +235,9 @@ def decode_string(bencoded_value):
         >>> decode_string(b"5:hello")
         (b'hello', b'')
     """
-    first_colon_index = bencoded_value.find(b":")
-    if first_colon_index == -1:
-        raise ValueError("Not a string")
-    length_string = int(bencoded_value[:first_colon_index])
-    decoded_string = bencoded_value[
-        first_colon_index + 1 : first_colon_index + 1 + length_string
-    ]
-    bencoded_remainder = bencoded_value[first_colon_index + 1 + length_string :]
-    return decoded_string, bencoded_remainder
+    data = _as_bytes(bencoded_value)
+    decoded_string, end = _decode_string_at(data, 0)
+    return decoded_string, data[end:]
 
 def decode_int(bencoded_value):
     """
@@ -50,14 +253,9 @@ def decode_int(bencoded_value):
         >>> decode_int(b"i23e")
         (23, b'')
     """
-    if chr(bencoded_value[0]) != "i":
-        raise ValueError("Not an integer")
-    end_int = bencoded_value.find(b"e")
-    if end_int == -1:
-        raise ValueError("Not an integer")
-    decoded_int = int(bencoded_value[1:end_int])
-    bencoded_remainder = bencoded_value[end_int + 1 :]
-    return decoded_int, bencoded_remainder
+    data = _as_bytes(bencoded_value)
+    decoded_int, end = _decode_int_at(data, 0)
+    return decoded_int, data[end:]
 
 def decode_list(bencoded_value):
     """
@@ -73,14 +271,11 @@ def decode_list(bencoded_value):
         >>> decode_list(b"li1ei2ei3ee")
         ([1, 2, 3], b'')
     """
-    if chr(bencoded_value[0]) != "l":
+    data = _as_bytes(bencoded_value)
+    if not data or data[0] != 0x6C:
         raise ValueError("Not a list")
-    bencoded_remainder = bencoded_value[1:]
-    decoded_list = []
-    while chr(bencoded_remainder[0]) != "e":
-        decoded_value, bencoded_remainder = decode_bencode(bencoded_remainder)
-        decoded_list.append(decoded_value)
-    return decoded_list, bencoded_remainder[1:]
+    decoded_list, end = decode_bencode_at(data)
+    return decoded_list, data[end:]
 
 def decode_dict(bencoded_value):
     """
@@ -94,17 +289,13 @@ def decode_dict(bencoded_value):
 
     Example:
         >>> decode_dict(b"d3:foo3:bare")
-        ({b'foo': b'bar'}, b'')
+        ({'foo': b'bar'}, b'')
     """
-    if chr(bencoded_value[0]) != "d":
+    data = _as_bytes(bencoded_value)
+    if not data or data[0] != 0x64:
         raise ValueError("Not a dict")
-    bencoded_remainder = bencoded_value[1:]
-    decoded_dict = {}
-    while chr(bencoded_remainder[0]) != "e":
-        decoded_key, bencoded_remainder = decode_string(bencoded_remainder)
-        decoded_value, bencoded_remainder = decode_bencode(bencoded_remainder)
-        decoded_dict[decoded_key.decode()] = decoded_value
-    return decoded_dict, bencoded_remainder[1:]
+    decoded_dict, end = decode_bencode_at(data)
+    return decoded_dict, data[end:]
 
 def decode_bencode(bencoded_value):
     """
@@ -120,18 +311,9 @@ def decode_bencode(bencoded_value):
         >>> decode_bencode(b"5:hello")
         (b'hello', b'')
     """
-    if chr(bencoded_value[0]).isdigit():
-        return decode_string(bencoded_value)
-    elif chr(bencoded_value[0]) == "i":
-        return decode_int(bencoded_value)
-    elif chr(bencoded_value[0]) == "l":
-        return decode_list(bencoded_value)
-    elif chr(bencoded_value[0]) == "d":
-        return decode_dict(bencoded_value)
-    else:
-        raise NotImplementedError(
-            "We only support strings, integers, lists, and dicts."
-        )
+    data = _as_bytes(bencoded_value)
+    decoded_value, end = decode_bencode_at(data)
+    return decoded_value, data[end:]
 
 def bencode_string(unencoded_value):
     """
@@ -197,14 +379,11 @@ def bencode_list(unencoded_value):
         >>> bencode_list([1, 2, 3])
         b'li1ei2ei3ee'
     """
-    result = b"l"
-    for i in unencoded_value:
-        result += bencode(i)
-    return result + b"e"
+    return bencode(list(unencoded_value))
 
 def bencode_dict(unencoded_value):
     """
-    Encodes a dictionary as a bencoded dictionary.
+    Encodes a dictionary as a bencoded dictionary, keys sorted as raw bytes.
 
     Args:
         unencoded_value (dict): The dictionary to encode.
@@ -216,37 +395,129 @@ def bencode_dict(unencoded_value):
         >>> bencode_dict({b"foo": b"bar"})
         b'd3:foob3:bare'
     """
-    result = b"d"
-    for k in unencoded_value:
-        result += bencode(k) + bencode(unencoded_value[k])
-    return result + b"e"
+    return bencode(dict(unencoded_value))
+
+# Bytes bencode_to buffers before each write to the file.
+BENCODE_CHUNK_SIZE = 1 << 16
+
+def _sorted_items(unencoded_dict):
+    # The spec orders keys as raw strings. Keys of one type sort that way
+    # as they are: str order is code point order, which UTF-8 preserves.
+    try:
+        return [(key, unencoded_dict[key]) for key in sorted(unencoded_dict)]
+    except TypeError:
+        pass
+    # Mixed str and bytes keys: compare them encoded.
+    items = [
+        (key.encode() if isinstance(key, str) else bytes(key), value)
+        for key, value in unencoded_dict.items()
+    ]
+    items.sort(key=itemgetter(0))
+    for (key, _), (next_key, _) in zip(items, items[1:]):
+        if key == next_key:
+            raise ValueError("Duplicate dictionary key %r." % key)
+    return items
+
+def _bencode_into(value, out, write=None):
+    # Appends the encoding of value to out. With write, out is handed to it
+    # and emptied whenever it grows past BENCODE_CHUNK_SIZE, and large
+    # strings go to write directly instead of through out.
+    kind = type(value)
+    if kind is bytes or kind is bytearray or kind is memoryview:
+        length = value.nbytes if kind is memoryview else len(value)
+        out += b"%d:" % length
+        if write is not None and length >= BENCODE_CHUNK_SIZE:
+            write(out)
+            del out[:]
+            write(value)
+        else:
+            out += value
+    elif kind is str:
+        encoded = value.encode()
+        out += b"%d:" % len(encoded)
+        out += encoded
+    elif kind is int or kind is bool:
+        out += b"i%de" % value
+    elif kind is dict:
+        out += b"d"
+        for key, item in _sorted_items(value):
+            if type(key) is str:
+                key = key.encode()
+            out += b"%d:" % len(key)
+            out += key
+            _bencode_into(item, out, write)
+            if write is not None and len(out) >= BENCODE_CHUNK_SIZE:
+                write(out)
+                del out[:]
+        out += b"e"
+    elif kind is list or kind is tuple or isinstance(value, Iterator):
+        out += b"l"
+        for item in value:
+            _bencode_into(item, out, write)
+            if write is not None and len(out) >= BENCODE_CHUNK_SIZE:
+                write(out)
+                del out[:]
+        out += b"e"
+    elif isinstance(value, (bytes, bytearray)):
+        _bencode_into(bytes(value), out, write)
+    elif isinstance(value, int):
+        _bencode_into(int(value), out, write)
+    elif isinstance(value, str):
+        _bencode_into(str(value), out, write)
+    elif isinstance(value, dict):
+        _bencode_into(dict(value), out, write)
+    elif isinstance(value, (list, tuple)):
+        _bencode_into(list(value), out, write)
+    else:
+        raise ValueError("Can only bencode strings, ints, lists, or dicts.")
 
 def bencode(unencoded_value):
     """
     Encodes a value as a bencoded value.
 
+    The whole encoding is built in one ``bytearray``. Dictionary keys are
+    written sorted as raw bytes, as the spec requires; lists may also be
+    tuples or iterators, and strings ``bytearray`` or ``memoryview``.
+
     Args:
         unencoded_value (str, int, list, dict, bytes): The value to encode.
 
     Returns:
         bytes: The bencoded value.
 
+    Raises:
+        ValueError: For a value of another type, or a dictionary whose keys
+            collide once encoded.
+
     Example:
-        >>> bencode("hello")
-        b'5:hello'
+        >>> bencode({"b": 1, "a": [b"x"]})
+        b'd1:al1:xe1:bi1ee'
     """
-    if isinstance(unencoded_value, str):
-        return bencode_string(unencoded_value)
-    elif isinstance(unencoded_value, bytes):
-        return bencode_bytes(unencoded_value)
-    elif isinstance(unencoded_value, int):
-        return bencode_int(unencoded_value)
-    elif isinstance(unencoded_value, list):
-        return bencode_list(unencoded_value)
-    elif isinstance(unencoded_value, dict):
-        return bencode_dict(unencoded_value)
-    else:
-        raise ValueError("Can only bencode strings, ints, lists, or dicts.")
+    out = bytearray()
+    _bencode_into(unencoded_value, out)
+    return bytes(out)
+
+def bencode_to(unencoded_value, f):
+    """
+    Encodes a value straight into a file-like object.
+
+    At most about ``BENCODE_CHUNK_SIZE`` bytes of output are buffered at a
+    time, so with iterators in place of lists, very large structures (e.g.
+    the file list of a generated torrent) never have to exist in memory at
+    once.
+
+    Args:
+        unencoded_value (str, int, list, dict, bytes): The value to encode.
+        f (file): An object with a ``write`` method taking bytes-like objects.
+
+    Example:
+        >>> with open("out.torrent", "wb") as f:
+        ...     bencode_to({"info": {"files": (entry for entry in entries)}}, f)
+    """
+    out = bytearray()
+    _bencode_into(unencoded_value, out, f.write)
+    if out:
+        f.write(out)
 
 
 def decode_torrentfile(filename):
@@ -265,10 +536,256 @@ def decode_torrentfile(filename):
     """
     with open(filename, "rb") as f:
         bencoded_content = f.read()
-        decoded_value, remainder = decode_bencode(bencoded_content)
-        if remainder:
-            raise ValueError("Undecoded remainder.")
-        return decoded_value
+    return decode_bencode_all(bencoded_content)
+
+def decode_metainfo(bencoded_content):
+    """
+    Decodes torrent metainfo and records where the info dictionary sits.
+
+    Args:
+        bencoded_content (bytes): The raw contents of a .torrent file.
+
+    Returns:
+        tuple: A tuple containing the decoded metainfo and the ``(start, end)``
+        byte span of the ``info`` value within ``bencoded_content``.
+
+    Example:
+        >>> decode_metainfo(b"d4:infod6:lengthi1eee")
+        ({'info': {'length': 1}}, (7, 20))
+    """
+    data = _as_bytes(bencoded_content)
+    spans = {}
+    try:
+        if not data or data[0] != 0x64:
+            raise ValueError("Torrent metainfo is not a dict")
+        decoded_value, end = _decode_dict_at(data, 0, spans)
+    except IndexError:
+        raise ValueError("Unexpected end of bencoded data.") from None
+    except RecursionError:
+        raise ValueError("Bencoded data is nested too deeply.") from None
+    if end != len(data):
+        raise ValueError("Undecoded remainder.")
+    if "info" not in spans:
+        raise ValueError("Torrent metainfo has no info dict.")
+    return decoded_value, spans["info"]
+
+class PieceHashes:
+    """
+    An indexed, read-only view over the concatenated ``pieces`` string.
+
+    Indexing slices out a single 20-byte hash on demand, so building the view
+    costs nothing however many pieces the torrent has.
+
+    Example:
+        >>> hashes = PieceHashes(b"\x01" * 20 + b"\x02" * 20)
+        >>> len(hashes), hashes[1]
+        (2, b'\x02\x02\x02\x02\x02\x02\x02\x02\x02\x02\x02\x02\x02\x02\x02\x02\x02\x02\x02\x02')
+    """
+
+    __slots__ = ("_pieces", "_count")
+
+    def __init__(self, pieces):
+        if len(pieces) % 20 != 0:
+            raise ValueError("Piece hashes do not add up to a multiple of", 20, "bytes.")
+        self._pieces = pieces
+        self._count = len(pieces) // 20
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("piece index out of range")
+        return self._pieces[index * 20 : index * 20 + 20]
+
+    def __iter__(self):
+        pieces = self._pieces
+        for start in range(0, len(pieces), 20):
+            yield pieces[start : start + 20]
+
+class Torrent:
+    """
+    A parsed .torrent file.
+
+    Built once per command and handed to every function that needs torrent
+    metadata. Derived fields are computed on first access and cached. The info
+    hash is the SHA-1 of the info dictionary's bytes exactly as they appear in
+    the file, so it is never re-encoded.
+
+    Attributes:
+        metainfo (dict): The decoded metainfo.
+        info (dict): The decoded info dictionary.
+
+    Example:
+        >>> torrent = Torrent.from_file("sample.torrent")
+        >>> torrent.info_hash.hex(), torrent.piece_count
+        ('d69f91e6b2ae4c542468d1073a71d4ea13879a7f', 3)
+    """
+
+    __slots__ = (
+        "metainfo",
+        "info",
+        "_raw",
+        "_info_span",
+        "_info_hash",
+        "_piece_hashes",
+        "_piece_lengths",
+        "_files",
+        "_length",
+        "_tiers",
+    )
+
+    def __init__(self, bencoded_content):
+        self._raw = bencoded_content
+        self.metainfo, self._info_span = decode_metainfo(bencoded_content)
+        self.info = self.metainfo["info"]
+        self._info_hash = None
+        self._piece_hashes = None
+        self._piece_lengths = None
+        self._files = None
+        self._length = None
+        self._tiers = None
+
+    @classmethod
+    def from_bytes(cls, bencoded_content):
+        """
+        Parses a torrent from the raw contents of a .torrent file.
+
+        Args:
+            bencoded_content (bytes): The raw metainfo.
+
+        Returns:
+            Torrent: The parsed torrent.
+        """
+        return cls(_as_bytes(bencoded_content))
+
+    @classmethod
+    def from_file(cls, filename):
+        """
+        Parses a torrent from a .torrent file on disk.
+
+        Args:
+            filename (str): The path to the torrent file.
+
+        Returns:
+            Torrent: The parsed torrent.
+        """
+        with open(filename, "rb") as f:
+            return cls(f.read())
+
+    @property
+    def announce(self):
+        """str: The tracker URL; the first listed one if there is only an ``announce-list``."""
+        if "announce" in self.metainfo:
+            return self.metainfo["announce"].decode()
+        return self.announce_list[0][0]
+
+    @property
+    def announce_list(self):
+        """
+        list[list[str]]: The tracker tiers, most preferred first (BEP 12).
+
+        Each tier is shuffled once, as BEP 12 asks, and trackers that answer
+        are then moved to the front of their tier by the tracker client. A
+        torrent without an ``announce-list`` has a single one-tracker tier.
+        """
+        if self._tiers is None:
+            tiers = []
+            for tier in self.metainfo.get("announce-list", []):
+                urls = [url.decode() for url in tier]
+                if urls:
+                    random.shuffle(urls)
+                    tiers.append(urls)
+            if not tiers:
+                tiers = [[self.metainfo["announce"].decode()]]
+            self._tiers = tiers
+        return self._tiers
+
+    @property
+    def info_hash(self):
+        """bytes: The 20-byte SHA-1 of the raw info dictionary."""
+        if self._info_hash is None:
+            start, end = self._info_span
+            self._info_hash = hashlib.sha1(memoryview(self._raw)[start:end]).digest()
+            # The raw metainfo is only kept around for this hash.
+            self._raw = None
+        return self._info_hash
+
+    @property
+    def is_private(self):
+        """bool: Whether the torrent is private (BEP 27): peers come only from its trackers."""
+        return self.info.get("private") == 1
+
+    @property
+    def is_multi_file(self):
+        """bool: Whether the info dictionary lists several files."""
+        return "files" in self.info
+
+    @property
+    def files(self):
+        """
+        list: A ``(path components, length)`` pair per file, in torrent order.
+
+        A single-file torrent has one entry named after the torrent.
+        """
+        if self._files is None:
+            if self.is_multi_file:
+                self._files = [
+                    ([component.decode() for component in f["path"]], f["length"])
+                    for f in self.info["files"]
+                ]
+            else:
+                self._files = [([self.info["name"].decode()], self.info["length"])]
+        return self._files
+
+    @property
+    def length(self):
+        """int: The total length of the torrent's content in bytes."""
+        if self._length is None:
+            self._length = sum(length for _, length in self.files)
+        return self._length
+
+    @property
+    def piece_length(self):
+        """int: The nominal length of every piece but the last."""
+        return self.info["piece length"]
+
+    @property
+    def piece_hashes(self):
+        """PieceHashes: An indexed view over the expected piece hashes."""
+        if self._piece_hashes is None:
+            self._piece_hashes = PieceHashes(self.info["pieces"])
+        return self._piece_hashes
+
+    @property
+    def piece_count(self):
+        """int: The number of pieces."""
+        return len(self.piece_hashes)
+
+    @property
+    def piece_lengths(self):
+        """list: The length of each piece; only the last one may be short."""
+        if self._piece_lengths is None:
+            count = self.piece_count
+            lengths = [self.piece_length] * count
+            if count:
+                lengths[-1] = self.length - self.piece_length * (count - 1)
+            self._piece_lengths = lengths
+        return self._piece_lengths
+
+    def piece_size(self, index):
+        """
+        Returns the length of a single piece.
+
+        Args:
+            index (int): The piece index.
+
+        Returns:
+            int: The piece's length in bytes.
+        """
+        return self.piece_lengths[index]
 
 def piece_hashes(pieces):
     """
@@ -289,15 +806,15 @@ def piece_hashes(pieces):
         raise ValueError("Piece hashes do not add up to a multiple of", n, "bytes.")
     return [pieces[i : i + n] for i in range(0, len(pieces), n)]
 
-def print_info(filename):
+def print_info(torrent):
     """
     Prints information about a torrent file.
 
     Args:
-        filename (str): The path to the torrent file.
+        torrent (Torrent): The parsed torrent.
 
     Example:
-        >>> print_info("example.torrent")
+        >>> print_info(Torrent.from_file("example.torrent"))
         Tracker URL: http://example.com/announce
         Length: 12345
         Info Hash: 1234567890abcdef
@@ -306,322 +823,4379 @@ def print_info(filename):
         01 02 03 04 05 06 07 08
         09 10 11 12 13 14 15 16
     """
-    decoded_value = decode_torrentfile(filename)
-    print("Tracker URL:", decoded_value["announce"].decode())
-    print("Length:", decoded_value["info"]["length"])
-    info_hash = hashlib.sha1(bencode(decoded_value["info"])).hexdigest()
-    print("Info Hash:", info_hash)
-    print("Piece Length:", decoded_value["info"]["piece length"])
+    print("Tracker URL:", torrent.announce)
+    print("Length:", torrent.length)
+    print("Info Hash:", torrent.info_hash.hex())
+    print("Piece Length:", torrent.piece_length)
     print("Piece Hashes:")
-    hashes = piece_hashes(decoded_value["info"]["pieces"])
-    for h in hashes:
+    for h in torrent.piece_hashes:
         print(h.hex())
 
-def get_peers(filename):
-    """
-    Retrieves a list of peers from a torrent file.
+# Upper bounds, in seconds, of the latency histograms' buckets.
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
 
-    Args:
-        filename (str): The path to the torrent file.
+# Seconds between JSON stats lines, unless the command line says otherwise.
+STATS_INTERVAL = 10
 
-    Returns:
-        list: A list of peers.
-
-    Example:
-        >>> get_peers("example.torrent")
-        [b'\x01\x02\x03\x04\x05\x06', b'\x07\x08\x09\x10\x11\x12']
-    """
-    decoded_value = decode_torrentfile(filename)
-    tracker_url = decoded_value["announce"].decode()
-    info_hash = hashlib.sha1(bencode(decoded_value["info"])).digest()
-    peer_id = "00112233445566778899"
-    port = 6881
-    uploaded = 0
-    downloaded = 0
-    left = decoded_value["info"]["length"]
-    compact = 1
-    params = dict(
-        info_hash=info_hash,
-        peer_id=peer_id,
-        port=port,
-        uploaded=uploaded,
-        downloaded=downloaded,
-        left=left,
-        compact=compact,
-    )
-    result = requests.get(tracker_url, params=params)
-    decoded_result = decode_bencode(result.content)[0]
-    return decoded_result["peers"]
+# Functions listed in the --profile summary.
+PROFILE_LINES = 30
 
-def split_peers(peers):
+class Histogram:
     """
-    Splits a list of peers into individual peers.
+    Counts observations into fixed buckets, like a Prometheus histogram.
 
-    Args:
-        peers (bytes): The list of peers.
+    Safe to update from any thread: hashing and disk writes observe from
+    their pools, announces from the tracker threads.
 
-    Returns:
-        list: A list of individual peers.
+    Args:
+        bounds (tuple): Increasing upper bounds of the buckets; a last,
+            unbounded bucket catches everything larger.
 
     Example:
-        >>> split_peers(b'\x01\x02\x03\x04\x05\x06\x07\x08\x09\x10\x11\x12')
-        ['1.2.3.4:5678', '5.6.7.8:9012']
+        >>> histogram = Histogram()
+        >>> histogram.observe(0.042)
+        >>> histogram.quantile(0.5)
+        0.05
     """
-    if len(peers) % 6 != 0:
-        raise ValueError(
-            "Peer list from tracker does not divide into 6 bytes; did you use compact?"
-        )
-    uncompacted_peers = []
-    for peer in [peers[i : i + 6] for i in range(0, len(peers), 6)]:
-        ip = str(peer[0]) + "." + str(peer[1]) + "." + str(peer[2]) + "." + str(peer[3])
-        port = str(int.from_bytes(peer[4:], byteorder="big", signed=False))
-        uncompacted_peers.append(ip + ":" + port)
-    return uncompacted_peers
 
-def init_handshake(filename, peer):
+    __slots__ = ("bounds", "counts", "count", "sum", "_lock")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        # A value equal to a bound belongs to that bound's bucket ("le").
+        bucket = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        """
+        Estimates a quantile as the upper bound of the bucket it falls in.
+
+        Args:
+            q (float): The quantile, between 0 and 1.
+
+        Returns:
+            float: The estimate; ``inf`` past the last bound, None if nothing
+            was observed.
+        """
+        with self._lock:
+            counts = list(self.counts)
+            count = self.count
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for bound, bucket_count in zip(self.bounds, counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+class PeerTraffic:
+    """The bytes received from and sent to one peer, over all its open connections."""
+
+    __slots__ = ("received", "sent", "connections")
+
+    def __init__(self):
+        self.received = 0
+        self.sent = 0
+        self.connections = 0
+
+class Metrics:
     """
-    Initializes a handshake with a BitTorrent peer.
+    Counters and latency histograms for the download pipeline.
 
-    Args:
-        filename (str): The name of the torrent file.
-        peer (str): The peer's IP address and port number in the format "ip:port".
+    The pipeline updates them as it goes: each announce, handshake, block
+    round trip, piece hash and piece write adds an observation, and peer
+    connections count their bytes. Gauges, such as the number of pieces in
+    flight, are read on demand from the functions registered with ``watch``.
 
-    Returns:
-        tuple: A tuple containing the socket object and the received handshake message.
+    ``snapshot`` and ``json_line`` summarise everything for the periodic
+    stats line; ``prometheus`` renders it in the Prometheus text format.
+
+    Attributes:
+        announce (Histogram): Seconds per tracker announce.
+        handshake (Histogram): Seconds from connecting to a peer until its
+            handshake arrived.
+        block_rtt (Histogram): Seconds from requesting a block until it arrived.
+        hash_check (Histogram): Seconds to hash one piece.
+        disk_write (Histogram): Seconds from queueing a piece write until it
+            was done.
+        peers (dict): ``PeerTraffic`` per connected "ip:port". A peer is
+            dropped when its last connection closes, so the dict stays as
+            small as the swarm.
+        departed (PeerTraffic): The bytes of every peer since dropped.
+        started (float): The ``time.monotonic()`` the metrics were created.
 
     Example:
-        >>> s, received_message = init_handshake("example.torrent", "192.168.1.100:6881")
-        >>> print(received_message)
+        >>> metrics = default_metrics()
+        >>> metrics.traffic(("1.2.3.4", 6881)).received += 16384
+        >>> metrics.release(("1.2.3.4", 6881))
+        >>> print(metrics.prometheus())
     """
-    decoded_value = decode_torrentfile(filename)
-    peer_colon = peer.find(":")
-    ip = peer[:peer_colon]
-    port = int(peer[peer_colon + 1:])
-    length_prefix = struct.pack(">B", 19)
-    protocol_string = b"BitTorrent protocol"
-    reserved_bytes = b"\x00" * 8
-    info_hash = hashlib.sha1(bencode(decoded_value["info"])).digest()
-    peer_id = b"00112233445566778899"
-    message = length_prefix + protocol_string + reserved_bytes + info_hash + peer_id
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect((ip, port))
-    s.send(message)
-    # Only grab the first 68 bytes, that's the handshake. Anything after this is the start of the bitfield.
-    received_message = s.recv(68)
-    return s, received_message
 
-def construct_message(message_id, payload):
+    # The histograms, with their help text for Prometheus.
+    HISTOGRAMS = {
+        "announce": "Tracker announce latency.",
+        "handshake": "Peer handshake latency.",
+        "block_rtt": "Block request round-trip time.",
+        "hash_check": "Piece SHA-1 check time.",
+        "disk_write": "Piece write latency.",
+    }
+
+    # The gauges there always are, with their help text.
+    GAUGES = {
+        "pieces_in_flight": "Pieces being downloaded, verified or written.",
+    }
+
+    __slots__ = tuple(HISTOGRAMS) + ("peers", "departed", "started", "_gauges", "_lock")
+
+    def __init__(self):
+        for name in self.HISTOGRAMS:
+            setattr(self, name, Histogram())
+        self.peers = {}
+        self.departed = PeerTraffic()
+        self.started = time.monotonic()
+        self._gauges = {name: [] for name in self.GAUGES}
+        self._lock = threading.Lock()
+
+    def traffic(self, peer):
+        """
+        Returns the byte counters of a peer for a new connection to it.
+
+        The counters are created on first use; every call must be matched by
+        a ``release`` once the connection closes.
+
+        Args:
+            peer (tuple or str): The peer's ``(ip, port)``, or "ip:port".
+
+        Returns:
+            PeerTraffic: The counters; the caller adds to them directly.
+        """
+        key = peer if isinstance(peer, str) else format_peer(peer)
+        with self._lock:
+            traffic = self.peers.get(key)
+            if traffic is None:
+                traffic = self.peers[key] = PeerTraffic()
+            traffic.connections += 1
+        return traffic
+
+    def release(self, peer):
+        """
+        Notes that a connection to a peer closed.
+
+        Once its last connection is gone the peer's bytes are folded into
+        ``departed`` and its entry is dropped.
+
+        Args:
+            peer (tuple or str): The peer's ``(ip, port)``, or "ip:port".
+        """
+        key = peer if isinstance(peer, str) else format_peer(peer)
+        with self._lock:
+            traffic = self.peers[key]
+            traffic.connections -= 1
+            if not traffic.connections:
+                del self.peers[key]
+                self.departed.received += traffic.received
+                self.departed.sent += traffic.sent
+
+    def watch(self, name, read):
+        """
+        Adds a function to a gauge; the gauge's value is the sum of its functions.
+
+        Args:
+            name (str): The gauge, e.g. "pieces_in_flight".
+            read (callable): Returns the current value. It is called from
+                whichever thread exports the metrics.
+        """
+        with self._lock:
+            self._gauges.setdefault(name, []).append(read)
+
+    def unwatch(self, name, read):
+        with self._lock:
+            self._gauges[name].remove(read)
+
+    def gauges(self):
+        with self._lock:
+            gauges = {name: list(reads) for name, reads in self._gauges.items()}
+        return {name: sum(read() for read in reads) for name, reads in gauges.items()}
+
+    def snapshot(self):
+        """
+        Summarises the metrics.
+
+        Returns:
+            dict: The gauges, byte totals, ``[received, sent]`` counts per
+            connected peer, and for each histogram its count, mean and estimated
+            median and 99th percentile, in seconds ("+Inf" past the last
+            bucket).
+        """
+        with self._lock:
+            peers = {key: [traffic.received, traffic.sent] for key, traffic in self.peers.items()}
+            received, sent = self.departed.received, self.departed.sent
+        snapshot = {"uptime": round(time.monotonic() - self.started, 3)}
+        snapshot.update(self.gauges())
+        snapshot["bytes_in"] = received + sum(counts[0] for counts in peers.values())
+        snapshot["bytes_out"] = sent + sum(counts[1] for counts in peers.values())
+        for name in self.HISTOGRAMS:
+            histogram = getattr(self, name)
+            count = histogram.count
+            summary = {"count": count, "mean": histogram.sum / count if count else None}
+            for key, q in (("p50", 0.5), ("p99", 0.99)):
+                value = histogram.quantile(q)
+                # Past the last bound, as Prometheus labels that bucket; JSON has no inf.
+                summary[key] = "+Inf" if value == float("inf") else value
+            snapshot[name] = summary
+        snapshot["peers"] = peers
+        return snapshot
+
+    def json_line(self):
+        """
+        Returns:
+            str: ``snapshot`` as one line of JSON, without the newline.
+        """
+        return json.dumps(self.snapshot(), separators=(",", ":"))
+
+    def prometheus(self):
+        """
+        Renders the metrics in the Prometheus text exposition format (0.0.4).
+
+        Returns:
+            str: The metrics page.
+        """
+        lines = []
+        for name, help_text in self.HISTOGRAMS.items():
+            histogram = getattr(self, name)
+            with histogram._lock:
+                counts = list(histogram.counts)
+                total = histogram.sum
+            metric = "bittorrent_%s_seconds" % name
+            lines.append("# HELP %s %s" % (metric, help_text))
+            lines.append("# TYPE %s histogram" % metric)
+            cumulative = 0
+            for bound, count in zip(histogram.bounds + ("+Inf",), counts):
+                cumulative += count
+                lines.append('%s_bucket{le="%s"} %d' % (metric, bound, cumulative))
+            lines.append("%s_sum %r" % (metric, total))
+            lines.append("%s_count %d" % (metric, cumulative))
+        for name, value in self.gauges().items():
+            lines.append("# HELP bittorrent_%s %s" % (name, self.GAUGES.get(name, name)))
+            lines.append("# TYPE bittorrent_%s gauge" % name)
+            lines.append("bittorrent_%s %d" % (name, value))
+        with self._lock:
+            peers = [(key, traffic.received, traffic.sent) for key, traffic in self.peers.items()]
+            departed = (None, self.departed.received, self.departed.sent)
+        for direction, column in (("received", 1), ("sent", 2)):
+            metric = "bittorrent_%s_bytes_total" % direction
+            lines.append("# HELP %s Bytes %s over all peers." % (metric, direction))
+            lines.append("# TYPE %s counter" % metric)
+            lines.append("%s %d" % (metric, sum(peer[column] for peer in peers + [departed])))
+            metric = "bittorrent_peer_%s_bytes_total" % direction
+            lines.append("# HELP %s Bytes %s per peer." % (metric, direction))
+            lines.append("# TYPE %s counter" % metric)
+            for peer in peers:
+                lines.append('%s{peer="%s"} %d' % (metric, peer[0], peer[column]))
+        return "\n".join(lines) + "\n"
+
+_default_metrics = None
+
+def default_metrics():
     """
-    Constructs a BitTorrent message.
+    Returns the process-wide metrics, creating them on first use.
+
+    Returns:
+        Metrics: The shared metrics.
+    """
+    global _default_metrics
+    if _default_metrics is None:
+        _default_metrics = Metrics()
+    return _default_metrics
+
+def report_stats(f, interval=STATS_INTERVAL, metrics=None):
+    """
+    Writes ``Metrics.json_line`` to ``f`` every ``interval`` seconds, from a
+    daemon thread.
 
     Args:
-        message_id (int): The ID of the message.
-        payload (bytes): The payload of the message.
+        f (file): A text file, e.g. ``sys.stderr``.
+        interval (float): Seconds between lines.
+        metrics (Metrics, optional): Defaults to the shared metrics.
 
     Returns:
-        bytes: The constructed message.
+        callable: Stops the reporting after writing one last line.
 
     Example:
-        >>> message = construct_message(6, b"example payload")
-        >>> print(message)
+        >>> stop = report_stats(sys.stderr, 5)
+        >>> download("example.txt", torrent)
+        >>> stop()
     """
-    message_id = message_id.to_bytes(1)
-    message = message_id + payload
-    length = len(message)
-    length_prefix = length.to_bytes(4, byteorder="big")
-    message = length_prefix + message
-    return message
+    metrics = metrics or default_metrics()
+    stopped = threading.Event()
 
-def verify_message(message, message_id):
+    def report():
+        while not stopped.wait(interval):
+            print(metrics.json_line(), file=f, flush=True)
+        print(metrics.json_line(), file=f, flush=True)
+
+    thread = threading.Thread(target=report, name="stats", daemon=True)
+    thread.start()
+
+    def stop():
+        stopped.set()
+        thread.join()
+
+    return stop
+
+def serve_metrics(port, host="", metrics=None):
     """
-    Verifies a BitTorrent message.
+    Serves ``Metrics.prometheus`` over HTTP, from a daemon thread.
+
+    Any GET gets the metrics page, so ``/metrics`` works as Prometheus expects.
 
     Args:
-        message (bytes): The message to verify.
-        message_id (int): The expected ID of the message.
+        port (int): The port to listen on; 0 picks a free one.
+        host (str): The address to listen on; all of them by default.
+        metrics (Metrics, optional): Defaults to the shared metrics.
 
-    Raises:
-        ValueError: If the message ID or length is incorrect.
+    Returns:
+        ThreadingHTTPServer: The running server; its ``server_address``
+        holds the port, and ``shutdown`` stops it.
+
+    Example:
+        >>> server = serve_metrics(9090)
+        >>> requests.get("http://127.0.0.1:9090/metrics").text
+    """
+    metrics = metrics or default_metrics()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+PEER_ID = b"00112233445566778899"
+
+LISTEN_PORT = 6881
+
+# Seconds to wait for a tracker to answer an announce.
+TRACKER_TIMEOUT = 15
+
+# Seconds to wait for the final completed or stopped announce before exiting
+# without it; it is a courtesy to the tracker, not worth holding up the user.
+FINAL_ANNOUNCE_TIMEOUT = 5
+
+# Used when a tracker does not say how often to re-announce.
+DEFAULT_ANNOUNCE_INTERVAL = 1800
+
+# UDP tracker retransmission: the n-th attempt waits UDP_BASE_TIMEOUT * 2**n
+# seconds. BEP 15 suggests 15 seconds and eight retries; a command-line
+# client gives up sooner.
+UDP_BASE_TIMEOUT = 3
+UDP_MAX_RETRIES = 4
+
+# How long a UDP tracker's connection ID may be reused (BEP 15).
+UDP_CONNECTION_ID_LIFETIME = 60
+
+_UDP_PROTOCOL_ID = 0x41727101980
+_UDP_CONNECT = 0
+_UDP_ANNOUNCE = 1
+_UDP_ERROR = 3
+_UDP_EVENTS = {None: 0, "completed": 1, "started": 2, "stopped": 3}
+
+class TransferStats:
+    """
+    The byte counters a client reports to its trackers.
+
+    Example:
+        >>> stats = TransferStats(left=92063)
+        >>> stats.downloaded += 32768
+    """
+
+    __slots__ = ("uploaded", "downloaded", "left")
+
+    def __init__(self, left, uploaded=0, downloaded=0):
+        self.left = left
+        self.uploaded = uploaded
+        self.downloaded = downloaded
+
+# Compact peer entries: address then big-endian port.
+_PEER4 = struct.Struct(">4sH")
+_PEER6 = struct.Struct(">16sH")
+
+def parse_compact_peers(peers, ipv6=False):
+    """
+    Parses a compact peer list into ``(ip, port)`` tuples.
+
+    IPv4 entries are 6 bytes (BEP 23), IPv6 entries from ``peers6`` are 18
+    bytes (BEP 7). The blob is unpacked a whole entry at a time with
+    ``struct.iter_unpack``; the only string built per peer is its address.
+
+    Args:
+        peers (bytes): The compact peer list.
+        ipv6 (bool): Whether the entries are 18-byte IPv6 ones.
+
+    Returns:
+        list: ``(ip, port)`` tuples, in tracker order.
+
+    Raises:
+        ValueError: If the list is not a whole number of entries.
+
+    Example:
+        >>> parse_compact_peers(b'\x01\x02\x03\x04\x16\x2e')
+        [('1.2.3.4', 5678)]
+    """
+    if ipv6:
+        entry, ntop = _PEER6, lambda ip: socket.inet_ntop(socket.AF_INET6, ip)
+    else:
+        entry, ntop = _PEER4, socket.inet_ntoa
+    if len(peers) % entry.size != 0:
+        raise ValueError(
+            "Peer list from tracker does not divide into %d bytes; did you use compact?"
+            % entry.size
+        )
+    return [(ntop(ip), port) for ip, port in entry.iter_unpack(peers)]
+
+def _peer_list(peers, peers6=b""):
+    # Some trackers ignore compact=1 and send a list of dicts instead.
+    if isinstance(peers, bytes):
+        parsed = parse_compact_peers(peers)
+    else:
+        parsed = [(peer["ip"].decode(), peer["port"]) for peer in peers]
+    if peers6:
+        parsed += parse_compact_peers(peers6, ipv6=True)
+    return parsed
+
+def _merge_peers(known, peers):
+    # Returns the peers not seen before, and remembers them, so replies from
+    # several trackers can be unioned.
+    added = []
+    for peer in peers:
+        if peer not in known:
+            known.add(peer)
+            added.append(peer)
+    return added
+
+class TrackerClient:
+    """
+    Announces torrents to HTTP and UDP trackers.
+
+    The protocol is chosen from the announce URL's scheme. All HTTP announces
+    share one pooled ``requests.Session``, so repeated announces reuse the
+    same TCP (and TLS) connection. UDP announces (BEP 15) cache the tracker's
+    connection ID for its one-minute lifetime, so a repeat announce costs two
+    packets instead of four. The peer list is cached per info
+    hash for as long as the tracker's ``interval`` says it is fresh, so asking
+    for peers again does not hit the tracker. The client sends the
+    ``started`` event on a torrent's first announce; the caller reports
+    ``completed`` and ``stopped``.
+
+    Torrents with an ``announce-list`` (BEP 12) are announced one tier at a
+    time: every tracker of a tier at once, with the peer lists merged, and
+    the next tier only if all of them failed.
+
+    Each announce runs on a daemon thread of its own, so a tracker still
+    retrying after ``announce`` has returned never keeps the process alive
+    or delays later announces.
+
+    The client is safe to use from several threads.
+
+    Example:
+        >>> tracker = TrackerClient()
+        >>> peers = tracker.get_peers(torrent)
+        >>> tracker.announce(torrent, stats, event="completed")
+    """
+
+    def __init__(
+        self,
+        peer_id=PEER_ID,
+        port=LISTEN_PORT,
+        timeout=TRACKER_TIMEOUT,
+        udp_timeout=UDP_BASE_TIMEOUT,
+        udp_retries=UDP_MAX_RETRIES,
+    ):
+        self.peer_id = peer_id
+        self.port = port
+        self.timeout = timeout
+        self.udp_timeout = udp_timeout
+        self.udp_retries = udp_retries
+        self.session = requests.Session()
+        self.key = random.getrandbits(32)
+        self._swarms = {}
+        self._connection_ids = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def announce(self, torrent, stats=None, event=None, on_peers=None):
+        """
+        Announces to the torrent's trackers and caches the peers they return.
+
+        The trackers of the first tier are asked at the same time, so the
+        call returns as soon as the fastest of them hands out peers instead
+        of waiting out slow or dead ones in turn. Only when every tracker of
+        a tier has failed is the next tier asked, as BEP 12 says. Replies
+        that arrive later are merged into the cached peer list without
+        duplicates, and the peers each of them adds are passed to
+        ``on_peers``. A tracker that answers is moved to the front of its tier.
+
+        Args:
+            torrent (Torrent): The parsed torrent.
+            stats (TransferStats, optional): The counters to report; defaults
+                to nothing transferred yet.
+            event (str, optional): ``"started"``, ``"completed"`` or ``"stopped"``.
+            on_peers (callable, optional): Called from a tracker thread with
+                the new peers of each reply that arrives after this call has
+                returned.
+
+        Returns:
+            list: ``(ip, port)`` tuples; empty if every tracker that answered
+            had no peers.
+
+        Raises:
+            ConnectionError: If no tracker answers and the last to fail
+                reported a failure; ``TimeoutError`` or ``OSError`` if it
+                could not be reached.
+        """
+        if stats is None:
+            stats = TransferStats(torrent.length)
+        with self._lock:
+            swarm = self._swarms.get(torrent.info_hash, {})
+            tracker_ids = dict(swarm.get("tracker ids", {}))
+            tiers = [list(tier) for tier in torrent.announce_list]
+        batch = {
+            "peers": [],
+            "known": set(),
+            "answered": set(),
+            "next announce": float("inf"),
+            "returned": False,
+            "on peers": on_peers,
+        }
+        error = None
+        for tier in tiers:
+            replies = {}
+            for url in tier:
+                reply = _in_daemon_thread(
+                    self.announce_to, url, torrent, stats, event, tracker_ids.get(url)
+                )
+                replies[reply] = url
+                reply.add_done_callback(
+                    lambda reply, url=url: self._late_reply(torrent, url, batch, reply)
+                )
+            answered = False
+            for reply in as_completed(replies):
+                if reply.exception() is not None:
+                    error = reply.exception()
+                    continue
+                answered = True
+                with self._lock:
+                    self._merge_reply(torrent, replies[reply], batch, reply.result())
+                    if batch["peers"]:
+                        batch["returned"] = True
+                        return list(batch["peers"])
+            if answered:
+                with self._lock:
+                    batch["returned"] = True
+                    return list(batch["peers"])
+        raise error
+
+    def _merge_reply(self, torrent, url, batch, response):
+        # Called with the lock held, once by the announcing thread and once
+        # by the reply's done callback, whichever comes first.
+        if url in batch["answered"]:
+            return []
+        batch["answered"].add(url)
+        for tier in torrent.announce_list:
+            if url in tier:
+                tier.remove(url)
+                tier.insert(0, url)
+                break
+        added = _merge_peers(batch["known"], response["peers"])
+        batch["peers"] += added
+        batch["next announce"] = min(
+            batch["next announce"], time.monotonic() + response["interval"]
+        )
+        swarm = self._swarms.setdefault(torrent.info_hash, {"tracker ids": {}})
+        swarm["peers"] = list(batch["peers"])
+        swarm["next announce"] = batch["next announce"]
+        if "tracker id" in response:
+            swarm["tracker ids"][url] = response["tracker id"]
+        return added
+
+    def _late_reply(self, torrent, url, batch, reply):
+        if reply.exception() is not None or self._closed:
+            return
+        with self._lock:
+            added = self._merge_reply(torrent, url, batch, reply.result())
+            notify = batch["returned"] and batch["on peers"] is not None
+        if notify and added:
+            batch["on peers"](added)
+
+    def announce_to(self, url, torrent, stats, event=None, tracker_id=None):
+        """
+        Sends one announce to one tracker, without touching the cache.
+
+        Args:
+            url (str): The tracker's announce URL, ``http(s)://`` or ``udp://``.
+            torrent (Torrent): The parsed torrent.
+            stats (TransferStats): The counters to report.
+            event (str, optional): ``"started"``, ``"completed"`` or ``"stopped"``.
+            tracker_id (bytes, optional): The tracker id from an earlier reply.
+
+        Returns:
+            dict: ``peers`` (``(ip, port)`` tuples), ``interval`` and, if the tracker
+            sent one, ``tracker id``.
+
+        Raises:
+            ConnectionError: If the tracker reports a failure.
+        """
+        start = time.monotonic()
+        try:
+            if url.startswith("udp://"):
+                return self._announce_udp(url, torrent, stats, event)
+            return self._announce_http(url, torrent, stats, event, tracker_id)
+        finally:
+            default_metrics().announce.observe(time.monotonic() - start)
+
+    def _announce_http(self, url, torrent, stats, event, tracker_id):
+        params = dict(
+            info_hash=torrent.info_hash,
+            peer_id=self.peer_id,
+            port=self.port,
+            uploaded=stats.uploaded,
+            downloaded=stats.downloaded,
+            left=stats.left,
+            compact=1,
+        )
+        if event:
+            params["event"] = event
+        if tracker_id:
+            params["trackerid"] = tracker_id
+        result = self.session.get(url, params=params, timeout=self.timeout)
+        result.raise_for_status()
+        decoded_result = decode_bencode_at(result.content)[0]
+        if "failure reason" in decoded_result:
+            raise ConnectionError(
+                "Tracker failure: %s" % decoded_result["failure reason"].decode(errors="replace")
+            )
+        response = {
+            "peers": _peer_list(
+                decoded_result.get("peers", b""), decoded_result.get("peers6", b"")
+            ),
+            "interval": decoded_result.get("interval", DEFAULT_ANNOUNCE_INTERVAL),
+        }
+        if "tracker id" in decoded_result:
+            response["tracker id"] = decoded_result["tracker id"]
+        return response
+
+    def _announce_udp(self, url, torrent, stats, event):
+        parsed = urlparse(url)
+        if parsed.hostname is None or parsed.port is None:
+            raise ValueError("UDP tracker URL needs a host and port: %s" % url)
+        address = (parsed.hostname, parsed.port)
+        family, _, _, _, sockaddr = socket.getaddrinfo(*address, type=socket.SOCK_DGRAM)[0]
+        with socket.socket(family, socket.SOCK_DGRAM) as sock:
+            sock.connect(sockaddr)
+            for attempt in range(2):
+                connection_id = self._udp_connection_id(sock, address)
+                payload = struct.pack(
+                    ">20s20sqqqIIIiH",
+                    torrent.info_hash,
+                    self.peer_id,
+                    stats.downloaded,
+                    stats.left,
+                    stats.uploaded,
+                    _UDP_EVENTS[event],
+                    0,
+                    self.key,
+                    -1,
+                    self.port,
+                )
+                try:
+                    reply = self._udp_transact(sock, connection_id, _UDP_ANNOUNCE, payload)
+                except ConnectionError:
+                    # Most likely the connection ID expired early; get a new one once.
+                    with self._lock:
+                        self._connection_ids.pop(address, None)
+                    if attempt:
+                        raise
+                    continue
+                if len(reply) < 12:
+                    raise ValueError("UDP announce reply too short.")
+                interval, _leechers, _seeders = struct.unpack_from(">III", reply)
+                # Over IPv6 the tracker answers with 18-byte entries (BEP 15).
+                ipv6 = family == socket.AF_INET6
+                peers = reply[12:]
+                peers = peers[: len(peers) - len(peers) % (18 if ipv6 else 6)]
+                return {"peers": parse_compact_peers(peers, ipv6), "interval": interval}
+
+    def _udp_connection_id(self, sock, address):
+        with self._lock:
+            cached = self._connection_ids.get(address)
+        if cached is not None and time.monotonic() < cached[1]:
+            return cached[0]
+        reply = self._udp_transact(sock, _UDP_PROTOCOL_ID, _UDP_CONNECT, b"")
+        if len(reply) < 8:
+            raise ValueError("UDP connect reply too short.")
+        (connection_id,) = struct.unpack_from(">Q", reply)
+        with self._lock:
+            self._connection_ids[address] = (
+                connection_id,
+                time.monotonic() + UDP_CONNECTION_ID_LIFETIME,
+            )
+        return connection_id
+
+    def _udp_transact(self, sock, connection_id, action, payload):
+        """
+        Sends one UDP tracker request, retransmitting with exponential backoff.
+
+        Returns:
+            bytes: The reply body after the action and transaction id.
+        """
+        transaction_id = random.getrandbits(32)
+        request = struct.pack(">QII", connection_id, action, transaction_id) + payload
+        for attempt in range(self.udp_retries + 1):
+            sock.send(request)
+            deadline = time.monotonic() + self.udp_timeout * 2**attempt
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                sock.settimeout(remaining)
+                try:
+                    reply = sock.recv(65536)
+                except TimeoutError:
+                    break
+                except ConnectionRefusedError:
+                    # An ICMP error from an earlier packet; keep waiting.
+                    continue
+                if len(reply) < 8:
+                    continue
+                reply_action, reply_transaction = struct.unpack_from(">II", reply)
+                if reply_transaction != transaction_id:
+                    continue
+                if reply_action == _UDP_ERROR:
+                    raise ConnectionError(
+                        "Tracker failure: %s" % reply[8:].decode(errors="replace")
+                    )
+                if reply_action != action:
+                    raise ValueError("UDP tracker replied with action %s." % reply_action)
+                return reply[8:]
+        raise TimeoutError("UDP tracker did not answer.")
+
+    def get_peers(self, torrent, stats=None, on_peers=None):
+        """
+        Returns the torrent's peers, announcing only if the cached list is stale.
+
+        Args:
+            torrent (Torrent): The parsed torrent.
+            stats (TransferStats, optional): The counters to report if an
+                announce is needed.
+            on_peers (callable, optional): Passed on to ``announce``.
+
+        Returns:
+            list: ``(ip, port)`` tuples.
+        """
+        with self._lock:
+            swarm = self._swarms.get(torrent.info_hash)
+            if swarm is not None and time.monotonic() < swarm["next announce"]:
+                return swarm["peers"]
+        return self.announce(
+            torrent, stats, event=None if swarm else "started", on_peers=on_peers
+        )
+
+    def seconds_until_announce(self, torrent):
+        """
+        Reports how long until the tracker expects the next announce.
+
+        Args:
+            torrent (Torrent): The parsed torrent.
+
+        Returns:
+            float: Seconds until the cached peer list goes stale; 0 if it already has.
+        """
+        with self._lock:
+            swarm = self._swarms.get(torrent.info_hash)
+        if swarm is None:
+            return 0.0
+        return max(0.0, swarm["next announce"] - time.monotonic())
+
+    def forget(self, torrent):
+        """
+        Drops the cached state for a torrent, e.g. after sending ``stopped``.
+
+        Args:
+            torrent (Torrent): The parsed torrent.
+        """
+        with self._lock:
+            self._swarms.pop(torrent.info_hash, None)
+
+    def close(self):
+        """Closes the HTTP session; replies still outstanding are dropped."""
+        self._closed = True
+        self.session.close()
+
+def _in_daemon_thread(function, *args):
+    # Like Executor.submit, but on a daemon thread of its own, so a call still
+    # running (a UDP tracker retrying, say) never holds up interpreter exit.
+    future = Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(function(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+async def _await_in_daemon_thread(function, *args, timeout=None):
+    # asyncio.to_thread for tracker calls. A default-executor thread keeps
+    # running after its awaiter is cancelled or times out, and asyncio.run
+    # waits for it before returning; a daemon thread is simply left behind.
+    return await asyncio.wait_for(asyncio.wrap_future(_in_daemon_thread(function, *args)), timeout)
+
+_default_tracker = None
+
+def default_tracker():
+    """
+    Returns the process-wide tracker client, creating it on first use.
+
+    Returns:
+        TrackerClient: The shared client.
+    """
+    global _default_tracker
+    if _default_tracker is None:
+        _default_tracker = TrackerClient()
+    return _default_tracker
+
+def get_peers(torrent, stats=None):
+    """
+    Retrieves a list of peers from a torrent file.
+
+    Peers come from the shared tracker client, so repeated calls within the
+    tracker's announce interval reuse the cached list.
+
+    Args:
+        torrent (Torrent): The parsed torrent.
+        stats (TransferStats, optional): The counters to report if an
+            announce is needed.
+
+    Returns:
+        list: ``(ip, port)`` tuples.
+
+    Example:
+        >>> get_peers(Torrent.from_file("example.torrent"))
+        [('1.2.3.4', 5678), ('5.6.7.8', 9012)]
+    """
+    return default_tracker().get_peers(torrent, stats)
+
+def split_peers(peers):
+    """
+    Splits a list of peers into individual peers.
+
+    Args:
+        peers (bytes): The list of peers.
+
+    Returns:
+        list: A list of individual peers.
+
+    Example:
+        >>> split_peers(b'\x01\x02\x03\x04\x05\x06\x07\x08\x09\x10\x11\x12')
+        ['1.2.3.4:5678', '5.6.7.8:9012']
+    """
+    return [format_peer(peer) for peer in parse_compact_peers(peers)]
+
+def format_peer(peer):
+    """
+    Formats a peer address for display.
+
+    Args:
+        peer (tuple): The peer's ``(ip, port)``.
+
+    Returns:
+        str: ``"ip:port"``, with IPv6 addresses in brackets.
+
+    Example:
+        >>> format_peer(("::1", 6881))
+        '[::1]:6881'
+    """
+    ip, port = peer
+    if ":" in ip:
+        return "[%s]:%d" % (ip, port)
+    return "%s:%d" % (ip, port)
+
+def init_handshake(torrent, peer):
+    """
+    Initializes a handshake with a BitTorrent peer.
+
+    Args:
+        torrent (Torrent): The parsed torrent.
+        peer (tuple or str): The peer's ``(ip, port)``, or ``"ip:port"``.
+
+    The connect and the handshake each run under their own deadline; later
+    reads on the socket time out after ``MESSAGE_TIMEOUT`` seconds.
+
+    Returns:
+        tuple: A tuple containing the socket object and the received handshake message.
+
+    Raises:
+        ValueError: If the peer did not answer with a BitTorrent handshake
+            for the torrent.
+
+    Example:
+        >>> s, received_message = init_handshake(torrent, "192.168.1.100:6881")
+        >>> print(received_message)
+    """
+    ip, port = parse_peer_address(peer)
+    message = _handshake_message(torrent.info_hash, PEER_ID)
+    s = socket.socket(socket.AF_INET6 if ":" in ip else socket.AF_INET, socket.SOCK_STREAM)
+    # Requests are small and pipelined; don't let Nagle hold them back.
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+        s.settimeout(CONNECT_TIMEOUT)
+        s.connect((ip, port))
+        s.settimeout(HANDSHAKE_TIMEOUT)
+        s.sendall(message)
+        # Exactly the 68 bytes of the handshake, however they arrive. Anything
+        # after this is the start of the bitfield.
+        received_message = bytearray(68)
+        _recv_exactly_into(s, memoryview(received_message))
+        _check_handshake(received_message, torrent.info_hash)
+        s.settimeout(MESSAGE_TIMEOUT)
+    except BaseException:
+        s.close()
+        raise
+    return s, bytes(received_message)
+
+def construct_message(message_id, payload):
+    """
+    Constructs a BitTorrent message.
+
+    Args:
+        message_id (int): The ID of the message.
+        payload (bytes): The payload of the message.
+
+    Returns:
+        bytes: The constructed message.
+
+    Example:
+        >>> message = construct_message(6, b"example payload")
+        >>> print(message)
+    """
+    message_id = message_id.to_bytes(1)
+    message = message_id + payload
+    length = len(message)
+    length_prefix = length.to_bytes(4, byteorder="big")
+    message = length_prefix + message
+    return message
+
+def verify_message(message, message_id):
+    """
+    Verifies a BitTorrent message.
+
+    Args:
+        message (bytes): The message to verify.
+        message_id (int): The expected ID of the message.
+
+    Raises:
+        ValueError: If the message ID or length is incorrect.
 
     Example:
         >>> verify_message(b"\x00\x00\x00\x10\x06example payload", 6)
     """
-    if message[4] != message_id:
-        raise ValueError(
-            "Expected message of id %s, but received id %s" % (message_id, message[4])
-        )
-    if int.from_bytes(message[:4]) != len(message[4:]):
-        raise ValueError("Message wrong length.")
+    if message[4] != message_id:
+        raise ValueError(
+            "Expected message of id %s, but received id %s" % (message_id, message[4])
+        )
+    if int.from_bytes(message[:4]) != len(message[4:]):
+        raise ValueError("Message wrong length.")
+
+def request_block(s, piece_index, block_index, length):
+    """
+    Requests a block from a BitTorrent peer.
+
+    Args:
+        s (socket): The socket object.
+        piece_index (int): The index of the piece.
+        block_index (int): The index of the block.
+        length (int): The length of the block.
+
+    Returns:
+        bytes: The received block.
+
+    Example:
+        >>> block = request_block(s, 0, 0, 2**14)
+        >>> print(block)
+    """
+    index = piece_index
+    begin = block_index * 2**14
+    length = length
+    payload = (
+        struct.pack(">I", index) + struct.pack(">I", begin) + struct.pack(">I", length)
+    )
+    message = construct_message(6, payload)
+    s.send(message)
+    piece_message = receive_message(s)
+    while piece_message[4] != 7:
+        piece_message = receive_message(s)
+    # Verify that the block has the payload we expect:
+    verify_message(piece_message, 7)
+    received_index = int.from_bytes(piece_message[5:9])
+    received_begin = int.from_bytes(piece_message[9:13])
+    if received_index != index or received_begin != begin:
+        raise ValueError("Piece message does not have expected payload.")
+    block = piece_message[13:]
+    return block
+
+def receive_message(s):
+    """
+    Receive a message from a socket.
+
+    This function receives a message from a socket, handling cases where the message is not fully received.
+
+    Args:
+        s (socket): The socket to receive the message from.
+
+    Returns:
+        bytearray: The received message.
+
+    Raises:
+        ValueError: If the message is longer than ``MAX_MESSAGE_LENGTH``.
+
+    Example:
+        >>> import socket
+        >>> s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        >>> s.connect(("example.com", 80))
+        >>> message = receive_message(s)
+        >>> print(message)
+    """
+    length = bytearray(4)
+    while True:
+        _recv_exactly_into(s, memoryview(length))
+        if int.from_bytes(length):
+            break
+    if int.from_bytes(length) > MAX_MESSAGE_LENGTH:
+        raise ValueError("Message of %d bytes is too long." % int.from_bytes(length))
+    # One buffer per message, filled in place however the bytes trickle in.
+    message = bytearray(4 + int.from_bytes(length))
+    message[:4] = length
+    _recv_exactly_into(s, memoryview(message)[4:])
+    return message
+
+def _recv_exactly_into(s, view):
+    while view:
+        received = s.recv_into(view)
+        if not received:
+            raise ConnectionError("Peer closed the connection.")
+        view = view[received:]
+
+BLOCK_SIZE = 2**14
+
+# Number of block requests kept outstanding per connection.
+PIPELINE_DEPTH = 8
+
+# Per-operation deadlines, in seconds.
+CONNECT_TIMEOUT = 10
+HANDSHAKE_TIMEOUT = 10
+# How long an idle connection may stay silent. Peers send a keep-alive at
+# least every two minutes.
+MESSAGE_TIMEOUT = 150
+# How long we wait for the next block while requests are outstanding.
+REQUEST_TIMEOUT = 30
+KEEPALIVE_INTERVAL = 90
+
+# Longest message we accept outside of piece payloads, which are received
+# in place. A bitfield for a million pieces still fits.
+MAX_MESSAGE_LENGTH = 2**20
+
+# Payloads of the fixed-size messages: have (index), and request and cancel
+# (index, begin, length).
+HAVE_PAYLOAD = struct.Struct(">I")
+REQUEST_PAYLOAD = struct.Struct(">III")
+
+def _unpack_payload(message, payload):
+    """
+    Unpacks the payload of a fixed-size message, checking its length first.
+
+    Args:
+        message (bytes): The message, with its length prefix and id.
+        payload (struct.Struct): The layout of its payload.
+
+    Returns:
+        tuple: The unpacked fields.
+
+    Raises:
+        ValueError: If the payload is not exactly ``payload.size`` bytes.
+    """
+    if len(message) != 5 + payload.size:
+        raise ValueError(
+            "Message %d has %d payload bytes, not %d." % (message[4], len(message) - 5, payload.size)
+        )
+    return payload.unpack_from(message, 5)
+
+def parse_peer_address(peer):
+    """
+    Splits a peer address into host and port.
+
+    Tracker peers are already ``(ip, port)`` tuples and are returned as is;
+    addresses typed on the command line are parsed.
+
+    Args:
+        peer (tuple or str): The peer's ``(ip, port)``, or its address in the
+            format "ip:port" or "[ipv6]:port".
+
+    Returns:
+        tuple: A tuple containing the host and the integer port.
+
+    Example:
+        >>> parse_peer_address("192.168.1.100:6881")
+        ('192.168.1.100', 6881)
+    """
+    if isinstance(peer, tuple):
+        return peer
+    host, _, port = peer.rpartition(":")
+    return host.strip("[]"), int(port)
+
+# Reserved handshake bytes: bit 0x10 of byte 5 announces the extension
+# protocol (BEP 10).
+RESERVED_BYTES = b"\x00\x00\x00\x00\x00\x10\x00\x00"
+
+# Weight of the newest sample in the per-peer moving averages.
+STATS_SMOOTHING = 0.3
+
+# Seconds of traffic folded into one transfer rate sample.
+RATE_SAMPLE_INTERVAL = 1.0
+
+# Bounds for the adaptive request window, which follows the peer's
+# bandwidth-delay product.
+MIN_PIPELINE_DEPTH = 2
+MAX_PIPELINE_DEPTH = 64
+
+class PeerStats:
+    """
+    Exponentially weighted moving averages describing one peer connection.
+
+    Attributes:
+        rate (float): Bytes per second received from the peer.
+        rtt (float): Seconds from sending a block request to its reply, or
+            None before the first block.
+        min_rtt (float): The shortest such time seen: the round trip without
+            queueing behind our other requests.
+        chokes (float): Chokes per piece downloaded.
+        hash_failures (float): The fraction of its pieces that failed verification.
+        started (float): The event loop time the connection came up.
+
+    Example:
+        >>> stats = PeerStats(loop.time())
+        >>> stats.received(16384, 0.05, loop.time())
+        >>> stats.window(PIPELINE_DEPTH)
+    """
+
+    __slots__ = (
+        "rate", "rtt", "min_rtt", "chokes", "hash_failures", "started",
+        "_sample_bytes", "_sample_start", "_piece_chokes",
+    )
+
+    def __init__(self, now):
+        self.rate = 0.0
+        self.rtt = None
+        self.min_rtt = None
+        self.chokes = 0.0
+        self.hash_failures = 0.0
+        self.started = now
+        self._sample_bytes = 0
+        self._sample_start = now
+        self._piece_chokes = 0
+
+    @staticmethod
+    def _smooth(average, sample):
+        return average + STATS_SMOOTHING * (sample - average)
+
+    def update(self, now):
+        """
+        Closes the current rate sample once it spans ``RATE_SAMPLE_INTERVAL``.
+
+        Call it before reading ``rate`` so a stalled peer's rate decays.
+
+        Args:
+            now (float): The event loop time.
+        """
+        elapsed = now - self._sample_start
+        if elapsed >= RATE_SAMPLE_INTERVAL:
+            self.rate = self._smooth(self.rate, self._sample_bytes / elapsed)
+            self._sample_bytes = 0
+            self._sample_start = now
+
+    def received(self, length, rtt, now):
+        """
+        Records a block.
+
+        Args:
+            length (int): The block's size in bytes.
+            rtt (float): Seconds since the block was requested.
+            now (float): The event loop time.
+        """
+        self._sample_bytes += length
+        self.rtt = rtt if self.rtt is None else self._smooth(self.rtt, rtt)
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        self.update(now)
+
+    def choked(self):
+        self._piece_chokes += 1
+
+    def piece_done(self):
+        self.chokes = self._smooth(self.chokes, self._piece_chokes)
+        self._piece_chokes = 0
+
+    def verified(self, intact):
+        self.hash_failures = self._smooth(self.hash_failures, 0.0 if intact else 1.0)
+
+    def window(self, default=PIPELINE_DEPTH):
+        """
+        Sizes the request window to keep one round trip's worth of data in flight.
+
+        Args:
+            default (int): The window to use until there are measurements.
+
+        Returns:
+            int: The number of block requests to keep outstanding.
+        """
+        if self.min_rtt is None or not self.rate:
+            return default
+        # The plain round trip: the smoothed one includes queueing behind our
+        # own requests and would grow the window without bound.
+        in_flight = self.rate * self.min_rtt / BLOCK_SIZE
+        # Headroom, so the window can grow when the peer speeds up.
+        return max(MIN_PIPELINE_DEPTH, min(MAX_PIPELINE_DEPTH, math.ceil(in_flight * 1.5) + 1))
+
+def _handshake_message(info_hash, peer_id):
+    return struct.pack(">B", 19) + b"BitTorrent protocol" + RESERVED_BYTES + info_hash + peer_id
+
+def _check_handshake(message, info_hash):
+    # A peer answering for another torrent, or not speaking BitTorrent at all,
+    # is dropped before anything else is read from it.
+    if message[:20] != b"\x13BitTorrent protocol":
+        raise ValueError("Not a BitTorrent handshake.")
+    if message[28:48] != info_hash:
+        raise ValueError("Handshake for a different torrent.")
+
+class PeerConnection:
+    """
+    An asyncio connection to one peer speaking the peer-wire protocol.
+
+    Every network operation runs under its own deadline, so a slow or dead
+    peer only ever stalls its own connection. A background task sends
+    keep-alives while the connection is otherwise idle.
+
+    The connection drives its non-blocking socket directly with
+    ``loop.sock_recv_into``, so piece payloads are received straight into
+    the caller's piece buffer at their ``begin`` offset instead of passing
+    through intermediate ``bytes`` objects.
+
+    Messages are returned in the same framing ``receive_message`` uses: the
+    4-byte length prefix followed by the message id and payload.
+
+    Attributes:
+        peer (tuple or str): The peer's ``(ip, port)`` or "ip:port" address.
+        stats (PeerStats): Transfer statistics, updated by ``request_piece``.
+        traffic (PeerTraffic): The peer's byte counters in ``default_metrics``,
+            updated by every read and write.
+        remote_peer_id (bytes): The peer id the remote sent in its handshake.
+        handshake_message (bytes): The full 68-byte handshake it sent.
+
+    Example:
+        >>> conn = await PeerConnection.open("192.168.1.100:6881", torrent.info_hash)
+        >>> message = await conn.read_message()
+        >>> conn.close()
+    """
+
+    def __init__(self, peer, sock):
+        self.peer = peer
+        self.sock = sock
+        self.remote_peer_id = None
+        self.handshake_message = None
+        self._loop = asyncio.get_running_loop()
+        self._last_write = self._loop.time()
+        self._send_lock = asyncio.Lock()
+        # Reused for every length prefix and piece header: id, index and begin.
+        self._header = bytearray(9)
+        self._header_view = memoryview(self._header)
+        self._scratch = None
+        self._keepalive = None
+        self.stats = PeerStats(self._loop.time())
+        self.traffic = default_metrics().traffic(peer)
+        self._released = False
+
+    @classmethod
+    async def open(cls, peer, info_hash, peer_id=PEER_ID, pipelined=b""):
+        """
+        Connects to a peer and exchanges handshakes.
+
+        The connect must finish within ``CONNECT_TIMEOUT`` seconds and the
+        handshake within ``HANDSHAKE_TIMEOUT``.
+
+        Args:
+            peer (tuple or str): The peer's ``(ip, port)``, or "ip:port".
+            info_hash (bytes): The torrent's info hash.
+            peer_id (bytes): Our 20-byte peer id.
+            pipelined (bytes): Framed messages to send along with our
+                handshake, e.g. ``interested``, saving a round trip.
+
+        Returns:
+            PeerConnection: The connected peer.
+
+        Raises:
+            ValueError: If the peer's handshake is not for ``info_hash``.
+        """
+        host, port = parse_peer_address(peer)
+        family = socket.AF_INET6 if ":" in host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        # Requests are small and pipelined; don't let Nagle hold them back.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            async with asyncio.timeout(CONNECT_TIMEOUT):
+                await asyncio.get_running_loop().sock_connect(sock, (host, port))
+        except BaseException:
+            sock.close()
+            raise
+        conn = cls(peer, sock)
+        start = conn._loop.time()
+        try:
+            await conn.handshake(info_hash, peer_id, pipelined)
+        except BaseException:
+            conn.close()
+            raise
+        default_metrics().handshake.observe(conn._loop.time() - start)
+        conn._keepalive = asyncio.create_task(conn._send_keepalives())
+        return conn
+
+    @classmethod
+    async def accept(cls, sock, peer, info_hashes, peer_id=PEER_ID):
+        """
+        Answers the handshake of a peer that connected to us.
+
+        The peer speaks first, so we only reply once we know which torrent
+        it wants.
+
+        Args:
+            sock (socket.socket): The accepted socket.
+            peer (tuple): The peer's ``(ip, port)``.
+            info_hashes (container): The info hashes we serve.
+            peer_id (bytes): Our 20-byte peer id.
+
+        Returns:
+            PeerConnection: The connected peer; the info hash it asked for
+            is ``handshake_message[28:48]``.
+
+        Raises:
+            ValueError: If the peer did not send a BitTorrent handshake for
+                one of ``info_hashes``.
+        """
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = cls(peer, sock)
+        try:
+            received_message = bytearray(68)
+            async with asyncio.timeout(HANDSHAKE_TIMEOUT):
+                await conn._recv_into(memoryview(received_message))
+                if received_message[:20] != b"\x13BitTorrent protocol":
+                    raise ValueError("Not a BitTorrent handshake.")
+                info_hash = bytes(received_message[28:48])
+                if info_hash not in info_hashes:
+                    raise ValueError("Handshake for a torrent we do not serve.")
+                await conn.send(_handshake_message(info_hash, peer_id))
+        except BaseException:
+            conn.close()
+            raise
+        conn.handshake_message = bytes(received_message)
+        conn.remote_peer_id = conn.handshake_message[48:68]
+        conn._keepalive = asyncio.create_task(conn._send_keepalives())
+        return conn
+
+    async def _recv_into(self, view):
+        while view:
+            received = await self._loop.sock_recv_into(self.sock, view)
+            if not received:
+                raise ConnectionError("Peer closed the connection.")
+            self.traffic.received += received
+            view = view[received:]
+
+    async def _discard(self, length):
+        if self._scratch is None:
+            self._scratch = memoryview(bytearray(BLOCK_SIZE))
+        while length:
+            chunk = min(length, len(self._scratch))
+            await self._recv_into(self._scratch[:chunk])
+            length -= chunk
+
+    async def _read_length(self):
+        while True:
+            await self._recv_into(self._header_view[:4])
+            length = int.from_bytes(self._header_view[:4])
+            if length:
+                return length
+
+    async def handshake(self, info_hash, peer_id=PEER_ID, pipelined=b""):
+        """
+        Sends our handshake and reads the peer's.
+
+        Args:
+            info_hash (bytes): The torrent's info hash.
+            peer_id (bytes): Our 20-byte peer id.
+            pipelined (bytes): Framed messages to send right after our handshake.
+
+        Returns:
+            bytes: The 68-byte handshake the peer sent.
+
+        Raises:
+            ValueError: If it is not a BitTorrent handshake for ``info_hash``.
+        """
+        message = _handshake_message(info_hash, peer_id) + pipelined
+        received_message = bytearray(68)
+        async with asyncio.timeout(HANDSHAKE_TIMEOUT):
+            await self.send(message)
+            await self._recv_into(memoryview(received_message))
+        _check_handshake(received_message, info_hash)
+        self.handshake_message = bytes(received_message)
+        self.remote_peer_id = self.handshake_message[48:68]
+        return self.handshake_message
+
+    @property
+    def supports_extensions(self):
+        """bool: Whether the peer's handshake announced the extension protocol (BEP 10)."""
+        return bool(self.handshake_message[25] & 0x10)
+
+    async def read_message(self, timeout=MESSAGE_TIMEOUT):
+        """
+        Reads the next message, skipping keep-alives.
+
+        Args:
+            timeout (float): Seconds to wait for the message.
+
+        Returns:
+            bytearray: The length prefix, message id and payload.
+
+        Raises:
+            ValueError: If the message is longer than ``MAX_MESSAGE_LENGTH``.
+        """
+        async with asyncio.timeout(timeout):
+            length = await self._read_length()
+            if length > MAX_MESSAGE_LENGTH:
+                raise ValueError("Message of %d bytes is too long." % length)
+            message = bytearray(4 + length)
+            message[:4] = self._header_view[:4]
+            await self._recv_into(memoryview(message)[4:])
+        return message
+
+    async def send(self, data):
+        """
+        Writes one or more already framed messages.
+
+        Args:
+            data (bytes): The framed messages.
+        """
+        async with self._send_lock:
+            self._last_write = self._loop.time()
+            async with asyncio.timeout(REQUEST_TIMEOUT):
+                await self._loop.sock_sendall(self.sock, data)
+            self.traffic.sent += len(data)
+
+    async def send_block(self, index, begin, chunks):
+        """
+        Sends a piece message whose payload is read straight from files.
+
+        The payload goes from the page cache to the socket with
+        ``os.sendfile`` and is never copied into Python. On Linux the socket
+        is corked while the header and payload go out, so they share
+        segments.
+
+        Args:
+            index (int): The piece index.
+            begin (int): The block's offset within the piece.
+            chunks (list): ``(fd, offset, length)`` parts of the block, in order.
+        """
+        length = sum(chunk[2] for chunk in chunks)
+        header = struct.pack(">IBII", 9 + length, 7, index, begin)
+        cork = getattr(socket, "TCP_CORK", None)
+        async with self._send_lock:
+            self._last_write = self._loop.time()
+            async with asyncio.timeout(REQUEST_TIMEOUT):
+                if cork is not None:
+                    self.sock.setsockopt(socket.IPPROTO_TCP, cork, 1)
+                try:
+                    await self._loop.sock_sendall(self.sock, header)
+                    for fd, offset, count in chunks:
+                        await self._sendfile(fd, offset, count)
+                    self.traffic.sent += len(header) + length
+                finally:
+                    if cork is not None and self.sock.fileno() != -1:
+                        self.sock.setsockopt(socket.IPPROTO_TCP, cork, 0)
+
+    async def _sendfile(self, fd, offset, count):
+        if not hasattr(os, "sendfile"):
+            await self._loop.sock_sendall(self.sock, os.pread(fd, count, offset))
+            return
+        while count:
+            try:
+                sent = os.sendfile(self.sock.fileno(), fd, offset, count)
+            except BlockingIOError:
+                await self._writable()
+                continue
+            if not sent:
+                raise EOFError("File ended before the block did.")
+            offset += sent
+            count -= sent
+
+    async def _writable(self):
+        waiter = self._loop.create_future()
+        fileno = self.sock.fileno()
+        self._loop.add_writer(fileno, lambda: waiter.done() or waiter.set_result(None))
+        try:
+            await waiter
+        finally:
+            self._loop.remove_writer(fileno)
+
+    async def send_message(self, message_id, payload=b""):
+        """
+        Frames and writes a single message.
+
+        Args:
+            message_id (int): The ID of the message.
+            payload (bytes): The payload of the message.
+        """
+        await self.send(construct_message(message_id, payload))
+
+    async def _send_keepalives(self):
+        try:
+            while True:
+                idle = self._loop.time() - self._last_write
+                if idle >= KEEPALIVE_INTERVAL:
+                    await self.send(b"\x00\x00\x00\x00")
+                    idle = 0
+                await asyncio.sleep(KEEPALIVE_INTERVAL - idle)
+        except (OSError, asyncio.CancelledError):
+            pass
+
+    async def request_piece(
+        self,
+        piece_index,
+        length,
+        window=PIPELINE_DEPTH,
+        on_message=None,
+        cancelled=None,
+        throttle=None,
+        buffer=None,
+    ):
+        """
+        Downloads all blocks of a piece, keeping up to ``window`` requests in flight.
+
+        Incoming piece messages are matched back to their request by
+        ``(index, begin)``, and the window is refilled as each block arrives.
+        If the peer chokes us, the outstanding requests are dropped and re-sent
+        after the next unchoke.
+
+        Block payloads are received directly into the piece buffer, which is
+        handed back as is for hashing and writing to disk.
+
+        Args:
+            piece_index (int): The index of the piece.
+            length (int): The length of the piece.
+            window (int): The maximum number of outstanding requests.
+            on_message (callable, optional): Called with every message other
+                than piece, choke and unchoke, e.g. to track ``have`` messages.
+            cancelled (callable, optional): Polled after every message; once it
+                returns true the outstanding requests are cancelled and the
+                piece is abandoned.
+            throttle (callable, optional): A coroutine function awaited with
+                the number of bytes about to be requested, e.g. a rate limit's
+                ``take``.
+            buffer (bytearray, optional): Where to assemble the piece, e.g.
+                one from a ``PiecePool``; at least ``length`` bytes long. A
+                new buffer is allocated if not given.
+
+        Returns:
+            bytearray: The assembled piece (a memoryview of the first
+            ``length`` bytes of ``buffer``, if given), or None if it was
+            cancelled.
+
+        Example:
+            >>> piece = await conn.request_piece(0, 2**18, window=16)
+        """
+        if window < 1:
+            raise ValueError("Pipeline window must be at least 1.")
+        unrequested = deque(
+            (begin, min(BLOCK_SIZE, length - begin)) for begin in range(0, length, BLOCK_SIZE)
+        )
+        pending = {}
+        sent_at = {}
+        piece = bytearray(length) if buffer is None else memoryview(buffer)[:length]
+        piece_view = memoryview(piece)
+        header = self._header
+        stats = self.stats
+        block_rtt = default_metrics().block_rtt
+        choked = False
+        while unrequested or pending:
+            requests_out = []
+            requested = 0
+            while not choked and unrequested and len(pending) < window:
+                begin, block_length = unrequested.popleft()
+                requests_out.append(
+                    construct_message(6, struct.pack(">III", piece_index, begin, block_length))
+                )
+                pending[begin] = block_length
+                requested += block_length
+            if requests_out:
+                if throttle is not None:
+                    await throttle(requested)
+                await self.send(b"".join(requests_out))
+                now = self._loop.time()
+                for begin in pending:
+                    sent_at.setdefault(begin, now)
+            message = None
+            async with asyncio.timeout(REQUEST_TIMEOUT if pending else MESSAGE_TIMEOUT):
+                message_length = await self._read_length()
+                if message_length > MAX_MESSAGE_LENGTH:
+                    raise ValueError("Message of %d bytes is too long." % message_length)
+                await self._recv_into(self._header_view[:1])
+                if header[0] == 7:
+                    if message_length < 9:
+                        raise ValueError("Message wrong length.")
+                    await self._recv_into(self._header_view[1:9])
+                    received_index, received_begin = struct.unpack_from(">II", header, 1)
+                    block_length = message_length - 9
+                    expected = pending.get(received_begin) if received_index == piece_index else None
+                    if expected is None:
+                        # A late reply to a request we already gave up on.
+                        await self._discard(block_length)
+                    elif block_length != expected:
+                        raise ValueError("Piece message does not have expected payload.")
+                    else:
+                        await self._recv_into(
+                            piece_view[received_begin : received_begin + block_length]
+                        )
+                        del pending[received_begin]
+                        now = self._loop.time()
+                        rtt = now - sent_at.pop(received_begin)
+                        stats.received(block_length, rtt, now)
+                        block_rtt.observe(rtt)
+                else:
+                    message = bytearray(4 + message_length)
+                    message[:4] = message_length.to_bytes(4, "big")
+                    message[4] = header[0]
+                    await self._recv_into(memoryview(message)[5:])
+            if cancelled is not None and cancelled():
+                await self.send(
+                    b"".join(
+                        construct_message(8, struct.pack(">III", piece_index, begin, block_length))
+                        for begin, block_length in pending.items()
+                    )
+                )
+                return None
+            if message is None:
+                continue
+            if message[4] == 0:
+                # A choke discards every request the peer has not served yet.
+                choked = True
+                stats.choked()
+                unrequested.extendleft(sorted(pending.items(), reverse=True))
+                pending.clear()
+                sent_at.clear()
+            elif message[4] == 1:
+                choked = False
+            elif on_message is not None:
+                on_message(message)
+        stats.piece_done()
+        return piece
+
+    def close(self):
+        if self._keepalive is not None:
+            self._keepalive.cancel()
+        self.sock.close()
+        if not self._released:
+            self._released = True
+            default_metrics().release(self.peer)
+
+# The message id we ask peers to use for ut_pex (BEP 11), announced in our
+# extension handshake.
+UT_PEX_ID = 1
+
+# Seconds between ut_pex messages to the same peer; BEP 11 asks for at least a minute.
+PEX_INTERVAL = 60
+
+# Most peers added or dropped in one ut_pex message (BEP 11).
+PEX_MAX_PEERS = 50
+
+def extension_handshake(port=None, pex=True):
+    """
+    Builds our extension protocol handshake (BEP 10), advertising ut_pex.
+
+    Args:
+        port (int, optional): The port we accept connections on, if any.
+        pex (bool): Whether to advertise ut_pex; False for private
+            torrents, which BEP 27 keeps off peer exchange.
+
+    Returns:
+        bytes: The payload of the extended message, starting with the
+        extended message id 0.
+    """
+    handshake = {"m": {"ut_pex": UT_PEX_ID} if pex else {}}
+    if port is not None:
+        handshake["p"] = port
+    return b"\x00" + bencode(handshake)
+
+def _compact_peers(peers):
+    # The inverse of parse_compact_peers, split by address family.
+    peers4 = []
+    peers6 = []
+    for ip, port in peers:
+        if ":" in ip:
+            peers6.append(socket.inet_pton(socket.AF_INET6, ip) + struct.pack(">H", port))
+        else:
+            peers4.append(socket.inet_aton(ip) + struct.pack(">H", port))
+    return b"".join(peers4), b"".join(peers6)
+
+def parse_pex(payload):
+    """
+    Reads the peers a ut_pex message adds.
+
+    Args:
+        payload (bytes): The bencoded ut_pex dictionary.
+
+    Returns:
+        list: The added peers' ``(ip, port)`` tuples. Dropped peers are
+        ignored; connections to them fail on their own.
+
+    Raises:
+        ValueError: If the message is malformed.
+    """
+    message = decode_bencode_all(bytes(payload))
+    if not isinstance(message, dict):
+        raise ValueError("ut_pex message is not a dictionary.")
+    added = message.get("added", b"")
+    added6 = message.get("added6", b"")
+    if not isinstance(added, bytes) or not isinstance(added6, bytes):
+        raise ValueError("ut_pex peer lists must be strings.")
+    return parse_compact_peers(added) + parse_compact_peers(added6, ipv6=True)
+
+class PeerExchange:
+    """
+    Remembers what we told one peer about the swarm, so ut_pex messages
+    only carry changes (BEP 11).
+
+    Args:
+        remote_id (int): The message id the peer assigned to ut_pex in its
+            extension handshake.
+
+    Example:
+        >>> pex = PeerExchange(2)
+        >>> payload = pex.message({("10.0.0.1", 6881)})
+        >>> await conn.send_message(20, payload)
+    """
+
+    __slots__ = ("remote_id", "sent", "next_send")
+
+    def __init__(self, remote_id):
+        self.remote_id = remote_id
+        self.sent = set()
+        self.next_send = 0.0
+
+    def message(self, peers):
+        """
+        Builds the next ut_pex message.
+
+        Args:
+            peers (set): The peers we are connected to now, other than this one.
+
+        Returns:
+            bytes: The extended message payload, or None if nothing changed.
+        """
+        added = [peer for peer in peers if peer not in self.sent][:PEX_MAX_PEERS]
+        dropped = [peer for peer in self.sent if peer not in peers][:PEX_MAX_PEERS]
+        if not added and not dropped:
+            return None
+        self.sent.difference_update(dropped)
+        self.sent.update(added)
+        added4, added6 = _compact_peers(added)
+        dropped4, dropped6 = _compact_peers(dropped)
+        message = {
+            "added": added4,
+            "added.f": b"\x00" * (len(added4) // 6),
+            "added6": added6,
+            "added6.f": b"\x00" * (len(added6) // 18),
+            "dropped": dropped4,
+            "dropped6": dropped6,
+        }
+        return bytes([self.remote_id]) + bencode(message)
+
+def _read_extension_handshake(payload):
+    # Returns the id a peer's extension handshake assigns to ut_pex and the
+    # port it accepts connections on; either may be None.
+    handshake = decode_bencode_all(bytes(payload))
+    extensions = handshake.get("m") if isinstance(handshake, dict) else None
+    if not isinstance(extensions, dict):
+        raise ValueError("Extension handshake without an 'm' dictionary.")
+    remote_id = extensions.get("ut_pex")
+    if not (isinstance(remote_id, int) and 0 < remote_id < 256):
+        remote_id = None
+    port = handshake.get("p")
+    if not (isinstance(port, int) and 0 < port < 65536):
+        port = None
+    return remote_id, port
+
+async def _start_download(conn, piece_count, on_message=None, interested=True):
+    """
+    Declares interest and collects the peer's pieces until it unchokes us.
+
+    The bitfield and ``have`` messages a peer sends straight after its
+    handshake all land in one ``Bitfield``.
+
+    Args:
+        conn (PeerConnection): The connected peer.
+        piece_count (int): The number of pieces in the torrent.
+        on_message (callable, optional): Called with any other message
+            that arrives meanwhile, such as extended messages.
+        interested (bool): Whether to send ``interested``; False if it
+            already went out with the handshake.
+
+    Returns:
+        Bitfield: The pieces the peer announced.
+    """
+    bitfield = Bitfield(piece_count)
+    if interested:
+        await conn.send_message(2)
+    message = await conn.read_message()
+    while message[4] != 1:
+        if message[4] == 5:
+            bitfield = Bitfield(piece_count, message[5:])
+        elif message[4] == 4:
+            bitfield.add(_unpack_payload(message, HAVE_PAYLOAD)[0])
+        elif on_message is not None:
+            on_message(message)
+        message = await conn.read_message()
+    return bitfield
+
+def handshake(torrent, peer):
+    """
+    Connects to a peer, exchanges handshakes and disconnects.
+
+    Args:
+        torrent (Torrent): The parsed torrent.
+        peer (str): The peer's address in the format "ip:port".
+
+    Returns:
+        bytes: The peer id the remote sent.
+
+    Example:
+        >>> handshake(torrent, "192.168.1.100:6881").hex()
+        '2d524e302e302e302d5af5a26b8fd5a6e6f10d27'
+    """
+
+    async def run():
+        conn = await PeerConnection.open(peer, torrent.info_hash)
+        conn.close()
+        return conn.remote_peer_id
+
+    return asyncio.run(run())
+
+# The number of peers asked for the same piece by ``download_piece``.
+PIECE_RACE_PEERS = 3
+
+async def _fetch_piece(peer, torrent, index, window):
+    # One peer's verified copy of a piece.
+    conn = await PeerConnection.open(peer, torrent.info_hash, pipelined=construct_message(2, b""))
+    try:
+        await _start_download(conn, torrent.piece_count, interested=False)
+        # Only the last piece may be short
+        piece = await conn.request_piece(index, torrent.piece_size(index), window)
+    finally:
+        conn.close()
+    if hashlib.sha1(piece).digest() != torrent.piece_hashes[index]:
+        raise ValueError("Piece hash mismatch.")
+    return piece
+
+async def download_piece_async(outputfile, torrent, piececount, window=PIPELINE_DEPTH):
+    """
+    Download a single piece of a torrent file; the coroutine behind ``download_piece``.
+
+    The first ``PIECE_RACE_PEERS`` peers are all asked for the piece and the
+    first verified copy is kept, so a slow or broken peer early in the
+    tracker's list does not decide how long the download takes.
+
+    Args:
+        outputfile (str): The file to write the piece to.
+        torrent (Torrent): The parsed torrent.
+        piececount (int): The index of the piece to download.
+        window (int): The number of block requests to keep in flight.
+
+    Returns:
+        tuple: A tuple containing the piece index and the file path.
+    """
+    peers = await asyncio.to_thread(get_peers, torrent)
+    racers = [
+        asyncio.create_task(_fetch_piece(peer, torrent, piececount, window))
+        for peer in peers[:PIECE_RACE_PEERS]
+    ]
+    try:
+        error = ConnectionError("The tracker returned no peers.")
+        for racer in asyncio.as_completed(racers):
+            try:
+                piece = await racer
+                break
+            except (OSError, EOFError, ValueError) as e:
+                error = e
+        else:
+            raise error
+    finally:
+        for racer in racers:
+            racer.cancel()
+        await asyncio.gather(*racers, return_exceptions=True)
+    # Write piece to disk
+    with open(outputfile, "wb") as piece_file:
+        piece_file.write(piece)
+    # Return piece completed and location
+    return piececount, outputfile
+
+def download_piece(outputfile, torrent, piececount, window=PIPELINE_DEPTH):
+    """
+    Download a single piece of a torrent file.
+
+    This function downloads a single piece of a torrent file from a peer, verifies its hash, and writes it to disk.
+
+    Args:
+        outputfile (str): The file to write the piece to.
+        torrent (Torrent): The parsed torrent.
+        piececount (int): The index of the piece to download.
+        window (int): The number of block requests to keep in flight.
+
+    Returns:
+        tuple: A tuple containing the piece index and the file path.
+
+    Example:
+        >>> download_piece("/tmp/test-0", torrent, 0)
+        (0, "/tmp/test-0")
+    """
+    return asyncio.run(download_piece_async(outputfile, torrent, piececount, window))
+
+# Maximum number of peers the download command connects to at once.
+MAX_PEERS = 50
+
+# Peers dialled beyond MAX_PEERS, so that peers which are dead, slow to
+# handshake or still choking us do not hold up the download slots.
+DIAL_SURPLUS = 16
+
+class DownloadSlots:
+    """
+    The connections allowed to download at once, and those waiting to.
+
+    Args:
+        count (int): The number of slots.
+
+    Attributes:
+        waiting (set): The peers whose connections are ready to download,
+            waiting in ``acquire``.
+
+    Example:
+        >>> slots = DownloadSlots(MAX_PEERS)
+        >>> await slots.acquire(peer)
+        >>> slots.release()
+    """
+
+    __slots__ = ("waiting", "_semaphore")
+
+    def __init__(self, count):
+        self.waiting = set()
+        self._semaphore = asyncio.Semaphore(count)
+
+    async def acquire(self, peer):
+        self.waiting.add(peer)
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting.discard(peer)
+
+    def release(self):
+        self._semaphore.release()
+
+# A peer is dropped after sending this many pieces that fail the hash check.
+MAX_HASH_FAILURES = 3
+
+class Bitfield:
+    """
+    A compact set of piece indices, laid out as in the bitfield message.
+
+    Example:
+        >>> bitfield = Bitfield(10, b"\xa0\x00")
+        >>> 0 in bitfield, 1 in bitfield, list(bitfield)
+        (True, False, [0, 2])
+    """
+
+    __slots__ = ("length", "bits")
+
+    def __init__(self, length, bits=None):
+        self.length = length
+        size = (length + 7) // 8
+        if bits is None:
+            self.bits = bytearray(size)
+        else:
+            if len(bits) != size:
+                raise ValueError("Bitfield has the wrong length.")
+            self.bits = bytearray(bits)
+            if length % 8:
+                # Spare bits at the end must be ignored.
+                self.bits[-1] &= (0xFF00 >> (length % 8)) & 0xFF
+
+    def __contains__(self, index):
+        return 0 <= index < self.length and bool(self.bits[index >> 3] & (0x80 >> (index & 7)))
+
+    def __iter__(self):
+        bits = self.bits
+        for byte_index, byte in enumerate(bits):
+            if byte:
+                for bit in range(8):
+                    if byte & (0x80 >> bit):
+                        yield byte_index * 8 + bit
+
+    def add(self, index):
+        """
+        Marks a piece as present.
+
+        Args:
+            index (int): The piece index.
+        """
+        if not 0 <= index < self.length:
+            raise ValueError("Piece index %s out of range." % index)
+        self.bits[index >> 3] |= 0x80 >> (index & 7)
+
+    def count(self):
+        """
+        Counts the pieces present.
+
+        Returns:
+            int: The number of set bits.
+        """
+        return int.from_bytes(self.bits).bit_count()
+
+class PieceScheduler:
+    """
+    Hands out pieces to peer connections, rarest first.
+
+    Wanted pieces are kept in buckets keyed by how many connected peers have
+    them, so picking the rarest piece a peer can serve only looks at the
+    lowest buckets. Once every remaining piece has been handed out, the
+    scheduler enters endgame mode and hands the still-outstanding pieces to
+    further peers as well; the first copy to complete wins.
+
+    The scheduler is driven from a single event loop and does no locking.
+    ``wait_for_change`` wakes up whenever a piece is completed or given back,
+    or availability changes.
+
+    Example:
+        >>> scheduler = PieceScheduler(3)
+        >>> scheduler.add_bitfield(Bitfield(3, b"\xe0"))
+        >>> scheduler.pick(Bitfield(3, b"\xe0")) in (0, 1, 2)
+        True
+    """
+
+    def __init__(self, piece_count, completed=None):
+        self.piece_count = piece_count
+        self.completed = completed if completed is not None else Bitfield(piece_count)
+        self.remaining = piece_count - self.completed.count()
+        self.availability = [0] * piece_count
+        self.in_progress = {}
+        self.verifying = set()
+        self._buckets = {0: set(range(piece_count)) - set(self.completed)}
+        self._changed = asyncio.Event()
+
+    @property
+    def done(self):
+        return self.remaining == 0
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait_for_change(self, timeout):
+        """
+        Waits until the scheduler's state changes or ``timeout`` seconds pass.
+
+        Args:
+            timeout (float): The longest time to wait.
+        """
+        try:
+            async with asyncio.timeout(timeout):
+                await self._changed.wait()
+        except TimeoutError:
+            pass
+
+    def _move(self, index, delta):
+        old = self.availability[index]
+        self.availability[index] = old + delta
+        bucket = self._buckets.get(old)
+        if bucket is not None and index in bucket:
+            bucket.discard(index)
+            if not bucket:
+                del self._buckets[old]
+            self._buckets.setdefault(old + delta, set()).add(index)
+
+    def add_bitfield(self, bitfield):
+        """
+        Counts a newly connected peer's pieces towards availability.
+
+        Args:
+            bitfield (Bitfield): The peer's pieces.
+        """
+        for index in bitfield:
+            self._move(index, 1)
+        self._notify()
+
+    def add_have(self, index):
+        """
+        Counts a single piece announced by a peer's have message.
+
+        Args:
+            index (int): The piece index.
+        """
+        self._move(index, 1)
+        self._notify()
+
+    def remove_bitfield(self, bitfield):
+        """
+        Drops a disconnected peer's pieces from availability.
+
+        Args:
+            bitfield (Bitfield): The peer's pieces.
+        """
+        for index in bitfield:
+            self._move(index, -1)
+
+    def pick(self, bitfield):
+        """
+        Chooses the next piece for a peer and marks it in progress.
+
+        Args:
+            bitfield (Bitfield): The pieces the peer has.
+
+        Returns:
+            int: The piece index, or None if the peer has nothing we need.
+        """
+        for availability in sorted(self._buckets):
+            if availability == 0:
+                continue
+            bucket = self._buckets[availability]
+            for index in bucket:
+                if index in bitfield:
+                    bucket.discard(index)
+                    if not bucket:
+                        del self._buckets[availability]
+                    self.in_progress[index] = 1
+                    return index
+        if any(self._buckets.values()):
+            return None
+        # Endgame: everything left is already being fetched somewhere.
+        candidates = [
+            index
+            for index in self.in_progress
+            if index in bitfield and index not in self.verifying
+        ]
+        if not candidates:
+            return None
+        index = min(candidates, key=self.in_progress.__getitem__)
+        self.in_progress[index] += 1
+        return index
+
+    def abort(self, index):
+        """
+        Gives back a piece whose download failed or was abandoned.
+
+        Args:
+            index (int): The piece index.
+        """
+        if index not in self.in_progress:
+            return
+        self.in_progress[index] -= 1
+        if self.in_progress[index] == 0:
+            del self.in_progress[index]
+            if index not in self.completed:
+                self._buckets.setdefault(self.availability[index], set()).add(index)
+        self._notify()
+
+    def downloaded(self, index):
+        """
+        Records that a piece has been received and is waiting for its hash check.
+
+        Endgame no longer hands the piece out again while it is checked.
+
+        Args:
+            index (int): The piece index.
+        """
+        self.verifying.add(index)
+
+    def reject(self, index):
+        """
+        Gives back a received piece that failed its hash check.
+
+        Args:
+            index (int): The piece index.
+        """
+        self.verifying.discard(index)
+        self.abort(index)
+
+    def complete(self, index):
+        """
+        Records a verified piece.
+
+        Args:
+            index (int): The piece index.
+
+        Returns:
+            bool: True for the first copy of the piece, False for an endgame duplicate.
+        """
+        self.in_progress.pop(index, None)
+        self.verifying.discard(index)
+        if index in self.completed:
+            return False
+        self.completed.add(index)
+        self.remaining -= 1
+        self._notify()
+        return True
+
+    def is_complete(self, index):
+        return index in self.completed
+
+# Pieces ahead of the read cursor that a streaming download fetches in order.
+STREAM_WINDOW = 16
+
+# Seconds a piece in the streaming window may take before another peer is
+# also asked for it, until there is a measured piece time to go by.
+STREAM_FIRST_DEADLINE = 5.0
+
+# A piece's deadline, in multiples of the average time a piece takes.
+STREAM_DEADLINE_FACTOR = 2.0
+
+class StreamingScheduler(PieceScheduler):
+    """
+    Hands out pieces in order within a sliding window ahead of a reader.
+
+    The ``window`` pieces from ``cursor`` on are picked lowest index first.
+    Each gets a deadline when it is handed out, ``STREAM_DEADLINE_FACTOR``
+    times the average piece time from now; a piece still outstanding past
+    its deadline is handed to the next peer that asks as well, so one slow
+    peer cannot hold up the reader. Once every piece in the window is taken,
+    peers fall back to rarest first over the rest of the torrent, unless
+    ``beyond_window`` is False: then nothing past the window is fetched, so
+    a reader that keeps no copy on disk need only buffer the window.
+
+    Example:
+        >>> scheduler = StreamingScheduler(100, window=8)
+        >>> scheduler.advance(10)  # the reader is done with pieces 0-9
+    """
+
+    def __init__(self, piece_count, completed=None, window=STREAM_WINDOW, beyond_window=True):
+        super().__init__(piece_count, completed)
+        self.window = window
+        self.beyond_window = beyond_window
+        self.cursor = 0
+        self.piece_time = None
+        self.deadlines = {}
+        self._handed_out = {}
+
+    def advance(self, cursor):
+        """
+        Moves the window to start at the first piece the reader still needs.
+
+        Args:
+            cursor (int): The piece index.
+        """
+        self.cursor = cursor
+        self._notify()
+
+    def _hand_out(self, index, now):
+        allowance = (
+            STREAM_FIRST_DEADLINE if self.piece_time is None
+            else self.piece_time * STREAM_DEADLINE_FACTOR
+        )
+        self.deadlines[index] = now + allowance
+        return index
+
+    def pick(self, bitfield):
+        now = time.monotonic()
+        late = None
+        for index in range(self.cursor, min(self.piece_count, self.cursor + self.window)):
+            if index in self.completed or index in self.verifying or index not in bitfield:
+                continue
+            if index not in self.in_progress:
+                bucket = self._buckets.get(self.availability[index])
+                if bucket is not None:
+                    bucket.discard(index)
+                    if not bucket:
+                        del self._buckets[self.availability[index]]
+                self.in_progress[index] = 1
+                self._handed_out[index] = now
+                return self._hand_out(index, now)
+            if late is None and now > self.deadlines.get(index, now):
+                late = index
+        if late is not None:
+            self.in_progress[late] += 1
+            return self._hand_out(late, now)
+        if not self.beyond_window:
+            return None
+        return super().pick(bitfield)
+
+    def abort(self, index):
+        super().abort(index)
+        if index not in self.in_progress:
+            # Nobody is fetching it any more; a later fetch is timed afresh.
+            self._handed_out.pop(index, None)
+            self.deadlines.pop(index, None)
+
+    def complete(self, index):
+        started = self._handed_out.pop(index, None)
+        self.deadlines.pop(index, None)
+        if started is not None:
+            elapsed = time.monotonic() - started
+            self.piece_time = (
+                elapsed if self.piece_time is None
+                else self.piece_time + STATS_SMOOTHING * (elapsed - self.piece_time)
+            )
+        return super().complete(index)
+
+# Threads used to write verified pieces to disk; os.pwrite releases the GIL.
+DISK_WRITERS = 4
+
+# Upper bound on file descriptors a multi-file torrent keeps open at once.
+MAX_OPEN_FILES = 64
+
+def preallocate(fd, length):
+    """
+    Sizes a file to ``length`` bytes, reserving the blocks where supported.
+
+    Args:
+        fd (int): An open file descriptor.
+        length (int): The final size of the file.
+    """
+    if os.fstat(fd).st_size == length:
+        # Leave existing data, and its modification time, alone.
+        return
+    if length and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, length)
+        except OSError:
+            # Not every filesystem supports fallocate; a sparse file will do.
+            pass
+    os.ftruncate(fd, length)
+
+class FilePool:
+    """
+    A bounded, thread-safe LRU cache of open file descriptors.
+
+    Descriptors in use by another thread are never evicted, so the pool can
+    briefly exceed ``max_open`` under heavy concurrency. A read-only pool
+    opens its files ``O_RDONLY`` and never creates them.
+
+    Example:
+        >>> pool = FilePool(["a.bin", "b.bin"], max_open=1)
+        >>> with pool.handle(1) as fd:
+        ...     os.pwrite(fd, b"data", 0)
+    """
+
+    def __init__(self, paths, max_open=MAX_OPEN_FILES, readonly=False):
+        self.paths = paths
+        self.max_open = max_open
+        self.flags = os.O_RDONLY if readonly else os.O_RDWR | os.O_CREAT
+        self._open = OrderedDict()
+        self._users = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def handle(self, file_index):
+        """
+        Borrows the descriptor for a file, opening it if needed.
+
+        Args:
+            file_index (int): The index of the file in ``paths``.
+
+        Yields:
+            int: The open file descriptor.
+        """
+        with self._lock:
+            fd = self._open.get(file_index)
+            if fd is None:
+                fd = os.open(self.paths[file_index], self.flags, 0o644)
+                self._open[file_index] = fd
+                self._evict()
+            else:
+                self._open.move_to_end(file_index)
+            self._users[file_index] = self._users.get(file_index, 0) + 1
+        try:
+            yield fd
+        finally:
+            with self._lock:
+                self._users[file_index] -= 1
+                if not self._users[file_index]:
+                    del self._users[file_index]
+                self._evict()
+
+    def _evict(self):
+        if len(self._open) <= self.max_open:
+            return
+        for file_index in list(self._open):
+            if len(self._open) <= self.max_open:
+                break
+            if file_index not in self._users:
+                os.close(self._open.pop(file_index))
+
+    def close(self):
+        with self._lock:
+            for fd in self._open.values():
+                os.close(fd)
+            self._open.clear()
+
+def _safe_path_components(components):
+    for component in components:
+        if component in ("", ".", "..") or "/" in component or os.sep in component:
+            raise ValueError("Unsafe path in torrent: %r" % "/".join(components))
+    return components
+
+class Storage:
+    """
+    The on-disk home of a torrent's content.
+
+    A single-file torrent is stored at ``path``; a multi-file torrent is
+    stored under the directory ``path``, which takes the place of the
+    torrent's name. Every file is preallocated to its final size up front,
+    unless the storage is read-only: then the files must already exist at
+    their final sizes and are never created, resized or written.
+
+    The torrent's content is treated as one global byte range. A sorted index
+    of file start offsets maps any range onto ``(file, offset, length)`` spans
+    by binary search, so a piece that crosses file boundaries turns into one
+    positioned write per file it touches. Descriptors come from a bounded LRU
+    pool rather than being opened per piece.
+
+    Writes run on a small thread pool so they never block the event loop, in
+    whatever order pieces complete. Several storages may share one pool.
+
+    Example:
+        >>> with Storage(torrent, "example.txt") as storage:
+        ...     storage.write_piece(0, piece)
+    """
+
+    def __init__(self, torrent, path, max_open_files=MAX_OPEN_FILES, executor=None, readonly=False):
+        self.torrent = torrent
+        self.path = path
+        self.readonly = readonly
+        if torrent.is_multi_file:
+            self.paths = [
+                os.path.join(path, *_safe_path_components(components))
+                for components, _ in torrent.files
+            ]
+        else:
+            self.paths = [path]
+        self.lengths = [length for _, length in torrent.files]
+        self._starts = []
+        offset = 0
+        for length in self.lengths:
+            self._starts.append(offset)
+            offset += length
+        for file_path, length in zip(self.paths, self.lengths):
+            if readonly:
+                # Raises FileNotFoundError for a missing file.
+                size = os.stat(file_path).st_size
+                if size != length:
+                    raise ValueError(
+                        "%s is %d bytes; the torrent expects %d." % (file_path, size, length)
+                    )
+                continue
+            directory = os.path.dirname(file_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            fd = os.open(file_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                preallocate(fd, length)
+            finally:
+                os.close(fd)
+        self.files = FilePool(self.paths, max_open_files, readonly)
+        self._own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(DISK_WRITERS, thread_name_prefix="storage")
+        self._writes = set()
+        self._maps = {}
+        self._maps_lock = threading.Lock()
+
+    def spans(self, offset, length):
+        """
+        Maps a global byte range onto the files that hold it.
+
+        Args:
+            offset (int): The start of the range within the torrent's content.
+            length (int): The length of the range.
+
+        Yields:
+            tuple: ``(file_index, file_offset, span_length)`` for each file
+            the range touches, in order.
+
+        Example:
+            >>> list(storage.spans(90, 20))  # files of length 100 and 50
+            [(0, 90, 10), (1, 0, 10)]
+        """
+        file_index = bisect_right(self._starts, offset) - 1
+        while length > 0:
+            file_offset = offset - self._starts[file_index]
+            span_length = min(length, self.lengths[file_index] - file_offset)
+            if span_length > 0:
+                yield file_index, file_offset, span_length
+                offset += span_length
+                length -= span_length
+            file_index += 1
+
+    def write_piece(self, index, data):
+        """
+        Writes a verified piece at its place in the torrent's files.
+
+        Args:
+            index (int): The piece index.
+            data (bytes): The piece's content.
+        """
+        view = memoryview(data)
+        position = 0
+        for file_index, file_offset, span_length in self.spans(
+            index * self.torrent.piece_length, len(data)
+        ):
+            with self.files.handle(file_index) as fd:
+                chunk = view[position : position + span_length]
+                while chunk:
+                    written = os.pwrite(fd, chunk, file_offset)
+                    chunk = chunk[written:]
+                    file_offset += written
+            position += span_length
+
+    async def write_piece_async(self, index, data):
+        """
+        Writes a verified piece on the storage thread pool.
+
+        If the awaiting task is cancelled, the write still runs to completion;
+        ``close`` waits for it.
+
+        Args:
+            index (int): The piece index.
+            data (bytes): The piece's content.
+        """
+        start = time.monotonic()
+        future = self.executor.submit(self.write_piece, index, data)
+        self._writes.add(future)
+        future.add_done_callback(self._writes.discard)
+        await asyncio.wrap_future(future)
+        default_metrics().disk_write.observe(time.monotonic() - start)
+
+    def read_piece(self, index):
+        """
+        Reads a piece back from disk.
+
+        Each file's part is read with ``os.preadv`` straight into its slice of
+        a single buffer.
+
+        Args:
+            index (int): The piece index.
+
+        Returns:
+            bytearray: The piece's content as it is on disk. Bytes past the end
+            of a short file read as zeros.
+        """
+        piece = bytearray(self.torrent.piece_size(index))
+        view = memoryview(piece)
+        position = 0
+        for file_index, file_offset, span_length in self.spans(
+            index * self.torrent.piece_length, len(piece)
+        ):
+            with self.files.handle(file_index) as fd:
+                os.preadv(fd, [view[position : position + span_length]], file_offset)
+            position += span_length
+        return piece
+
+    def _map(self, file_index):
+        with self._maps_lock:
+            mapped = self._maps.get(file_index)
+            if mapped is None:
+                with self.files.handle(file_index) as fd:
+                    mapped = mmap.mmap(fd, self.lengths[file_index], access=mmap.ACCESS_READ)
+                self._maps[file_index] = mapped
+            return mapped
+
+    def hash_piece(self, index):
+        """
+        Computes the SHA-1 of a piece as it is on disk, without copying it.
+
+        The files are memory-mapped on first use and hashed straight from the
+        page cache; call ``release_maps`` when done.
+
+        Args:
+            index (int): The piece index.
+
+        Returns:
+            bytes: The 20-byte digest.
+        """
+        sha1hash = hashlib.sha1()
+        for file_index, file_offset, span_length in self.spans(
+            index * self.torrent.piece_length, self.torrent.piece_size(index)
+        ):
+            with memoryview(self._map(file_index)) as view:
+                sha1hash.update(view[file_offset : file_offset + span_length])
+        return sha1hash.digest()
+
+    def release_maps(self):
+        with self._maps_lock:
+            for mapped in self._maps.values():
+                mapped.close()
+            self._maps.clear()
+
+    def close(self):
+        if self._own_executor:
+            self.executor.shutdown(wait=True)
+        else:
+            wait_futures(list(self._writes))
+        self.release_maps()
+        self.files.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+RESUME_SUFFIX = ".resume"
+
+# Seconds between resume-file checkpoints while downloading.
+RESUME_SAVE_INTERVAL = 10
+
+def _file_stamps(storage):
+    stamps = []
+    for file_path in storage.paths:
+        st = os.stat(file_path)
+        stamps.append([st.st_size, st.st_mtime_ns])
+    return stamps
+
+def save_resume(storage, completed):
+    """
+    Records which pieces are on disk in a small sidecar file next to the output.
+
+    The sidecar also stores the size and modification time of every file, so
+    a later run can tell whether the data changed behind its back.
+
+    Args:
+        storage (Storage): The torrent's storage; all writes must have finished.
+        completed (Bitfield): The verified pieces.
+    """
+    resume = {
+        "info hash": storage.torrent.info_hash,
+        "pieces": bytes(completed.bits),
+        "files": _file_stamps(storage),
+    }
+    sidecar = storage.path + RESUME_SUFFIX
+    with open(sidecar + ".tmp", "wb") as f:
+        bencode_to(resume, f)
+    os.replace(sidecar + ".tmp", sidecar)
+
+def load_resume(storage):
+    """
+    Loads the completion bitfield from the sidecar file, if it can be trusted.
+
+    Args:
+        storage (Storage): The torrent's storage.
+
+    Returns:
+        Bitfield: The verified pieces, or None if there is no usable sidecar
+        for these exact files.
+    """
+    try:
+        with open(storage.path + RESUME_SUFFIX, "rb") as f:
+            resume = decode_bencode_all(f.read())
+        if resume["info hash"] != storage.torrent.info_hash:
+            return None
+        if resume["files"] != _file_stamps(storage):
+            return None
+        return Bitfield(storage.torrent.piece_count, resume["pieces"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def recheck(storage, workers=None):
+    """
+    Hashes every piece already on disk and reports which ones are intact.
+
+    The files are memory-mapped and hashed in a thread pool; hashlib releases
+    the GIL on large buffers, so this runs on all cores at disk speed.
+
+    Args:
+        storage (Storage): The torrent's storage.
+        workers (int, optional): The number of hashing threads; defaults to
+            the number of CPUs.
+
+    Returns:
+        Bitfield: The pieces whose on-disk content matches their hash.
+    """
+    torrent = storage.torrent
+    completed = Bitfield(torrent.piece_count)
+
+    def check(index):
+        return storage.hash_piece(index) == torrent.piece_hashes[index]
+
+    try:
+        with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+            for index, intact in enumerate(pool.map(check, range(torrent.piece_count))):
+                if intact:
+                    completed.add(index)
+    finally:
+        storage.release_maps()
+    return completed
+
+def resume_state(storage):
+    """
+    Works out which pieces of an existing download can be kept.
+
+    A trusted sidecar file skips the recheck entirely; otherwise every piece
+    on disk is hashed.
+
+    Args:
+        storage (Storage): The torrent's storage.
+
+    Returns:
+        Bitfield: The pieces that do not need downloading again.
+    """
+    completed = load_resume(storage)
+    if completed is None:
+        completed = recheck(storage)
+    return completed
+
+# Threads hashing downloaded pieces. hashlib releases the GIL, so they run
+# alongside each other and the event loop.
+HASH_WORKERS = 4
+
+# Pieces that may be queued for or in verification at once, per hash thread.
+HASH_QUEUE_PER_WORKER = 4
+
+# Bytes of piece buffers a download may hold at once: pieces being received,
+# hashed or written.
+PIECE_MEMORY_LIMIT = 64 * 2**20
+
+class PiecePool:
+    """
+    A fixed number of reusable piece buffers, sized to fit a memory cap.
+
+    Every piece on its way from the network to the disk lives in one of the
+    pool's buffers, so the memory used for pieces never exceeds ``limit``
+    (or two pieces, if pieces are larger), however many peers are connected
+    or however large the torrent is. When every buffer is taken, ``acquire``
+    waits: peer connections stop starting new pieces until a write to disk
+    hands a buffer back.
+
+    Buffers are allocated on first use and then recycled, never freed.
+
+    Must be used from a running event loop.
+
+    Args:
+        piece_length (int): The torrent's piece length; every buffer has this size.
+        limit (int): The most bytes of buffers to allocate.
+
+    Attributes:
+        capacity (int): The number of buffers.
+        allocated (int): The buffers allocated so far.
+
+    Example:
+        >>> pool = PiecePool(torrent.piece_length)
+        >>> buffer = await pool.acquire()
+        >>> piece = await conn.request_piece(index, length, buffer=buffer)
+        >>> pool.release(piece)
+    """
+
+    __slots__ = ("piece_length", "capacity", "allocated", "_free", "_available")
+
+    def __init__(self, piece_length, limit=PIECE_MEMORY_LIMIT):
+        self.piece_length = piece_length
+        self.capacity = max(2, limit // piece_length)
+        self.allocated = 0
+        self._free = []
+        self._available = asyncio.Semaphore(self.capacity)
+
+    @property
+    def in_use(self):
+        return self.allocated - len(self._free)
+
+    async def acquire(self):
+        """
+        Takes a buffer, waiting for one to be released if all are in use.
+
+        Returns:
+            bytearray: A buffer of ``piece_length`` bytes, with arbitrary contents.
+        """
+        await self._available.acquire()
+        if self._free:
+            return self._free.pop()
+        self.allocated += 1
+        return bytearray(self.piece_length)
+
+    def release(self, buffer):
+        """
+        Gives a buffer back.
+
+        Args:
+            buffer (bytearray or memoryview): The buffer, or a view of it
+                such as the piece ``request_piece`` returned.
+        """
+        if isinstance(buffer, memoryview):
+            buffer = buffer.obj
+        self._free.append(buffer)
+        self._available.release()
+
+class PieceVerifier:
+    """
+    Checks downloaded pieces against the torrent's SHA-1 hashes on a thread pool.
+
+    Peer connections hand a finished piece to ``submit`` and go straight on
+    to their next piece, so receiving from the network and hashing overlap
+    instead of taking turns on the event loop. Results come back from
+    ``result`` in the order hashing finishes, not the order pieces were
+    submitted. Each hash mismatch counts against the peer that sent the
+    piece, in ``failures``.
+
+    At most ``workers * HASH_QUEUE_PER_WORKER`` pieces wait for or are in
+    verification at once; beyond that ``submit`` waits, which keeps fast
+    peers from piling up piece buffers faster than they can be hashed.
+
+    Must be created and used from a running event loop.
+
+    Args:
+        torrent (Torrent): The parsed torrent.
+        workers (int): The number of hashing threads.
+        executor (ThreadPoolExecutor, optional): A pool to hash on instead of
+            starting one; it is left running on ``close``.
+
+    Attributes:
+        failures (dict): Hash mismatches per peer.
+        pending (int): Pieces submitted whose result has not been collected.
+
+    Example:
+        >>> verifier = PieceVerifier(torrent)
+        >>> await verifier.submit(index, piece, peer)
+        >>> index, piece, peer, intact = await verifier.result()
+    """
+
+    def __init__(self, torrent, workers=HASH_WORKERS, executor=None):
+        self.piece_hashes = torrent.piece_hashes
+        self._own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(workers, thread_name_prefix="hash")
+        self.failures = {}
+        self.pending = 0
+        self._slots = asyncio.Semaphore(workers * HASH_QUEUE_PER_WORKER)
+        self._results = asyncio.Queue()
+        self._loop = asyncio.get_running_loop()
+
+    async def submit(self, index, piece, peer=None):
+        """
+        Queues a piece for verification.
+
+        Args:
+            index (int): The piece index.
+            piece (bytearray): The piece data; it must not be modified afterwards.
+            peer (tuple, optional): The peer that sent it, for blame.
+        """
+        await self._slots.acquire()
+        self.pending += 1
+        future = self._loop.run_in_executor(self.executor, self._check, index, piece)
+        future.add_done_callback(
+            lambda future: self._finished(index, piece, peer, future)
+        )
+
+    def _check(self, index, piece):
+        start = time.perf_counter()
+        intact = hashlib.sha1(piece).digest() == self.piece_hashes[index]
+        default_metrics().hash_check.observe(time.perf_counter() - start)
+        return intact
+
+    def _finished(self, index, piece, peer, future):
+        self._slots.release()
+        intact = not future.cancelled() and future.exception() is None and future.result()
+        if not intact and peer is not None:
+            self.failures[peer] = self.failures.get(peer, 0) + 1
+        self._results.put_nowait((index, piece, peer, intact))
+
+    async def result(self):
+        """
+        Waits for the next piece to finish verification.
+
+        Returns:
+            tuple: ``(index, piece, peer, intact)``.
+        """
+        result = await self._results.get()
+        self.pending -= 1
+        return result
+
+    def close(self):
+        if self._own_executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+async def _store_verified(verifier, scheduler, storage, stats, swarm=None, pool=None, on_complete=None):
+    # Writes intact pieces in the order they verify; corrupt ones go back to
+    # the scheduler to be fetched again, most likely from another peer.
+    # Either way the piece's buffer then goes back to the pool. on_complete
+    # is called with the index of each piece once it is on disk.
+    while True:
+        index, piece, peer, intact = await verifier.result()
+        if swarm is not None and peer in swarm:
+            swarm[peer].verified(intact)
+        if not intact:
+            scheduler.reject(index)
+            if pool is not None:
+                pool.release(piece)
+            continue
+        await storage.write_piece_async(index, piece)
+        if pool is not None:
+            pool.release(piece)
+        stats.downloaded += len(piece)
+        if scheduler.complete(index):
+            stats.left -= len(piece)
+            if on_complete is not None:
+                on_complete(index)
+
+async def _download_from_peer(
+    torrent,
+    peer,
+    scheduler,
+    verifier,
+    window,
+    swarm=None,
+    on_peers=None,
+    session=None,
+    pool=None,
+    slots=None,
+):
+    """
+    Downloads pieces from one peer until the scheduler has nothing left for it.
+
+    Our ``interested`` goes out with the handshake, and the peer's bitfield
+    and ``have`` messages are collected until it unchokes us. Only then
+    does the connection take one of ``slots``, if given: a peer that is
+    slow to answer never holds up a slot a faster one could use.
+
+    Finished pieces are handed to the verifier without waiting for their
+    hash; the connection stops once the verifier has blamed the peer for
+    ``MAX_HASH_FAILURES`` corrupt pieces.
+
+    The request window starts at ``window`` and then follows the peer's
+    measured rate and round trip, see ``PeerStats.window``.
+
+    If the peer supports the extension protocol, peers it gossips through
+    ut_pex are passed to ``on_peers``, and it is told about the rest of
+    ``swarm`` at most every ``PEX_INTERVAL`` seconds. Private torrents
+    take no part in peer exchange.
+
+    Args:
+        torrent (Torrent): The parsed torrent.
+        peer (tuple): The peer's ``(ip, port)``.
+        scheduler (PieceScheduler): The shared scheduler.
+        verifier (PieceVerifier): Where finished pieces are sent.
+        window (int): The number of block requests to start with.
+        swarm (dict, optional): The peers we are connected to, mapped to
+            their ``PeerStats``; this peer is in it while its connection is up.
+        on_peers (callable, optional): Called with peers learned from this one.
+        session (TorrentSession, optional): Whose download rate and request
+            budget this connection shares.
+        pool (PiecePool, optional): Where piece buffers come from. The
+            connection only picks a piece once it holds a buffer; the buffer
+            then travels with the piece to the verifier.
+        slots (DownloadSlots, optional): One of them is held while the
+            connection is in ``swarm``.
+    """
+    loop = asyncio.get_running_loop()
+    conn = None
+    bitfield = None
+    slotted = False
+    index = None
+    buffer = None
+    pex = None
+    throttle = None
+    if session is not None:
+        throttle = lambda length: session.download.take(length, torrent.info_hash)
 
-def request_block(s, piece_index, block_index, length):
+    def on_message(message):
+        nonlocal pex
+        if message[4] == 4:
+            (have_index,) = _unpack_payload(message, HAVE_PAYLOAD)
+            bitfield.add(have_index)
+            scheduler.add_have(have_index)
+        elif message[4] == 20 and len(message) > 5:
+            if message[5] == 0:
+                remote_id, _port = _read_extension_handshake(message[6:])
+                if remote_id is not None and not torrent.is_private:
+                    pex = PeerExchange(remote_id)
+                else:
+                    pex = None
+            elif message[5] == UT_PEX_ID and on_peers is not None and not torrent.is_private:
+                on_peers(parse_pex(message[6:]))
+
+    try:
+        conn = await PeerConnection.open(peer, torrent.info_hash, pipelined=construct_message(2, b""))
+        if conn.supports_extensions:
+            await conn.send_message(20, extension_handshake(pex=not torrent.is_private))
+        bitfield = await _start_download(conn, torrent.piece_count, on_message, interested=False)
+        scheduler.add_bitfield(bitfield)
+        if slots is not None:
+            # Dialled ahead: wait, unchoked and ready, for a slot to free up.
+            await slots.acquire(peer)
+            slotted = True
+            # Judged from when it started downloading, not from when it was dialled.
+            conn.stats = PeerStats(loop.time())
+        if swarm is not None:
+            swarm[peer] = conn.stats
+        while not scheduler.done:
+            if verifier.failures.get(peer, 0) >= MAX_HASH_FAILURES:
+                return
+            if pex is not None and swarm is not None and loop.time() >= pex.next_send:
+                pex.next_send = loop.time() + PEX_INTERVAL
+                payload = pex.message(swarm.keys() - {peer})
+                if payload is not None:
+                    await conn.send_message(20, payload)
+            if pool is not None and buffer is None:
+                buffer = await pool.acquire()
+            index = scheduler.pick(bitfield)
+            if index is None:
+                if not scheduler.in_progress:
+                    # Nothing outstanding elsewhere could free up a piece for us.
+                    return
+                if buffer is not None:
+                    # Idle connections must not sit on buffers others could use.
+                    pool.release(buffer)
+                    buffer = None
+                await scheduler.wait_for_change(1.0)
+                continue
+            piece_window = conn.stats.window(window)
+            if session is not None:
+                piece_window = session.request_window(piece_window)
+            piece = await conn.request_piece(
+                index,
+                torrent.piece_size(index),
+                piece_window,
+                on_message,
+                lambda index=index: scheduler.is_complete(index),
+                throttle,
+                buffer,
+            )
+            if piece is None or scheduler.is_complete(index):
+                scheduler.abort(index)
+            else:
+                # The piece stays in progress until the verifier rules on it.
+                scheduler.downloaded(index)
+                await verifier.submit(index, piece, peer)
+                # The buffer is the verifier's now.
+                buffer = None
+            index = None
+    except (OSError, EOFError, ValueError):
+        pass
+    finally:
+        if swarm is not None:
+            swarm.pop(peer, None)
+        if slotted:
+            slots.release()
+        if index is not None:
+            # Also covers being cancelled while waiting to submit the piece.
+            scheduler.reject(index)
+        if buffer is not None:
+            pool.release(buffer)
+        if bitfield is not None:
+            scheduler.remove_bitfield(bitfield)
+        if conn is not None:
+            conn.close()
+
+async def download_async(
+    outputfile, torrent, window=PIPELINE_DEPTH, max_peers=MAX_PEERS, memory_limit=PIECE_MEMORY_LIMIT
+):
     """
-    Requests a block from a BitTorrent peer.
+    Download a torrent file; the coroutine behind ``download``.
 
     Args:
-        s (socket): The socket object.
-        piece_index (int): The index of the piece.
-        block_index (int): The index of the block.
-        length (int): The length of the block.
+        outputfile (str): The file to write the torrent to.
+        torrent (Torrent): The parsed torrent.
+        window (int): The number of block requests to keep in flight per piece.
+        max_peers (int): The maximum number of simultaneous peer connections.
+        memory_limit (int): The most bytes of piece buffers to hold at once.
 
-    Returns:
-        bytes: The received block.
+    Raises:
+        ConnectionError: If every peer went away before the download finished.
+    """
+    resuming = os.path.exists(outputfile)
+    storage = await asyncio.to_thread(Storage, torrent, outputfile)
+    scheduler = None
+    try:
+        # Only pieces that are missing or corrupt on disk get scheduled.
+        completed = await asyncio.to_thread(resume_state, storage) if resuming else None
+        scheduler = PieceScheduler(torrent.piece_count, completed)
+        if not scheduler.done:
+            await _download_pieces(
+                torrent, scheduler, storage, window, max_peers, memory_limit=memory_limit
+            )
+    finally:
+        await asyncio.to_thread(storage.close)
+        if scheduler is not None and scheduler.done:
+            if os.path.exists(outputfile + RESUME_SUFFIX):
+                os.remove(outputfile + RESUME_SUFFIX)
+        elif scheduler is not None:
+            save_resume(storage, scheduler.completed)
+    if not scheduler.done:
+        raise ConnectionError("Ran out of peers before the download completed.")
 
-    Example:
-        >>> block = request_block(s, 0, 0, 2**14)
-        >>> print(block)
+# Seconds to wait before retrying a failed re-announce.
+ANNOUNCE_RETRY_INTERVAL = 60
+
+# Seconds between reviews of the connected peers.
+PEER_REVIEW_INTERVAL = 15
+
+# A connection is only judged once it has been up this long.
+PEER_GRACE_PERIOD = 20
+
+def _missing_bytes(torrent, completed):
+    # The "left" a tracker is told: the size of every piece not verified yet.
+    return sum(
+        torrent.piece_size(index) for index in range(torrent.piece_count) if index not in completed
+    )
+
+def _slowest_peer(swarm, now):
+    # The connection to replace: the lowest rate among those past their grace
+    # period, discounted by the share of its pieces that failed the hash check.
+    judged = []
+    for peer, stats in swarm.items():
+        if now - stats.started >= PEER_GRACE_PERIOD:
+            stats.update(now)
+            judged.append((stats.rate * (1 - stats.hash_failures), peer))
+    return min(judged)[1] if judged else None
+
+async def _download_pieces(
+    torrent,
+    scheduler,
+    storage,
+    window,
+    max_peers,
+    tracker=None,
+    session=None,
+    memory_limit=PIECE_MEMORY_LIMIT,
+    stats=None,
+    resume=True,
+):
     """
-    index = piece_index
-    begin = block_index * 2**14
-    length = length
-    payload = (
-        struct.pack(">I", index) + struct.pack(">I", begin) + struct.pack(">I", length)
+    Runs the peer connections until the scheduler is done or every peer is gone.
+
+    Pieces are hashed by a ``PieceVerifier`` and written as they pass, by a
+    separate task, so no connection waits on SHA-1 or the disk.
+
+    The tracker is re-announced whenever its interval runs out, with the
+    current transfer counters. Peers it returns, including those from
+    trackers that answer after the first one, and peers gossiped by
+    connected peers through ut_pex, queue up for connection slots; a slot
+    freed by a dropped peer is refilled from that queue without asking the
+    tracker again. The final announce reports ``completed`` or ``stopped``.
+
+    Up to ``DIAL_SURPLUS`` peers beyond ``max_peers`` are dialled at once,
+    with connect and handshake deadlines, but only ``max_peers`` of them
+    download at a time: the first to be unchoked. Peers that are dead or
+    slow to answer do not delay the download, and a slot freed by a dropped
+    peer goes straight to a connection that is already waiting.
+
+    Every ``PEER_REVIEW_INTERVAL`` seconds, while every slot is taken and
+    untried peers or unchoked connections are waiting, the slowest
+    connection is dropped so one of them can take its place: a rotation
+    that keeps the fastest peers found so far. The dropped peer goes back
+    to the end of the queue, and rotation stops once every waiting peer has
+    been dropped before.
+
+    The number of pieces in progress is the ``pieces_in_flight`` gauge of
+    ``default_metrics``.
+
+    Pieces are received into buffers from a ``PiecePool`` capped at
+    ``memory_limit`` bytes, which go back to the pool once written. When
+    all are taken, connections wait before starting new pieces, so memory
+    does not grow with the number of peers or the size of the torrent.
+
+    Args:
+        torrent (Torrent): The parsed torrent.
+        scheduler (PieceScheduler): The scheduler, seeded with the pieces already on disk.
+        storage (Storage): Where verified pieces are written; anything with
+            a ``write_piece_async`` will do.
+        window (int): The initial number of block requests to keep in flight per piece.
+        max_peers (int): The maximum number of peers downloading at once.
+        tracker (TrackerClient, optional): Defaults to the shared client.
+        session (TorrentSession, optional): Whose connection and request
+            budgets, download rate and hashing threads this torrent shares.
+            Connected peers of its ``SeedServer`` are sent ``have`` for each
+            piece completed.
+        memory_limit (int): The most bytes of piece buffers to hold at once.
+        stats (TransferStats, optional): The counters to update and report,
+            kept across calls; by default fresh ones for the missing pieces.
+        resume (bool): Whether to checkpoint the completed pieces next to
+            ``storage`` every ``RESUME_SAVE_INTERVAL`` seconds; False when
+            ``storage`` is a ``StreamWriter``, which keeps nothing.
+    """
+    loop = asyncio.get_running_loop()
+    tracker = tracker or default_tracker()
+    pool = PiecePool(torrent.piece_length, memory_limit)
+    slots = DownloadSlots(max_peers)
+    if stats is None:
+        stats = TransferStats(_missing_bytes(torrent, scheduler.completed))
+    workers = {}
+    # Peers heard of but not tried yet, oldest first.
+    candidates = OrderedDict()
+    # Peers dropped by the review.
+    rotated = set()
+    swarm = {}
+    accepting = True
+
+    def fill():
+        active = sum(not worker.done() for worker in workers.values())
+        free = max_peers + DIAL_SURPLUS - active
+        if session is not None:
+            free = min(free, session.connection_slots(active))
+        while free > 0 and candidates and accepting:
+            peer, _ = candidates.popitem(last=False)
+            workers[peer] = asyncio.create_task(
+                _download_from_peer(
+                    torrent, peer, scheduler, verifier, window, swarm, connect, session, pool, slots
+                )
+            )
+            if session is not None:
+                session.connections += 1
+                workers[peer].add_done_callback(session.disconnected)
+            free -= 1
+
+    def connect(peers):
+        if not accepting:
+            return
+        for peer in peers:
+            if peer not in workers:
+                candidates[peer] = None
+        fill()
+
+    def requeue(peer):
+        # A rotated-out peer gets another turn once the untried ones have had theirs.
+        if accepting:
+            candidates[peer] = None
+
+    def on_peers(peers):
+        # Slower trackers of an announce-list answer from a tracker thread.
+        try:
+            loop.call_soon_threadsafe(connect, peers)
+        except RuntimeError:
+            pass  # The download has already finished.
+
+    peers = await asyncio.to_thread(tracker.get_peers, torrent, stats, on_peers)
+    verifier = PieceVerifier(torrent, executor=session and session.hash_executor)
+    on_complete = None
+    if session is not None:
+        on_complete = lambda index: session.server.have(torrent, index)
+    storing = asyncio.create_task(
+        _store_verified(verifier, scheduler, storage, stats, swarm, pool, on_complete)
     )
-    message = construct_message(6, payload)
-    s.send(message)
-    piece_message = receive_message(s)
-    while piece_message[4] != 7:
-        piece_message = receive_message(s)
-    # Verify that the block has the payload we expect:
-    verify_message(piece_message, 7)
-    received_index = int.from_bytes(piece_message[5:9])
-    received_begin = int.from_bytes(piece_message[9:13])
-    if received_index != index or received_begin != begin:
-        raise ValueError("Piece message does not have expected payload.")
-    block = piece_message[13:]
-    return block
+    connect(peers)
+    announcing = None
+    # Pieces stay in progress from being picked until they are written or rejected.
+    in_flight = lambda: len(scheduler.in_progress)
+    default_metrics().watch("pieces_in_flight", in_flight)
+    try:
+        next_checkpoint = loop.time() + RESUME_SAVE_INTERVAL
+        next_announce = loop.time() + tracker.seconds_until_announce(torrent)
+        next_review = loop.time() + PEER_REVIEW_INTERVAL
+        while not scheduler.done and (
+            verifier.pending
+            or candidates
+            or not all(worker.done() for worker in workers.values())
+        ):
+            await scheduler.wait_for_change(1.0)
+            fill()
+            if storing.done():
+                # Only a failed write ends the storing task.
+                storing.result()
+            if resume and loop.time() >= next_checkpoint:
+                await asyncio.to_thread(save_resume, storage, scheduler.completed)
+                next_checkpoint = loop.time() + RESUME_SAVE_INTERVAL
+            if loop.time() >= next_review:
+                next_review = loop.time() + PEER_REVIEW_INTERVAL
+                # Only with every slot taken: a free slot needs no rotation,
+                # and candidates may just be waiting behind peers still
+                # dialling. Peers rotated out before do not count as
+                # replacements, or rotation would never settle.
+                full = slots.waiting or len(swarm) >= max_peers
+                untried = any(
+                    peer not in rotated for peer in chain(slots.waiting, candidates)
+                )
+                slowest = _slowest_peer(swarm, loop.time()) if full and untried else None
+                if slowest is not None:
+                    rotated.add(slowest)
+                    workers[slowest].cancel()
+                    workers[slowest].add_done_callback(lambda _, peer=slowest: requeue(peer))
+            if announcing is None and loop.time() >= next_announce:
+                announcing = asyncio.create_task(
+                    _await_in_daemon_thread(tracker.announce, torrent, stats, None, on_peers)
+                )
+            elif announcing is not None and announcing.done():
+                try:
+                    connect(announcing.result())
+                    next_announce = loop.time() + tracker.seconds_until_announce(torrent)
+                except (OSError, ValueError):
+                    next_announce = loop.time() + ANNOUNCE_RETRY_INTERVAL
+                announcing = None
+    finally:
+        accepting = False
+        for worker in workers.values():
+            worker.cancel()
+        if announcing is not None:
+            announcing.cancel()
+        storing.cancel()
+        await asyncio.gather(*workers.values(), storing, return_exceptions=True)
+        verifier.close()
+        default_metrics().unwatch("pieces_in_flight", in_flight)
+        event = "completed" if scheduler.done else "stopped"
+        try:
+            await _await_in_daemon_thread(
+                tracker.announce, torrent, stats, event, timeout=FINAL_ANNOUNCE_TIMEOUT
+            )
+        except (OSError, ValueError):
+            pass
+        if event == "stopped":
+            tracker.forget(torrent)
 
-def receive_message(s):
+def download(
+    outputfile, torrent, window=PIPELINE_DEPTH, max_peers=MAX_PEERS, memory_limit=PIECE_MEMORY_LIMIT
+):
     """
-    Receive a message from a socket.
+    Download a torrent file.
 
-    This function receives a message from a socket, handling cases where the message is not fully received.
+    This function announces once, dials many peers in parallel from a single
+    event loop and downloads pieces from up to ``max_peers`` of them, rarest
+    first, writing each verified piece straight into the output file.
+
+    If the output already exists, the download resumes: pieces recorded in
+    the sidecar resume file, or found intact by a recheck, are kept, and only
+    missing or corrupt pieces are fetched.
+
+    Memory for pieces in flight is bounded by ``memory_limit``, whatever the
+    torrent's size or the number of peers.
 
     Args:
-        s (socket): The socket to receive the message from.
+        outputfile (str): The file to write the torrent to.
+        torrent (Torrent): The parsed torrent.
+        window (int): The number of block requests to keep in flight per piece.
+        max_peers (int): The maximum number of simultaneous peer connections.
+        memory_limit (int): The most bytes of piece buffers to hold at once.
 
     Returns:
-        bytes: The received message.
+        None
+
+    Raises:
+        ConnectionError: If every peer went away before the download finished.
 
     Example:
-        >>> import socket
-        >>> s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        >>> s.connect(("example.com", 80))
-        >>> message = receive_message(s)
-        >>> print(message)
+        >>> download("example.txt", Torrent.from_file("example.torrent"))
     """
-    length = s.recv(4)
-    while not length or not int.from_bytes(length):
-        length = s.recv(4)
-    message = s.recv(int.from_bytes(length))
-    # If we didn't receive the full message for some reason, keep gobbling.
-    while len(message) < int.from_bytes(length):
-        message += s.recv(int.from_bytes(length) - len(message))
-    return length + message
+    asyncio.run(download_async(outputfile, torrent, window, max_peers, memory_limit))
 
-def download_piece(outputfile, filename, piececount):
+class StreamWriter:
     """
-    Download a single piece of a torrent file.
+    Writes verified pieces to a file-like object in torrent order.
 
-    This function downloads a single piece of a torrent file from a peer, verifies its hash, and writes it to disk.
+    Stands in for ``Storage`` when the content only passes through. The
+    piece the reader needs next is written straight from its verified
+    buffer; a piece that verifies early is copied aside until its turn. With
+    a ``StreamingScheduler`` that fetches nothing beyond its window, at most
+    a window of pieces is ever held back.
 
     Args:
-        outputfile (str): The file to write the piece to.
-        filename (str): The name of the torrent file.
-        piececount (int): The index of the piece to download.
+        f (file): A binary file-like object.
+        scheduler (StreamingScheduler): Moved on as pieces are written.
 
-    Returns:
-        tuple: A tuple containing the piece index and the file path.
+    Example:
+        >>> writer = StreamWriter(sys.stdout.buffer, scheduler)
+        >>> await writer.write_piece_async(0, piece)
+    """
+
+    __slots__ = ("f", "scheduler", "next", "early")
+
+    def __init__(self, f, scheduler):
+        self.f = f
+        self.scheduler = scheduler
+        self.next = 0
+        self.early = {}
+
+    async def write_piece_async(self, index, data):
+        """
+        Writes a verified piece, or keeps a copy until the pieces before it are written.
+
+        A slow reader holds this up, and with it the verified pieces behind
+        it, until the piece pool runs dry and the connections wait: the
+        download never runs further ahead than memory allows.
+
+        Args:
+            index (int): The piece index.
+            data (bytes): The piece's content; not used after this returns.
+        """
+        if index != self.next:
+            if index > self.next:
+                self.early[index] = bytes(data)
+            return
+        await asyncio.to_thread(self.f.write, data)
+        self.next += 1
+        while self.next in self.early:
+            await asyncio.to_thread(self.f.write, self.early.pop(self.next))
+            self.next += 1
+        self.scheduler.advance(self.next)
+
+async def stream_async(path, torrent, window=STREAM_WINDOW, max_peers=MAX_PEERS):
+    """
+    Downloads a torrent, yielding its content in order as soon as it verifies.
+
+    Pieces are scheduled by a ``StreamingScheduler`` whose window follows
+    the consumer: it moves on as each piece is yielded. The data is also
+    kept at ``path``, and an existing download there is resumed, as with
+    ``download``.
+
+    Args:
+        path (str): Where the torrent's data is stored.
+        torrent (Torrent): The parsed torrent.
+        window (int): The number of pieces ahead of the consumer to fetch in order.
+        max_peers (int): The maximum number of simultaneous peer connections.
+
+    Yields:
+        bytearray: Each piece's content, in torrent order.
+
+    Raises:
+        ConnectionError: If every peer went away before the download finished.
 
     Example:
-        >>> download_piece("/tmp/test-0", "example.torrent", 0)
-        (0, "/tmp/test-0")
+        >>> async for piece in stream_async("movie.mkv", torrent):
+        ...     player.feed(piece)
+    """
+    resuming = os.path.exists(path)
+    storage = await asyncio.to_thread(Storage, torrent, path)
+    scheduler = None
+    downloading = None
+    try:
+        completed = await asyncio.to_thread(resume_state, storage) if resuming else None
+        scheduler = StreamingScheduler(torrent.piece_count, completed, window)
+        if not scheduler.done:
+            downloading = asyncio.create_task(
+                _download_pieces(torrent, scheduler, storage, PIPELINE_DEPTH, max_peers)
+            )
+        for index in range(torrent.piece_count):
+            while index not in scheduler.completed:
+                if downloading.done():
+                    downloading.result()
+                    raise ConnectionError("Ran out of peers before the download completed.")
+                await scheduler.wait_for_change(1.0)
+            # Verified pieces are written before they count as completed.
+            piece = await asyncio.to_thread(storage.read_piece, index)
+            scheduler.advance(index + 1)
+            yield piece
+    finally:
+        if downloading is not None:
+            downloading.cancel()
+            await asyncio.gather(downloading, return_exceptions=True)
+        await asyncio.to_thread(storage.close)
+        if scheduler is not None and scheduler.done:
+            if os.path.exists(path + RESUME_SUFFIX):
+                os.remove(path + RESUME_SUFFIX)
+        elif scheduler is not None:
+            save_resume(storage, scheduler.completed)
+
+def download_stream(f, torrent, window=STREAM_WINDOW, max_peers=MAX_PEERS):
+    """
+    Download a torrent into a file-like object, such as stdout, in order.
+
+    Bytes are written as soon as they and everything before them are
+    verified, so a consumer on the other end of a pipe can start long before
+    the download completes. Nothing touches the disk: a ``StreamWriter``
+    writes each piece from its verified buffer, and only the pieces of the
+    window that verify early are held back.
+
+    Args:
+        f (file): A binary file-like object.
+        torrent (Torrent): The parsed torrent.
+        window (int): The number of pieces ahead of the reader to fetch in order.
+        max_peers (int): The maximum number of simultaneous peer connections.
+
+    Raises:
+        ConnectionError: If every peer went away before the download finished.
+
+    Example:
+        >>> download_stream(sys.stdout.buffer, Torrent.from_file("movie.torrent"))
+    """
+
+    async def run():
+        scheduler = StreamingScheduler(torrent.piece_count, window=window, beyond_window=False)
+        writer = StreamWriter(f, scheduler)
+        await _download_pieces(torrent, scheduler, writer, PIPELINE_DEPTH, max_peers, resume=False)
+        if not scheduler.done:
+            raise ConnectionError("Ran out of peers before the download completed.")
+        await asyncio.to_thread(f.flush)
+
+    asyncio.run(run())
+
+# Peers we upload to at once; one of the slots is the optimistic unchoke.
+MAX_UPLOADS = 4
+
+# Seconds between choking decisions, as in BEP 3 clients.
+RECHOKE_INTERVAL = 10
+
+# Choking rounds between moves of the optimistic unchoke.
+OPTIMISTIC_ROUNDS = 3
+
+# Largest block we serve; 16 KiB is standard, 128 KiB the common cap.
+MAX_REQUEST_LENGTH = 2**17
+
+# Requests a peer may have waiting with us; further ones are dropped.
+MAX_QUEUED_REQUESTS = 256
+
+class Upload:
+    """
+    The server's view of one connected peer.
+
+    Attributes:
+        conn (PeerConnection): The connection.
+        seeded (dict): The torrent being served, as registered with ``SeedServer.add``.
+        interested (bool): Whether the peer wants data from us.
+        choked (bool): Whether we refuse its requests.
+        recent (int): Bytes sent to it since the last choking round.
+        requests (deque): ``(index, begin, length)`` requests waiting to be served.
+        pex (PeerExchange): Set if the peer supports ut_pex.
+        listen (tuple): Where the peer accepts connections, if it said so
+            in its extension handshake.
+        greeted (bool): Whether our bitfield has gone out; pieces completed
+            after that are announced with ``have``.
+        task (asyncio.Task): The task serving the peer.
     """
-    decoded_value = decode_torrentfile(filename)
-    peers = split_peers(get_peers(filename))
-    # For the sake of simplicity, at this stage, just use the first peer:
-    peer = peers[1]
-    s, received_message = init_handshake(filename, peer)
-    # Wait for bitfield message:
-    # It's only sent once, so no need to do a while here.
-    bitfield = receive_message(s)
-    verify_message(bitfield, 5)
-    # Build and send interested message
-    interested = construct_message(2, b"")
-    s.send(interested)
-    # Wait for unchoke message
-    unchoke = receive_message(s)
-    while unchoke[4] != 1:
-        unchoke = receive_message(s)
-    verify_message(unchoke, 1)
-    # Calculate number of blocks, figuring out if we are the last piece
-    last_piece_remainder = (
-        decoded_value["info"]["length"] % decoded_value["info"]["piece length"]
+
+    __slots__ = (
+        "conn", "seeded", "interested", "choked", "recent", "requests", "wake", "pex", "listen",
+        "greeted", "task",
     )
-    total_pieces = len(piece_hashes(decoded_value["info"]["pieces"]))
-    if piececount + 1 == total_pieces and last_piece_remainder > 0:
-        length = last_piece_remainder
-    else:
-        length = decoded_value["info"]["piece length"]
-    block_size = 16 * 1024
-    full_blocks = length // block_size
-    final_block = length % block_size
-    # Send request for a block. This is painfully duplicated at the moment
-    # to handle corner case where only have a small block.
-    piece = b""
-    sha1hash = hashlib.sha1()
-    if full_blocks == 0:
-        block = request_block(s, piececount, 0, final_block)
-        piece += block
-        sha1hash.update(block)
-    else:
-        for i in range(full_blocks):
-            block = request_block(s, piececount, i, block_size)
-            piece += block
-            sha1hash.update(block)
-        if final_block > 0:
-            block = request_block(s, piececount, i + 1, final_block)
-            piece += block
-            sha1hash.update(block)
-    # Verify piece hash
-    piece_hash = piece_hashes(decoded_value["info"]["pieces"])[piececount]
-    local_hash = sha1hash.digest()
-    if piece_hash != local_hash:
-        raise ValueError("Piece hash mismatch.")
-    # Write piece to disk
-    with open(outputfile, "wb") as piece_file:
-        piece_file.write(piece)
-    # Clean up
-    s.close()
-    # Return piece completed and location
-    return piececount, outputfile
 
-def download(outputfile, filename):
+    def __init__(self, conn, seeded):
+        self.conn = conn
+        self.seeded = seeded
+        self.interested = False
+        self.choked = True
+        self.recent = 0
+        self.requests = deque()
+        self.wake = asyncio.Event()
+        self.pex = None
+        self.listen = None
+        self.greeted = False
+        self.task = asyncio.current_task()
+
+class Choker:
     """
-    Download a torrent file.
+    Decides which interested peers may download from us.
+
+    Each round, the ``max_uploads - 1`` interested peers we sent the most
+    data to since the last round keep their slots: as a seed, that favours
+    the peers that can take data fastest. The last slot is an optimistic
+    unchoke, moved to a random other interested peer every
+    ``OPTIMISTIC_ROUNDS`` rounds, so newcomers get a chance to show their
+    speed.
+
+    Example:
+        >>> choker = Choker(4)
+        >>> unchoked = choker.choose(uploads)
+    """
+
+    __slots__ = ("max_uploads", "optimistic", "_round")
+
+    def __init__(self, max_uploads=MAX_UPLOADS):
+        self.max_uploads = max_uploads
+        self.optimistic = None
+        self._round = 0
+
+    def choose(self, uploads):
+        """
+        Runs one choking round.
+
+        Args:
+            uploads (iterable): Every connected ``Upload``.
+
+        Returns:
+            set: The uploads to unchoke; every other one should be choked.
+        """
+        interested = sorted(
+            (upload for upload in uploads if upload.interested),
+            key=lambda upload: upload.recent,
+            reverse=True,
+        )
+        regular = interested[: max(self.max_uploads - 1, 0)]
+        others = interested[len(regular):]
+        if self._round % OPTIMISTIC_ROUNDS == 0 or self.optimistic not in others:
+            self.optimistic = random.choice(others) if others else None
+        self._round += 1
+        unchoked = set(regular)
+        if self.optimistic is not None:
+            unchoked.add(self.optimistic)
+        return unchoked
+
+class SeedServer:
+    """
+    Accepts incoming peer connections and serves verified pieces from disk.
+
+    Peers handshake for any torrent registered with ``add``, get a bitfield
+    of its verified pieces and are unchoked by a ``Choker``: a peer that
+    becomes interested while a slot is free is unchoked at once, and every
+    ``RECHOKE_INTERVAL`` seconds the slots are reassigned. Blocks are sent
+    with ``PeerConnection.send_block``, straight from the page cache.
 
-    This function downloads a torrent file by downloading each piece and writing it to disk.
+    Peers that support ut_pex are told every ``PEX_INTERVAL`` seconds where
+    the torrent's other connected peers accept connections, unless the
+    torrent is private. Pieces completed while peers are connected, by a
+    download in the same session, are announced to them with ``have``.
+
+    Must be started from a running event loop.
 
     Args:
-        outputfile (str): The file to write the torrent to.
-        filename (str): The name of the torrent file.
+        port (int): The TCP port to listen on; 0 picks a free one.
+        max_uploads (int): The number of peers unchoked at once.
+        max_peers (int): The most incoming connections kept at once.
+        peer_id (bytes): Our 20-byte peer id.
+        session (TorrentSession, optional): Whose connection budget and
+            upload rate the server shares.
 
-    Returns:
-        None
+    Example:
+        >>> server = SeedServer()
+        >>> server.add(torrent, storage, completed)
+        >>> await server.start()
+        >>> await server.serve_forever()
+    """
+
+    def __init__(
+        self, port=LISTEN_PORT, max_uploads=MAX_UPLOADS, max_peers=MAX_PEERS, peer_id=PEER_ID, session=None
+    ):
+        self.port = port
+        self.max_peers = max_peers
+        self.peer_id = peer_id
+        self.session = session
+        self.choker = Choker(max_uploads)
+        self.torrents = {}
+        self.uploads = set()
+        self._listener = None
+        self._tasks = set()
+        self._main = []
+
+    def add(self, torrent, storage, completed, stats=None):
+        """
+        Starts serving a torrent.
+
+        Args:
+            torrent (Torrent): The parsed torrent.
+            storage (Storage): Where its data is.
+            completed (Bitfield): Its verified pieces; only these are served.
+            stats (TransferStats, optional): Its counters; ``uploaded`` grows
+                as blocks are sent.
+        """
+        self.torrents[torrent.info_hash] = {
+            "torrent": torrent,
+            "storage": storage,
+            "completed": completed,
+            "stats": stats if stats is not None else TransferStats(0),
+        }
+
+    def have(self, torrent, index):
+        """
+        Tells the torrent's connected peers that we now have a piece.
+
+        Args:
+            torrent (Torrent): A torrent registered with ``add``.
+            index (int): The piece just completed.
+        """
+        seeded = self.torrents.get(torrent.info_hash)
+        payload = HAVE_PAYLOAD.pack(index)
+        for upload in self.uploads:
+            if upload.seeded is seeded and upload.greeted:
+                self._spawn(self._send_have(upload, payload))
+
+    async def _send_have(self, upload, payload):
+        try:
+            await upload.conn.send_message(4, payload)
+        except OSError:
+            pass  # The peer's own task notices the broken connection.
+
+    async def remove(self, torrent):
+        """
+        Stops serving a torrent and disconnects its peers.
+
+        Args:
+            torrent (Torrent): A torrent registered with ``add``.
+        """
+        seeded = self.torrents.pop(torrent.info_hash, None)
+        tasks = [upload.task for upload in self.uploads if upload.seeded is seeded]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def start(self, host=""):
+        """
+        Binds the listening socket and starts accepting peers.
+
+        Args:
+            host (str): The address to listen on; all interfaces by default.
+
+        Returns:
+            int: The port actually bound.
+        """
+        self._listener = socket.create_server((host, self.port), backlog=128)
+        self._listener.setblocking(False)
+        self.port = self._listener.getsockname()[1]
+        self._main = [
+            self._spawn(self._accept()),
+            self._spawn(self._rechoke()),
+            self._spawn(self._exchange_peers()),
+        ]
+        return self.port
+
+    async def serve_forever(self):
+        """Runs until the server is closed or its accept loop fails."""
+        await asyncio.gather(*self._main)
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _accept(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            sock, address = await loop.sock_accept(self._listener)
+            session = self.session
+            if len(self.uploads) >= self.max_peers or (
+                session is not None and session.connections >= session.max_connections
+            ):
+                sock.close()
+                continue
+            self._spawn(self._serve_peer(sock, address[:2]))
+
+    async def _rechoke(self):
+        while True:
+            await asyncio.sleep(RECHOKE_INTERVAL)
+            unchoked = self.choker.choose(self.uploads)
+            changes = []
+            for upload in self.uploads:
+                upload.recent = 0
+                if upload in unchoked:
+                    changes.append(self._unchoke(upload))
+                else:
+                    changes.append(self._choke(upload))
+            # A slow peer's send must not hold up everyone else's decision.
+            await asyncio.gather(*changes, return_exceptions=True)
+
+    async def _exchange_peers(self):
+        while True:
+            await asyncio.sleep(PEX_INTERVAL)
+            sends = []
+            for upload in self.uploads:
+                if upload.pex is None:
+                    continue
+                peers = {
+                    other.listen
+                    for other in self.uploads
+                    if other.listen is not None
+                    and other.seeded is upload.seeded
+                    and other is not upload
+                }
+                payload = upload.pex.message(peers)
+                if payload is not None:
+                    sends.append(upload.conn.send_message(20, payload))
+            await asyncio.gather(*sends, return_exceptions=True)
+
+    async def _choke(self, upload):
+        if not upload.choked:
+            upload.choked = True
+            # Choking discards the requests the peer has queued (BEP 3).
+            upload.requests.clear()
+            await upload.conn.send_message(0)
+
+    async def _unchoke(self, upload):
+        if upload.choked:
+            upload.choked = False
+            await upload.conn.send_message(1)
+
+    async def _fill_slots(self):
+        # Between rounds, hand free slots to interested peers right away.
+        free = self.choker.max_uploads - sum(not upload.choked for upload in self.uploads)
+        for upload in list(self.uploads):
+            if free <= 0:
+                break
+            if upload.interested and upload.choked:
+                await self._unchoke(upload)
+                free -= 1
+
+    async def _serve_peer(self, sock, peer):
+        try:
+            conn = await PeerConnection.accept(sock, peer, self.torrents, self.peer_id)
+        except (OSError, ValueError):
+            return
+        seeded = self.torrents[conn.handshake_message[28:48]]
+        upload = Upload(conn, seeded)
+        self.uploads.add(upload)
+        if self.session is not None:
+            self.session.connections += 1
+        sender = asyncio.create_task(self._send_blocks(upload))
+        # A failed send ends the connection, which wakes the reader below.
+        reader = asyncio.current_task()
+        sender.add_done_callback(lambda task: task.cancelled() or reader.cancel())
+        try:
+            if conn.supports_extensions:
+                await conn.send_message(
+                    20, extension_handshake(self.port, not seeded["torrent"].is_private)
+                )
+            completed = seeded["completed"]
+            # From here on completed pieces are sent as have, queued behind
+            # the bitfield on the connection's send lock.
+            upload.greeted = True
+            if completed.count():
+                await conn.send_message(5, bytes(completed.bits))
+            while True:
+                message = await conn.read_message()
+                message_id = message[4]
+                if message_id == 2:
+                    upload.interested = True
+                    await self._fill_slots()
+                elif message_id == 3:
+                    upload.interested = False
+                    if not upload.choked:
+                        await self._choke(upload)
+                        await self._fill_slots()
+                elif message_id == 6:
+                    request = _unpack_payload(message, REQUEST_PAYLOAD)
+                    self._check_request(seeded, request)
+                    # Requests from a choked peer are dropped, as BEP 3 says.
+                    if not upload.choked and len(upload.requests) < MAX_QUEUED_REQUESTS:
+                        upload.requests.append(request)
+                        upload.wake.set()
+                elif message_id == 8:
+                    request = _unpack_payload(message, REQUEST_PAYLOAD)
+                    try:
+                        upload.requests.remove(request)
+                    except ValueError:
+                        pass
+                elif message_id == 20 and len(message) > 5 and message[5] == 0:
+                    remote_id, port = _read_extension_handshake(message[6:])
+                    if remote_id is not None and not seeded["torrent"].is_private:
+                        upload.pex = PeerExchange(remote_id)
+                    else:
+                        upload.pex = None
+                    if port is not None:
+                        upload.listen = (conn.peer[0], port)
+        except (OSError, EOFError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            # The sender cancels us when a send fails; any other cancellation
+            # (the server closing) must propagate.
+            if not sender.done() or sender.cancelled():
+                raise
+            asyncio.current_task().uncancel()
+        finally:
+            self.uploads.discard(upload)
+            if self.session is not None:
+                self.session.connections -= 1
+            sender.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
+            conn.close()
+            if not upload.choked:
+                try:
+                    await self._fill_slots()
+                except OSError:
+                    pass
+
+    def _check_request(self, seeded, request):
+        index, begin, length = request
+        torrent = seeded["torrent"]
+        if index not in seeded["completed"]:
+            raise ValueError("Request for piece %d, which we do not have." % index)
+        if not 0 < length <= MAX_REQUEST_LENGTH or begin + length > torrent.piece_size(index):
+            raise ValueError("Bad request for piece %d: %d+%d." % (index, begin, length))
+
+    async def _send_blocks(self, upload):
+        seeded = upload.seeded
+        storage = seeded["storage"]
+        piece_length = seeded["torrent"].piece_length
+        info_hash = seeded["torrent"].info_hash
+        while True:
+            await upload.wake.wait()
+            upload.wake.clear()
+            while upload.requests and not upload.choked:
+                index, begin, length = upload.requests.popleft()
+                if self.session is not None:
+                    await self.session.upload.take(length, info_hash)
+                    if upload.choked:
+                        break
+                with ExitStack() as stack:
+                    chunks = [
+                        (stack.enter_context(storage.files.handle(file_index)), file_offset, span_length)
+                        for file_index, file_offset, span_length in storage.spans(
+                            index * piece_length + begin, length
+                        )
+                    ]
+                    await upload.conn.send_block(index, begin, chunks)
+                upload.recent += length
+                seeded["stats"].uploaded += length
+
+    async def close(self):
+        """Stops accepting, disconnects every peer and closes the listening socket."""
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._listener is not None:
+            self._listener.close()
+
+async def seed_async(torrent, path, port=LISTEN_PORT, max_uploads=MAX_UPLOADS, tracker=None, on_ready=None):
+    """
+    Seeds a torrent until cancelled; the coroutine behind ``seed``.
+
+    Args:
+        torrent (Torrent): The parsed torrent.
+        path (str): The downloaded file, or directory for a multi-file torrent.
+        port (int): The TCP port to listen on; 0 picks a free one.
+        max_uploads (int): The number of peers unchoked at once.
+        tracker (TrackerClient, optional): Defaults to a client announcing
+            the port actually bound.
+        on_ready (callable, optional): Called with the bound port once the
+            server is listening.
+
+    Raises:
+        FileNotFoundError: If one of the torrent's files is missing.
+        ValueError: If a file is not the size the torrent gives it.
+    """
+    # Seeding only reads: never create, resize or truncate the user's files.
+    with Storage(torrent, path, readonly=True) as storage:
+        completed = await asyncio.to_thread(resume_state, storage)
+        stats = TransferStats(_missing_bytes(torrent, completed))
+        server = SeedServer(port, max_uploads)
+        server.add(torrent, storage, completed, stats)
+        await server.start()
+        own_tracker = tracker is None
+        if own_tracker:
+            tracker = TrackerClient(port=server.port)
+        if on_ready is not None:
+            on_ready(server.port)
+        try:
+            serving = asyncio.create_task(server.serve_forever())
+            while not serving.done():
+                try:
+                    await _await_in_daemon_thread(tracker.get_peers, torrent, stats)
+                    wait = tracker.seconds_until_announce(torrent)
+                except (OSError, ValueError):
+                    wait = ANNOUNCE_RETRY_INTERVAL
+                await asyncio.wait([serving], timeout=wait)
+            serving.result()
+        finally:
+            await server.close()
+            try:
+                await _await_in_daemon_thread(
+                    tracker.announce, torrent, stats, "stopped", timeout=FINAL_ANNOUNCE_TIMEOUT
+                )
+            except (OSError, ValueError):
+                pass
+            tracker.forget(torrent)
+            if own_tracker:
+                tracker.close()
+
+def seed(torrent, path, port=LISTEN_PORT, max_uploads=MAX_UPLOADS, on_ready=None):
+    """
+    Seed a downloaded torrent until interrupted.
+
+    The data is checked first (via the resume sidecar, or a full recheck),
+    and only verified pieces are offered. The tracker is announced to with
+    the port we listen on, and again whenever its interval runs out.
+
+    Args:
+        torrent (Torrent): The parsed torrent.
+        path (str): The downloaded file, or directory for a multi-file torrent.
+        port (int): The TCP port to listen on; 0 picks a free one.
+        max_uploads (int): The number of peers unchoked at once.
+        on_ready (callable, optional): Called with the bound port once the
+            server is listening.
+
+    Example:
+        >>> seed(Torrent.from_file("example.torrent"), "example.txt")
+    """
+    try:
+        asyncio.run(seed_async(torrent, path, port, max_uploads, on_ready=on_ready))
+    except KeyboardInterrupt:
+        pass
+
+# Connections, incoming and outgoing, across every torrent of a session.
+SESSION_MAX_CONNECTIONS = 500
+
+# Block requests in flight across every connection of a session.
+SESSION_MAX_REQUESTS = 4000
+
+# File descriptors each torrent of a session keeps open, so that hundreds of
+# torrents stay within the process's limit.
+SESSION_OPEN_FILES = 8
+
+class TokenBucket:
+    """
+    A byte-rate limit shared by many tasks, taking turns fairly between owners.
+
+    Tokens accrue at ``rate`` per second, up to ``burst``. A task asking for
+    more than are available waits in its owner's queue, and the queues are
+    served round robin: a torrent with many busy connections gets no bigger
+    share of the rate than one with a single connection.
+
+    Args:
+        rate (float): Bytes per second; None for no limit.
+        burst (int, optional): The most tokens that can build up; one
+            second's worth by default.
+
+    Example:
+        >>> bucket = TokenBucket(10_000_000)
+        >>> await bucket.take(BLOCK_SIZE, torrent.info_hash)
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "_updated", "_queues", "_timer")
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate or 0, MAX_REQUEST_LENGTH)
+        self.tokens = self.burst
+        self._updated = None
+        # Owner -> deque of (amount, future), in turn order.
+        self._queues = OrderedDict()
+        self._timer = None
+
+    def _refill(self, now):
+        if self._updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def take(self, amount, owner=None):
+        """
+        Waits until ``amount`` tokens are available, then consumes them.
+
+        A request for more than ``burst`` goes through once the bucket is
+        full and leaves it in debt.
+
+        Args:
+            amount (int): The number of bytes about to be transferred.
+            owner (hashable, optional): Whose turn the request waits in,
+                e.g. an info hash.
+        """
+        if self.rate is None:
+            return
+        loop = asyncio.get_running_loop()
+        self._refill(loop.time())
+        if not self._queues and self.tokens >= min(amount, self.burst):
+            self.tokens -= amount
+            return
+        future = loop.create_future()
+        self._queues.setdefault(owner, deque()).append((amount, future))
+        self._serve()
+        await future
+
+    def _serve(self):
+        loop = asyncio.get_running_loop()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._refill(loop.time())
+        while self._queues:
+            owner, queue = next(iter(self._queues.items()))
+            amount, future = queue[0]
+            if not future.done():
+                if self.tokens < min(amount, self.burst):
+                    # Wake up when the head of the line can go.
+                    delay = (min(amount, self.burst) - self.tokens) / self.rate
+                    self._timer = loop.call_later(delay, self._serve)
+                    return
+                self.tokens -= amount
+                future.set_result(None)
+            # A cancelled waiter just gives up its place.
+            queue.popleft()
+            if queue:
+                self._queues.move_to_end(owner)
+            else:
+                del self._queues[owner]
+
+class TorrentSession:
+    """
+    Downloads and seeds many torrents from one process.
+
+    Every torrent shares the session's event loop, a single listening port
+    (one ``SeedServer``), one ``TrackerClient`` and one pool each of hashing
+    and disk threads. The session's limits apply across all of them:
+
+    - ``max_connections`` counts incoming and outgoing connections; each
+      downloading torrent may open up to an even share of it.
+    - ``max_requests`` block requests in flight, split evenly between the
+      open connections by capping each one's request window.
+    - ``download_rate`` and ``upload_rate``, enforced by ``TokenBucket``s
+      whose turns rotate between torrents.
+
+    A torrent is offered to peers from the moment it is added, with whatever
+    pieces are verified, and goes on seeding after its download completes.
+    A download that runs out of peers is retried every
+    ``ANNOUNCE_RETRY_INTERVAL`` seconds.
+
+    Must be used from a running event loop.
+
+    Args:
+        port (int): The TCP port to listen on; 0 picks a free one.
+        max_connections (int): The connection limit.
+        max_requests (int): The in-flight block request limit.
+        download_rate (float, optional): Bytes per second; unlimited if None.
+        upload_rate (float, optional): Bytes per second; unlimited if None.
+        max_uploads (int): The number of peers unchoked at once.
+        peer_id (bytes): Our 20-byte peer id.
+
+    Attributes:
+        connections (int): Connections open now, incoming and outgoing.
+        downloading (int): Torrents not fully downloaded yet.
+        download (TokenBucket): The shared download rate limit.
+        upload (TokenBucket): The shared upload rate limit.
+        tracker (TrackerClient): The shared tracker client, once started.
+
+    Example:
+        >>> session = TorrentSession(download_rate=10_000_000)
+        >>> await session.start()
+        >>> session.add(Torrent.from_file("a.torrent"), "a.iso")
+        >>> await session.wait_complete()
+    """
+
+    def __init__(
+        self,
+        port=LISTEN_PORT,
+        max_connections=SESSION_MAX_CONNECTIONS,
+        max_requests=SESSION_MAX_REQUESTS,
+        download_rate=None,
+        upload_rate=None,
+        max_uploads=MAX_UPLOADS,
+        peer_id=PEER_ID,
+    ):
+        self.max_connections = max_connections
+        self.max_requests = max_requests
+        self.connections = 0
+        self.downloading = 0
+        self.download = TokenBucket(download_rate)
+        self.upload = TokenBucket(upload_rate)
+        self.server = SeedServer(port, max_uploads, max_connections, peer_id, session=self)
+        self.tracker = None
+        self.hash_executor = ThreadPoolExecutor(HASH_WORKERS, thread_name_prefix="hash")
+        self.disk_executor = ThreadPoolExecutor(DISK_WRITERS, thread_name_prefix="storage")
+        self._tasks = {}
+        self._completions = {}
+
+    async def start(self, host=""):
+        """
+        Starts listening for peers.
+
+        Args:
+            host (str): The address to listen on; all interfaces by default.
+
+        Returns:
+            int: The port actually bound, which is also announced to trackers.
+        """
+        port = await self.server.start(host)
+        self.tracker = TrackerClient(self.server.peer_id, port)
+        return port
+
+    def add(self, torrent, path, on_complete=None):
+        """
+        Starts downloading a torrent, then seeding it.
+
+        Args:
+            torrent (Torrent): The parsed torrent.
+            path (str): Where its data goes; existing data is checked and resumed.
+            on_complete (callable, optional): Called with the torrent once it
+                is fully downloaded and verified.
+        """
+        if torrent.info_hash in self._tasks:
+            raise ValueError("Torrent %s is already in the session." % torrent.info_hash.hex())
+        self._completions[torrent.info_hash] = asyncio.get_running_loop().create_future()
+        self._tasks[torrent.info_hash] = asyncio.create_task(self._run(torrent, path, on_complete))
+        self.downloading += 1
+
+    async def wait_complete(self):
+        """Waits until every torrent added so far has been downloaded."""
+        await asyncio.gather(*self._completions.values())
+
+    def connection_slots(self, in_use):
+        """
+        The number of new connections a downloading torrent may open.
+
+        Args:
+            in_use (int): The torrent's own open connections.
+
+        Returns:
+            int: Zero or more.
+        """
+        share = max(1, self.max_connections // max(1, self.downloading))
+        return max(0, min(self.max_connections - self.connections, share - in_use))
+
+    def request_window(self, window):
+        """
+        Caps a connection's request window at its share of ``max_requests``.
+
+        Args:
+            window (int): The window the connection would use on its own.
+
+        Returns:
+            int: The window to use.
+        """
+        return max(1, min(window, self.max_requests // max(1, self.connections)))
+
+    def disconnected(self, _task=None):
+        self.connections -= 1
+
+    async def _run(self, torrent, path, on_complete):
+        completion = self._completions[torrent.info_hash]
+        resuming = os.path.exists(path)
+        storage = await asyncio.to_thread(
+            Storage, torrent, path, SESSION_OPEN_FILES, self.disk_executor
+        )
+        scheduler = None
+        try:
+            completed = await asyncio.to_thread(resume_state, storage) if resuming else None
+            scheduler = PieceScheduler(torrent.piece_count, completed)
+            # One set of counters for downloading and seeding, so every
+            # announce reports what this torrent really transferred.
+            stats = TransferStats(_missing_bytes(torrent, scheduler.completed))
+            self.server.add(torrent, storage, scheduler.completed, stats)
+            while not scheduler.done:
+                try:
+                    await _download_pieces(
+                        torrent,
+                        scheduler,
+                        storage,
+                        PIPELINE_DEPTH,
+                        MAX_PEERS,
+                        self.tracker,
+                        self,
+                        stats=stats,
+                    )
+                except (OSError, ValueError):
+                    pass  # No tracker answered.
+                if not scheduler.done:
+                    await asyncio.to_thread(save_resume, storage, scheduler.completed)
+                    await asyncio.sleep(ANNOUNCE_RETRY_INTERVAL)
+            if os.path.exists(path + RESUME_SUFFIX):
+                os.remove(path + RESUME_SUFFIX)
+            self.downloading -= 1
+            completion.set_result(None)
+            if on_complete is not None:
+                on_complete(torrent)
+            while True:
+                try:
+                    await _await_in_daemon_thread(self.tracker.get_peers, torrent, stats)
+                    wait = self.tracker.seconds_until_announce(torrent)
+                except (OSError, ValueError):
+                    wait = ANNOUNCE_RETRY_INTERVAL
+                await asyncio.sleep(wait)
+        except Exception as e:
+            if not completion.done():
+                self.downloading -= 1
+                completion.set_exception(e)
+                # Marked as retrieved: wait_complete, if anyone calls it, reports it.
+                completion.exception()
+            raise
+        finally:
+            if not completion.done():
+                self.downloading -= 1
+                completion.cancel()
+            await self.server.remove(torrent)
+            if scheduler is not None and not scheduler.done:
+                save_resume(storage, scheduler.completed)
+            await asyncio.to_thread(storage.close)
+
+    async def close(self):
+        """Stops every torrent, saving resume data, and closes the listening socket."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.server.close()
+        if self.tracker is not None:
+            self.tracker.close()
+        self.hash_executor.shutdown(wait=False, cancel_futures=True)
+        self.disk_executor.shutdown(wait=True)
+
+async def session_async(directory, filenames, port=LISTEN_PORT, on_ready=None, on_complete=None, **limits):
+    """
+    Runs one session for many .torrent files until cancelled; the coroutine behind ``run_session``.
+
+    Args:
+        directory (str): Where each torrent's data goes, under its own name.
+        filenames (list): The .torrent files.
+        port (int): The TCP port to listen on; 0 picks a free one.
+        on_ready (callable, optional): Called with the bound port.
+        on_complete (callable, optional): Called with ``(torrent, path)`` as
+            each download completes.
+        **limits: ``TorrentSession`` limits, e.g. ``download_rate``.
+    """
+    session = TorrentSession(port, **limits)
+    paths = {}
+    try:
+        await session.start()
+        for filename in filenames:
+            torrent = await asyncio.to_thread(Torrent.from_file, filename)
+            name = torrent.info["name"].decode()
+            path = os.path.join(directory, *_safe_path_components([name]))
+            if path in paths:
+                raise ValueError("Torrents %s and %s share the name %r." % (paths[path], filename, name))
+            paths[path] = filename
+            session.add(
+                torrent,
+                path,
+                on_complete and (lambda torrent, path=path: on_complete(torrent, path)),
+            )
+        if on_ready is not None:
+            on_ready(session.server.port)
+        await session.server.serve_forever()
+    finally:
+        await session.close()
+
+def run_session(directory, filenames, port=LISTEN_PORT, on_ready=None, on_complete=None, **limits):
+    """
+    Download and then seed many torrents from one process until interrupted.
+
+    Args:
+        directory (str): Where each torrent's data goes, under its own name.
+        filenames (list): The .torrent files.
+        port (int): The TCP port to listen on; 0 picks a free one.
+        on_ready (callable, optional): Called with the bound port.
+        on_complete (callable, optional): Called with ``(torrent, path)`` as
+            each download completes.
+        **limits: ``TorrentSession`` limits, e.g. ``download_rate``.
 
     Example:
-        >>> download("example.torrent", "example.torrent")
+        >>> run_session("downloads", ["a.torrent", "b.torrent"], upload_rate=1_000_000)
     """
-    decoded_value = decode_torrentfile(filename)
-    total_pieces = len(piece_hashes(decoded_value["info"]["pieces"]))
-    piecefiles = []
-    for piece in range(0, total_pieces):
-        p, o = download_piece("/tmp/test-" + str(piece), filename, piece)
-        piecefiles.append(o)
-    with open(outputfile, "ab") as result_file:
-        for piecefile in piecefiles:
-            with open(piecefile, "rb") as piece_file:
-                result_file.write(piece_file.read())
-            os.remove(piecefile)
+    try:
+        asyncio.run(session_async(directory, filenames, port, on_ready, on_complete, **limits))
+    except KeyboardInterrupt:
+        pass
 
 def bytes_to_str(data):
     """
@@ -643,12 +5217,32 @@ def bytes_to_str(data):
         return data.decode()
     raise TypeError(f"Type not serializable: {type(data)}")
 
+def _pop_option(argv, name):
+    # Removes "--name value" or "--name=value" from anywhere in argv; returns the value.
+    for i, arg in enumerate(argv):
+        if arg == name and i + 1 < len(argv):
+            value = argv[i + 1]
+            del argv[i : i + 2]
+            return value
+        if arg.startswith(name + "="):
+            del argv[i]
+            return arg[len(name) + 1 :]
+    return None
+
 def main():
     """
     The main function.
 
     This function parses the command line arguments and calls the corresponding function.
 
+    Three options work with any command, anywhere on the command line:
+    ``--stats SECONDS`` writes a JSON line of ``default_metrics`` to stderr
+    that often, ``--metrics-port PORT`` serves them to Prometheus, and
+    ``--profile FILE`` runs the command under cProfile, saving the profile
+    to FILE and printing the top functions by cumulative time to stderr.
+    The profile covers the main thread, which runs the event loop; hashing
+    and disk writes show up in the metrics instead.
+
     Args:
         None
 
@@ -658,27 +5252,50 @@ def main():
     Example:
         >>> main()
     """
+    profile = _pop_option(sys.argv, "--profile")
+    stats_interval = _pop_option(sys.argv, "--stats")
+    metrics_port = _pop_option(sys.argv, "--metrics-port")
+    stop_stats = report_stats(sys.stderr, float(stats_interval)) if stats_interval else None
+    server = serve_metrics(int(metrics_port)) if metrics_port else None
+    try:
+        if profile:
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(_run_command)
+            finally:
+                profiler.dump_stats(profile)
+                stats = pstats.Stats(profiler, stream=sys.stderr)
+                stats.sort_stats("cumulative").print_stats(PROFILE_LINES)
+        else:
+            _run_command()
+    finally:
+        if _default_tracker is not None:
+            _default_tracker.close()
+        if stop_stats is not None:
+            stop_stats()
+        if server is not None:
+            server.shutdown()
+
+def _run_command():
     command = sys.argv[1]
     # You can use print statements as follows for debugging, they'll be visible when running tests.
     # print("Logs from your program will appear here!")
     if command == "decode":
         bencoded_value = sys.argv[2].encode()
-        decoded_value, remainder = decode_bencode(bencoded_value)
-        if remainder:
-            raise ValueError("Undecoded remainder.")
+        decoded_value = decode_bencode_all(bencoded_value)
         print(json.dumps(decoded_value, default=bytes_to_str))
     elif command == "info":
         if len(sys.argv) != 3:
             raise NotImplementedError(f"Usage: {sys.argv[0]} info filename")
         filename = sys.argv[2]
-        print_info(filename)
+        print_info(Torrent.from_file(filename))
     elif command == "peers":
         if len(sys.argv) != 3:
             raise NotImplementedError(f"Usage: {sys.argv[0]} peers filename")
         filename = sys.argv[2]
-        peers = split_peers(get_peers(filename))
+        peers = get_peers(Torrent.from_file(filename))
         for p in peers:
-            print(p)
+            print(format_peer(p))
     elif command == "handshake":
         if len(sys.argv) != 4:
             raise NotImplementedError(
@@ -686,10 +5303,8 @@ def main():
             )
         filename = sys.argv[2]
         peer = sys.argv[3]
-        peer_socket, received_message = init_handshake(filename, peer)
-        received_id = received_message[48:68].hex()
+        received_id = handshake(Torrent.from_file(filename), peer).hex()
         print("Peer ID:", received_id)
-        peer_socket.close()
     elif command == "download_piece":
         if len(sys.argv) != 6:
             raise NotImplementedError(
@@ -698,7 +5313,7 @@ def main():
         outputfile = sys.argv[3]
         filename = sys.argv[4]
         piececount = sys.argv[5]
-        p, o = download_piece(outputfile, filename, int(piececount))
+        p, o = download_piece(outputfile, Torrent.from_file(filename), int(piececount))
         print("Piece %i downloaded to %s" % (p, o))
     elif command == "download":
         if len(sys.argv) != 5:
@@ -707,8 +5322,37 @@ def main():
             )
         outputfile = sys.argv[3]
         filename = sys.argv[4]
-        download(outputfile, filename)
-        print("Download %s to %s" % (filename, outputfile))
+        if outputfile == "-":
+            download_stream(sys.stdout.buffer, Torrent.from_file(filename))
+            print("Download %s to stdout" % filename, file=sys.stderr)
+        else:
+            download(outputfile, Torrent.from_file(filename))
+            print("Download %s to %s" % (filename, outputfile))
+    elif command == "seed":
+        if len(sys.argv) != 4:
+            raise NotImplementedError(f"Usage: {sys.argv[0]} seed filename path")
+        filename = sys.argv[2]
+        path = sys.argv[3]
+        seed(
+            Torrent.from_file(filename),
+            path,
+            on_ready=lambda port: print("Seeding %s from %s on port %d" % (filename, path, port), flush=True),
+        )
+    elif command == "session":
+        if len(sys.argv) < 4:
+            raise NotImplementedError(f"Usage: {sys.argv[0]} session directory filename...")
+        directory = sys.argv[2]
+        filenames = sys.argv[3:]
+        run_session(
+            directory,
+            filenames,
+            on_ready=lambda port: print(
+                "Session of %d torrents on port %d" % (len(filenames), port), flush=True
+            ),
+            on_complete=lambda torrent, path: print(
+                "Download %s to %s" % (torrent.info["name"].decode(), path), flush=True
+            ),
+        )
     else:
         raise NotImplementedError(f"Unknown command {command}")
 
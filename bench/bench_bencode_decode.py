@@ -0,0 +1,117 @@
+"""
+Compares the offset-based bencode decoder with the original
+slice-and-return-remainder decoder on synthetic torrent metainfo.
+
+Usage:
+    python -m bench.bench_bencode_decode [--sizes 10K,100K,1M,10M,50M] [--legacy-limit 2M]
+"""
+import argparse
+import hashlib
+import time
+
+from app.main import bencode, decode_bencode_all
+
+
+def legacy_decode_bencode(bencoded_value):
+    """
+    The decoder as it was before the offset-based rewrite, kept verbatim
+    (modulo names) as the baseline.
+    """
+    lead = chr(bencoded_value[0])
+    if lead.isdigit():
+        first_colon_index = bencoded_value.find(b":")
+        length_string = int(bencoded_value[:first_colon_index])
+        decoded_string = bencoded_value[
+            first_colon_index + 1 : first_colon_index + 1 + length_string
+        ]
+        return decoded_string, bencoded_value[first_colon_index + 1 + length_string :]
+    elif lead == "i":
+        end_int = bencoded_value.find(b"e")
+        return int(bencoded_value[1:end_int]), bencoded_value[end_int + 1 :]
+    elif lead == "l":
+        bencoded_remainder = bencoded_value[1:]
+        decoded_list = []
+        while chr(bencoded_remainder[0]) != "e":
+            decoded_value, bencoded_remainder = legacy_decode_bencode(bencoded_remainder)
+            decoded_list.append(decoded_value)
+        return decoded_list, bencoded_remainder[1:]
+    elif lead == "d":
+        bencoded_remainder = bencoded_value[1:]
+        decoded_dict = {}
+        while chr(bencoded_remainder[0]) != "e":
+            decoded_key, bencoded_remainder = legacy_decode_bencode(bencoded_remainder)
+            decoded_value, bencoded_remainder = legacy_decode_bencode(bencoded_remainder)
+            decoded_dict[decoded_key.decode()] = decoded_value
+        return decoded_dict, bencoded_remainder[1:]
+    raise NotImplementedError("We only support strings, integers, lists, and dicts.")
+
+
+def parse_size(text):
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    text = text.strip().upper()
+    if text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def synthetic_metainfo(target_size):
+    """
+    Builds a multi-file torrent of roughly ``target_size`` bytes: half of it is
+    the ``pieces`` blob, the other half a list of file entries.
+    """
+    piece_count = max(1, target_size // 2 // 20)
+    pieces = b"".join(
+        hashlib.sha1(i.to_bytes(8, "big")).digest() for i in range(piece_count)
+    )
+    # A file entry encodes to roughly 60 bytes.
+    files = [
+        {"length": 1000 + i, "path": ["dir%d" % (i % 97), "file%d.bin" % i]}
+        for i in range(max(1, target_size // 2 // 60))
+    ]
+    return bencode(
+        {
+            "announce": "http://tracker.example/announce",
+            "info": {
+                "files": files,
+                "name": "synthetic",
+                "piece length": 262144,
+                "pieces": pieces,
+            },
+        }
+    )
+
+
+def best_of(fn, data, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(data)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="10K,100K,1M,10M,50M")
+    parser.add_argument(
+        "--legacy-limit",
+        default="2M",
+        help="skip the legacy decoder above this size (it is quadratic)",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    legacy_limit = parse_size(args.legacy_limit)
+
+    print("%10s %14s %14s %9s" % ("size", "legacy (s)", "offset (s)", "speedup"))
+    for size_text in args.sizes.split(","):
+        data = synthetic_metainfo(parse_size(size_text))
+        new = best_of(decode_bencode_all, data, args.repeat)
+        if len(data) <= legacy_limit:
+            old = best_of(lambda d: legacy_decode_bencode(d)[0], data, args.repeat)
+            print("%10d %14.4f %14.4f %8.1fx" % (len(data), old, new, old / new))
+        else:
+            print("%10d %14s %14.4f %9s" % (len(data), "skipped", new, "-"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Compares the single-buffer bencode encoder with the original encoder that
+concatenated ``bytes`` level by level, on synthetic torrent metainfo with
+many piece hashes and file entries. Also reports peak memory while
+encoding: ``bencode`` into one buffer versus ``bencode_to`` streaming the
+file list from a generator.
+
+Usage:
+    python -m bench.bench_bencode_encode [--sizes 10K,100K,1M,10M,50M] [--legacy-limit 10M]
+"""
+import argparse
+import hashlib
+import os
+import time
+import tracemalloc
+
+from app.main import bencode, bencode_to, decode_bencode_all
+from bench.bench_bencode_decode import parse_size
+
+
+def legacy_bencode(value):
+    """
+    The encoder as it was before the single-buffer rewrite, kept verbatim
+    (modulo names) as the baseline. It writes dict keys in insertion order.
+    """
+    if isinstance(value, str):
+        return (str(len(value)) + ":" + value).encode()
+    elif isinstance(value, bytes):
+        return str(len(value)).encode() + b":" + value
+    elif isinstance(value, int):
+        return ("i" + str(value) + "e").encode()
+    elif isinstance(value, list):
+        result = b"l"
+        for i in value:
+            result += legacy_bencode(i)
+        return result + b"e"
+    elif isinstance(value, dict):
+        result = b"d"
+        for k in value:
+            result += legacy_bencode(k) + legacy_bencode(value[k])
+        return result + b"e"
+    raise ValueError("Can only bencode strings, ints, lists, or dicts.")
+
+
+def file_entries(count):
+    # A file entry encodes to roughly 60 bytes.
+    for i in range(count):
+        yield {"length": 1000 + i, "path": ["dir%d" % (i % 97), "file%d.bin" % i]}
+
+
+def synthetic_metainfo(target_size, lazy=False):
+    """
+    A multi-file torrent of roughly ``target_size`` bytes once encoded: half
+    piece hashes, half file entries. With ``lazy``, the file list is a generator.
+    """
+    piece_count = max(1, target_size // 2 // 20)
+    pieces = b"".join(hashlib.sha1(i.to_bytes(8, "big")).digest() for i in range(piece_count))
+    files = file_entries(max(1, target_size // 2 // 60))
+    # Keys already in sorted order, so the legacy output is comparable.
+    return {
+        "announce": "http://tracker.example/announce",
+        "info": {
+            "files": files if lazy else list(files),
+            "name": "synthetic",
+            "piece length": 262144,
+            "pieces": pieces,
+        },
+    }
+
+
+def best_of(fn, data, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(data)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def peak_memory(fn, value):
+    # Peak bytes allocated while fn encodes value, beyond what was live before.
+    tracemalloc.start()
+    fn(value)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="10K,100K,1M,10M,50M")
+    parser.add_argument(
+        "--legacy-limit",
+        default="10M",
+        help="skip the legacy encoder above this size (it is quadratic)",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    legacy_limit = parse_size(args.legacy_limit)
+
+    print("%10s %12s %12s %9s %14s %14s" % (
+        "size", "legacy (s)", "buffer (s)", "speedup", "bencode peak", "streamed peak"
+    ))
+    with open(os.devnull, "wb") as sink:
+        for size_text in args.sizes.split(","):
+            size = parse_size(size_text)
+            metainfo = synthetic_metainfo(size)
+            encoded = bencode(metainfo)
+            new = best_of(bencode, metainfo, args.repeat)
+            if len(encoded) <= legacy_limit:
+                assert decode_bencode_all(legacy_bencode(metainfo)) == decode_bencode_all(encoded)
+                old = best_of(legacy_bencode, metainfo, args.repeat)
+                timings = "%12.4f %12.4f %8.1fx" % (old, new, old / new)
+            else:
+                timings = "%12s %12.4f %9s" % ("skipped", new, "-")
+            del metainfo
+            # Both start from a lazy structure: only the pieces blob exists up front.
+            buffered = peak_memory(bencode, synthetic_metainfo(size, lazy=True))
+            streamed = peak_memory(
+                lambda value: bencode_to(value, sink), synthetic_metainfo(size, lazy=True)
+            )
+            print("%10d %s %13.1fM %13.1fM" % (
+                len(encoded), timings, buffered / 2**20, streamed / 2**20
+            ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Measures how quickly a download gets going when the tracker lists
+unresponsive peers first: peers that accept the connection but sit on the
+handshake, ahead of responsive seeders, with fewer download slots than
+peers. Compares dialling only as many peers as there are slots with
+dialling ``DIAL_SURPLUS`` more, where a slot only goes to a peer that has
+answered and unchoked us.
+
+Reports the time until the first piece is verified and the overall rate.
+
+Usage:
+    python -m bench.bench_connect [--size 32M] [--slow 6] [--fast 4] [--max-peers 4]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+
+import app.main
+from app.main import PieceScheduler, Torrent, default_tracker, download_async
+from bench.bench_bencode_decode import parse_size
+from bench.swarm import FakeSwarm, SyntheticContent
+
+
+def run_swarm(args, ready):
+    content = SyntheticContent(parse_size(args.size), parse_size(args.piece_length))
+    peers = (
+        [{"latency": args.latency, "handshake_delay": args.handshake_delay}] * args.slow
+        + [{"latency": args.latency}] * args.fast
+    )
+    with FakeSwarm(content, peers) as swarm:
+        ready.send(swarm.metainfo)
+        ready.recv()
+
+
+def run(torrent, directory, max_peers, surplus):
+    app.main.DIAL_SURPLUS = surplus
+    complete = PieceScheduler.complete
+    first = []
+
+    def timed_complete(self, index):
+        if not first:
+            first.append(time.perf_counter())
+        return complete(self, index)
+
+    PieceScheduler.complete = timed_complete
+    try:
+        start = time.perf_counter()
+        asyncio.run(download_async(
+            os.path.join(directory, "surplus%d" % surplus), torrent, max_peers=max_peers
+        ))
+        elapsed = time.perf_counter() - start
+    finally:
+        PieceScheduler.complete = complete
+        # So the next run announces afresh instead of reusing cached peers.
+        default_tracker().forget(torrent)
+    return elapsed, first[0] - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", default="32M")
+    parser.add_argument("--piece-length", default="256K")
+    parser.add_argument("--slow", type=int, default=6)
+    parser.add_argument("--fast", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.02, help="one-way delay in seconds")
+    parser.add_argument(
+        "--handshake-delay", type=float, default=60.0, help="seconds the slow peers sit on a handshake"
+    )
+    parser.add_argument("--max-peers", type=int, default=4)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("fork")
+    ours, theirs = context.Pipe()
+    swarm = context.Process(target=run_swarm, args=(args, theirs), daemon=True)
+    swarm.start()
+    torrent = Torrent.from_bytes(ours.recv())
+    try:
+        print("%d bytes, %d unresponsive peers listed before %d seeders, %d download slots" % (
+            torrent.length, args.slow, args.fast, args.max_peers
+        ))
+        print("%-20s %14s %10s %10s" % ("dialling", "first piece ms", "seconds", "MB/s"))
+        with tempfile.TemporaryDirectory() as directory:
+            for name, surplus in (("slots only", 0), ("ahead", app.main.DIAL_SURPLUS)):
+                elapsed, first = run(torrent, directory, args.max_peers, surplus)
+                print("%-20s %14.0f %10.2f %10.1f" % (
+                    "%s (+%d)" % (name, surplus), first * 1000, elapsed, torrent.length / elapsed / 1e6
+                ))
+    finally:
+        ours.send(None)
+        swarm.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+End-to-end benchmark of the ``download`` command against a local fake
+swarm: a ``FakeTracker`` serving compact peer lists and ``FakePeer``
+seeders with configurable latency, bandwidth caps, choking and corrupt
+blocks, on synthetic torrents from MBs to GBs.
+
+Each scenario runs ``python -m app.main download`` in a fresh child
+process and reports its throughput, the time until the first piece is
+verified, and the child's CPU time and peak memory per MB downloaded,
+taken from ``wait4``'s resource usage.
+
+Each scenario also runs in streaming mode, ``download -o -``, which writes
+the content to stdout in order; for it the first byte read from the pipe
+is timed as well.
+
+Usage:
+    python -m bench.bench_download [--size 64M] [--piece-length 256K] [--peers 4]
+        [--latency 0.02] [--rate 4M] [--scenarios clean,latency,capped,choking,corrupt]
+        [--modes file,stream]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench.bench_bencode_decode import parse_size
+from bench.swarm import FakeSwarm, SyntheticContent
+
+# Printed on stderr by the child when the first piece has been verified.
+FIRST_PIECE = "first piece at "
+
+
+def scenarios(args):
+    # Name -> FakePeer keyword arguments for each of the swarm's peers.
+    peers = args.peers
+    return {
+        "clean": [{}] * peers,
+        "latency": [{"latency": args.latency}] * peers,
+        "capped": [{"latency": args.latency, "rate": parse_size(args.rate)}] * peers,
+        "choking": [{"latency": args.latency, "choke_every": 64, "choke_time": 0.2}] * peers,
+        # One peer in the swarm sends a corrupt block in every ten.
+        "corrupt": (
+            [{"latency": args.latency, "corrupt": 0.1}] + [{"latency": args.latency}] * (peers - 1)
+        ),
+    }
+
+
+def child(argv):
+    """Runs the download command, reporting when the first piece is verified."""
+    import app.main
+
+    complete = app.main.PieceScheduler.complete
+    reported = []
+
+    def timed_complete(self, index):
+        if not reported:
+            reported.append(index)
+            print(FIRST_PIECE + repr(time.monotonic()), file=sys.stderr, flush=True)
+        return complete(self, index)
+
+    app.main.PieceScheduler.complete = timed_complete
+    sys.argv = ["app.main"] + argv
+    app.main.main()
+
+
+def run(swarm, directory, stream):
+    torrent_path = os.path.join(directory, "bench.torrent")
+    output = "-" if stream else os.path.join(directory, "bench.out")
+    with open(torrent_path, "wb") as f:
+        f.write(swarm.metainfo)
+    start = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "bench.bench_download", "--child",
+         "download", "-o", output, torrent_path],
+        stdout=subprocess.PIPE if stream else subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    first_byte = None
+    if stream:
+        received = 0
+        while True:
+            chunk = process.stdout.read1(1 << 20)
+            if not chunk:
+                break
+            if first_byte is None:
+                first_byte = time.monotonic() - start
+            received += len(chunk)
+        if received != len(swarm.content):
+            raise RuntimeError("streamed %d of %d bytes" % (received, len(swarm.content)))
+    errors = process.stderr.read().decode()
+    # wait4 rather than Popen.wait, for the child's own resource usage.
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.monotonic() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise RuntimeError("download failed:\n" + errors)
+    first = next(
+        float(line[len(FIRST_PIECE):]) for line in errors.splitlines() if line.startswith(FIRST_PIECE)
+    )
+    if not stream:
+        os.remove(output)
+    return elapsed, first - start, first_byte, usage
+
+
+def main():
+    if sys.argv[1:2] == ["--child"]:
+        return child(sys.argv[2:])
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", default="64M")
+    parser.add_argument("--piece-length", default="256K")
+    parser.add_argument("--peers", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.02, help="one-way delay in seconds")
+    parser.add_argument("--rate", default="4M", help="per-connection cap in bytes per second")
+    parser.add_argument("--scenarios", default="clean,latency,capped,choking,corrupt")
+    parser.add_argument("--modes", default="file,stream")
+    args = parser.parse_args()
+
+    content = SyntheticContent(parse_size(args.size), parse_size(args.piece_length))
+    megabytes = content.length / 1e6
+    print("%d bytes, %d pieces, %d peers" % (content.length, content.piece_count, args.peers))
+    print("%-10s %-7s %8s %8s %14s %13s %10s %14s" % (
+        "scenario", "mode", "seconds", "MB/s", "first piece ms", "first byte ms",
+        "CPU ms/MB", "peak RSS KB/MB",
+    ))
+    available = scenarios(args)
+    with tempfile.TemporaryDirectory() as directory:
+        for name in args.scenarios.split(","):
+            for mode in args.modes.split(","):
+                with FakeSwarm(content, available[name]) as swarm:
+                    elapsed, first, first_byte, usage = run(swarm, directory, mode == "stream")
+                print("%-10s %-7s %8.2f %8.1f %14.0f %13s %10.2f %14.1f" % (
+                    name,
+                    mode,
+                    elapsed,
+                    megabytes / elapsed,
+                    first * 1000,
+                    "-" if first_byte is None else "%.0f" % (first_byte * 1000),
+                    (usage.ru_utime + usage.ru_stime) * 1000 / megabytes,
+                    usage.ru_maxrss / megabytes,
+                ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Measures the peak memory of a download against torrent size, piece length
+and peer count, with the piece buffer pool capped at ``--memory-limit``
+and, for comparison, with a cap too large to ever bind. With the cap, peak
+RSS should stay flat however large the torrent or however many peers
+serve it.
+
+Each download runs in a fresh child process and its peak RSS is taken
+from ``wait4``. The fake swarm runs in a child process of its own, so its
+memory is not counted against the downloader.
+
+Usage:
+    python -m bench.bench_memory [--sizes 32M,128M] [--piece-lengths 256K,4M]
+        [--peers 4,16] [--memory-limit 64M]
+"""
+import argparse
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench.bench_bencode_decode import parse_size
+from bench.swarm import FakeSwarm, SyntheticContent
+
+# A memory limit no download here comes near.
+UNBOUNDED = 1 << 62
+
+
+def child(memory_limit, outputfile, filename):
+    """Downloads a torrent with the given piece memory limit, then exits."""
+    from app.main import Torrent, download
+
+    download(outputfile, Torrent.from_file(filename), memory_limit=int(memory_limit))
+
+
+def run_swarm(size, piece_length, peers, latency, ready):
+    content = SyntheticContent(size, piece_length)
+    with FakeSwarm(content, [{"latency": latency}] * peers) as swarm:
+        ready.send(swarm.metainfo)
+        ready.recv()
+
+
+def run(filename, directory, memory_limit):
+    outputfile = os.path.join(directory, "bench.out")
+    start = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "bench.bench_memory", "--child",
+         str(memory_limit), outputfile, filename],
+        stdout=subprocess.DEVNULL,
+    )
+    # wait4 rather than Popen.wait, for the child's own resource usage.
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.monotonic() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise RuntimeError("download failed")
+    os.remove(outputfile)
+    return elapsed, usage.ru_maxrss
+
+
+def main():
+    if sys.argv[1:2] == ["--child"]:
+        return child(*sys.argv[2:5])
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="32M,128M")
+    parser.add_argument("--piece-lengths", default="256K,4M")
+    parser.add_argument("--peers", default="4,16")
+    parser.add_argument("--latency", type=float, default=0.01, help="one-way delay in seconds")
+    parser.add_argument("--memory-limit", default="64M")
+    args = parser.parse_args()
+    memory_limit = parse_size(args.memory_limit)
+
+    context = multiprocessing.get_context("fork")
+    print("%10s %12s %6s %-10s %8s %8s %12s" % (
+        "size", "piece length", "peers", "limit", "seconds", "MB/s", "peak RSS MB"
+    ))
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "bench.torrent")
+        for size in map(parse_size, args.sizes.split(",")):
+            for piece_length in map(parse_size, args.piece_lengths.split(",")):
+                for peers in map(int, args.peers.split(",")):
+                    ours, theirs = context.Pipe()
+                    swarm = context.Process(
+                        target=run_swarm,
+                        args=(size, piece_length, peers, args.latency, theirs),
+                        daemon=True,
+                    )
+                    swarm.start()
+                    try:
+                        with open(filename, "wb") as f:
+                            f.write(ours.recv())
+                        for name, limit in (
+                            (args.memory_limit, memory_limit), ("none", UNBOUNDED)
+                        ):
+                            elapsed, rss = run(filename, directory, limit)
+                            print("%10d %12d %6d %-10s %8.2f %8.1f %12.1f" % (
+                                size, piece_length, peers, name,
+                                elapsed, size / elapsed / 1e6, rss / 1024,
+                            ))
+                    finally:
+                        ours.send(None)
+                        swarm.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Measures time to first peer set for a torrent with an announce-list (BEP 12)
+whose trackers are slow, failing or unreachable: walking the tiers one
+tracker at a time versus ``TrackerClient.announce``, which asks the trackers
+of a tier in parallel, returns the first reply with peers and falls back to
+the next tier only once the whole tier has failed.
+
+Two announce-lists are timed. In "mixed tier" the first tier holds a dead,
+a failing, a slow and a fast tracker, so the fastest one should set the
+time. In "dead tier" every tracker of the first tier fails, so both ways
+pay for the fallback to the second.
+
+Usage:
+    python -m bench.bench_multitracker [--latency 0.05] [--slow 1.0] [--rounds 3]
+"""
+import argparse
+import time
+
+from app.main import TrackerClient, Torrent, TransferStats, bencode
+from bench.fake_tracker import FakeTracker, FakeUDPTracker
+
+
+def torrent_for(tiers):
+    metainfo = {
+        "announce": tiers[0][0],
+        "announce-list": tiers,
+        "info": {"length": 1, "name": "bench", "piece length": 16384, "pieces": b"\x00" * 20},
+    }
+    return Torrent.from_bytes(bencode(metainfo))
+
+
+def peer_range(first, count):
+    return ["127.0.%d.%d:6881" % divmod(i, 250) for i in range(first, first + count)]
+
+
+def sequential(client, torrent):
+    # The plain BEP 12 walk: the first tracker that answers wins.
+    error = None
+    for tier in torrent.announce_list:
+        for url in tier:
+            try:
+                stats = TransferStats(torrent.length)
+                return client.announce_to(url, torrent, stats, "started")["peers"]
+            except (OSError, ValueError) as e:
+                error = e
+    raise error
+
+
+def parallel(client, torrent):
+    return client.announce(torrent, event="started")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--latency", type=float, default=0.05, help="fast tracker latency (s)")
+    parser.add_argument("--slow", type=float, default=1.0, help="slow tracker latency (s)")
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    dead = FakeUDPTracker(drop=10**9)
+    failing = FakeTracker(failure="torrent not registered")
+    slow = FakeTracker(peer_range(0, 80), latency=args.slow)
+    fast = FakeTracker(peer_range(50, 60), latency=args.latency)
+    fast_udp = FakeUDPTracker(peer_range(100, 40), latency=args.latency * 2)
+    trackers = [dead, failing, slow, fast, fast_udp]
+    for tracker in trackers:
+        tracker.start()
+    try:
+        scenarios = [
+            ("mixed tier", [[dead.url, failing.url, slow.url, fast.url], [fast_udp.url]]),
+            ("dead tier", [[dead.url, failing.url], [slow.url, fast_udp.url]]),
+        ]
+        print("%-12s %-18s %16s %16s" % ("", "", "first peers (ms)", "worst (ms)"))
+        for scenario, tiers in scenarios:
+            for name, announce in (("one at a time", sequential), ("tier in parallel", parallel)):
+                times = []
+                for _ in range(args.rounds):
+                    # A fresh torrent reshuffles its tiers, as BEP 12 asks.
+                    torrent = torrent_for(tiers)
+                    client = TrackerClient(udp_timeout=0.25, udp_retries=1)
+                    start = time.perf_counter()
+                    peers = announce(client, torrent)
+                    times.append(time.perf_counter() - start)
+                    client.close()
+                    if not peers:
+                        raise RuntimeError("%s: no peers from %s" % (name, scenario))
+                print("%-12s %-18s %16.0f %16.0f" % (
+                    scenario, name, sum(times) / len(times) * 1000, max(times) * 1000
+                ))
+    finally:
+        for tracker in trackers:
+            tracker.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Measures adaptive peer selection on a mixed-speed swarm: a few fast peers
+and several bandwidth-capped slow ones, with the slow peers first in the
+tracker's list and fewer connection slots than peers. Compares keeping the
+peers in list order with reviewing them through ``PeerStats`` and
+replacing the slowest connection with an untried peer.
+
+The review runs on a shortened schedule, set by ``--review``, so the
+benchmark does not have to last minutes.
+
+Usage:
+    python -m bench.bench_peer_selection [--size 32M] [--fast 2] [--slow 6] [--max-peers 4]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+
+import app.main
+from app.main import default_tracker, download_async
+from bench.bench_bencode_decode import parse_size
+from bench.bench_pex import torrent_for
+from bench.fake_peer import FakePeer
+from bench.fake_tracker import FakeTracker
+
+
+def run_peers(data, piece_length, info_hash, rates, latency, ready):
+    peers = [FakePeer(data, piece_length, info_hash, latency, rate=rate).start() for rate in rates]
+    ready.send([peer.address for peer in peers])
+    ready.recv()
+
+
+def run(data, piece_length, addresses, max_peers, review, directory):
+    with FakeTracker(addresses) as tracker:
+        torrent = torrent_for(tracker.url, data, piece_length)
+        if review:
+            app.main.PEER_REVIEW_INTERVAL = review
+            app.main.PEER_GRACE_PERIOD = review
+        else:
+            app.main.PEER_REVIEW_INTERVAL = float("inf")
+        start = time.perf_counter()
+        asyncio.run(download_async(
+            os.path.join(directory, "review%s" % review), torrent, max_peers=max_peers
+        ))
+        elapsed = time.perf_counter() - start
+        # So the next run announces afresh instead of reusing cached peers.
+        default_tracker().forget(torrent)
+        return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", default="32M")
+    parser.add_argument("--piece-length", default="256K")
+    parser.add_argument("--fast", type=int, default=2)
+    parser.add_argument("--slow", type=int, default=6)
+    parser.add_argument("--fast-rate", default="16M", help="bytes per second")
+    parser.add_argument("--slow-rate", default="256K", help="bytes per second")
+    parser.add_argument("--latency", type=float, default=0.02, help="one-way delay in seconds")
+    parser.add_argument("--max-peers", type=int, default=4)
+    parser.add_argument("--review", type=float, default=2.0, help="review interval in seconds")
+    args = parser.parse_args()
+
+    data = os.urandom(parse_size(args.size))
+    piece_length = parse_size(args.piece_length)
+    rates = [parse_size(args.slow_rate)] * args.slow + [parse_size(args.fast_rate)] * args.fast
+    # The announce url is not part of the info dict, so any url gives the same hash.
+    info_hash = torrent_for("http://127.0.0.1/", data, piece_length).info_hash
+    context = multiprocessing.get_context("fork")
+    ours, theirs = context.Pipe()
+    child = context.Process(
+        target=run_peers,
+        args=(data, piece_length, info_hash, rates, args.latency, theirs),
+        daemon=True,
+    )
+    child.start()
+    addresses = ours.recv()
+    try:
+        print("%d bytes, %d slow peers listed before %d fast, %d connection slots" % (
+            len(data), args.slow, args.fast, args.max_peers
+        ))
+        print("%-16s %10s %10s" % ("peers", "seconds", "MB/s"))
+        with tempfile.TemporaryDirectory() as directory:
+            for name, review in (("list order", None), ("adaptive", args.review)):
+                elapsed = run(data, piece_length, addresses, args.max_peers, review, directory)
+                print("%-16s %10.2f %10.1f" % (name, elapsed, len(data) / elapsed / 1e6))
+    finally:
+        ours.send(None)
+        child.join()
+
+
+if __name__ == "__main__":
+    main()
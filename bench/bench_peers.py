@@ -0,0 +1,78 @@
+"""
+Compares ``parse_compact_peers`` with the original string-building
+``split_peers`` on large compact peer lists, including the step every
+caller used to need afterwards: splitting ``"ip:port"`` back apart.
+
+Usage:
+    python -m bench.bench_peers [--peers 50000] [--repeat 5]
+"""
+import argparse
+import os
+import time
+
+from app.main import parse_compact_peers
+
+
+def legacy_split_peers(peers):
+    """
+    ``split_peers`` as it was before the ``struct.iter_unpack`` rewrite, kept
+    verbatim (modulo names) as the baseline.
+    """
+    if len(peers) % 6 != 0:
+        raise ValueError(
+            "Peer list from tracker does not divide into 6 bytes; did you use compact?"
+        )
+    uncompacted_peers = []
+    for peer in [peers[i : i + 6] for i in range(0, len(peers), 6)]:
+        ip = str(peer[0]) + "." + str(peer[1]) + "." + str(peer[2]) + "." + str(peer[3])
+        port = str(int.from_bytes(peer[4:], byteorder="big", signed=False))
+        uncompacted_peers.append(ip + ":" + port)
+    return uncompacted_peers
+
+
+def legacy_addresses(peers):
+    # What init_handshake then did with each string.
+    addresses = []
+    for peer in legacy_split_peers(peers):
+        peer_colon = peer.find(":")
+        addresses.append((peer[:peer_colon], int(peer[peer_colon + 1:])))
+    return addresses
+
+
+def best_of(function, data, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(data)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--peers", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    peers = os.urandom(6 * args.peers)
+    peers6 = os.urandom(18 * args.peers)
+    assert parse_compact_peers(peers) == legacy_addresses(peers)
+
+    rows = [
+        ("legacy split_peers", best_of(legacy_split_peers, peers, args.repeat)),
+        ("legacy + re-parse", best_of(legacy_addresses, peers, args.repeat)),
+        ("parse_compact_peers", best_of(parse_compact_peers, peers, args.repeat)),
+        ("parse_compact_peers v6", best_of(
+            lambda data: parse_compact_peers(data, ipv6=True), peers6, args.repeat
+        )),
+    ]
+    baseline = rows[1][1]
+    print("%d peers" % args.peers)
+    print("%-24s %10s %10s %9s" % ("", "ms", "ns/peer", "speedup"))
+    for name, seconds in rows:
+        print("%-24s %10.2f %10.0f %8.1fx" % (
+            name, seconds * 1000, seconds * 1e9 / args.peers, baseline / seconds
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Measures swarm ramp-up through peer exchange: the tracker only knows one
+peer, which gossips the rest of the swarm through ut_pex (BEP 11).
+Compares a download where that peer gossips with one where it does not.
+
+Usage:
+    python -m bench.bench_pex [--peers 8] [--latency 0.02] [--size 16M]
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+
+from app.main import Torrent, bencode, download_async
+from bench.bench_bencode_decode import parse_size
+from bench.fake_peer import FakePeer
+from bench.fake_tracker import FakeTracker
+
+
+def torrent_for(url, data, piece_length, name="bench"):
+    pieces = b"".join(
+        hashlib.sha1(data[i : i + piece_length]).digest()
+        for i in range(0, len(data), piece_length)
+    )
+    metainfo = {
+        "announce": url,
+        "info": {"length": len(data), "name": name, "piece length": piece_length, "pieces": pieces},
+    }
+    return Torrent.from_bytes(bencode(metainfo))
+
+
+def run(data, piece_length, peers, latency, gossip, directory):
+    with FakeTracker() as tracker:
+        # A fresh name, hence info hash, per run, so the tracker client's
+        # cached peers never apply.
+        torrent = torrent_for(tracker.url, data, piece_length, "bench-%s" % os.urandom(4).hex())
+        others = [FakePeer(data, piece_length, torrent.info_hash, latency).start() for _ in range(peers - 1)]
+        first = FakePeer(
+            data, piece_length, torrent.info_hash, latency,
+            pex=[peer.address for peer in others] if gossip else (),
+        ).start()
+        tracker.peers = [first.address]
+        try:
+            start = time.perf_counter()
+            asyncio.run(download_async(os.path.join(directory, "pex%d" % gossip), torrent))
+            elapsed = time.perf_counter() - start
+        finally:
+            for peer in [first] + others:
+                peer.stop()
+        connected = sum(1 for peer in [first] + others if peer.connections)
+    return elapsed, connected
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--peers", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.02, help="one-way delay in seconds")
+    parser.add_argument("--size", default="16M")
+    parser.add_argument("--piece-length", default="256K")
+    args = parser.parse_args()
+
+    data = os.urandom(parse_size(args.size))
+    print("%d bytes, %d peers, %.0f ms latency" % (len(data), args.peers, args.latency * 1000))
+    print("%-12s %10s %10s %16s" % ("", "seconds", "MB/s", "peers connected"))
+    with tempfile.TemporaryDirectory() as directory:
+        for name, gossip in (("tracker only", False), ("with ut_pex", True)):
+            elapsed, connected = run(
+                data, parse_size(args.piece_length), args.peers, args.latency, gossip, directory
+            )
+            print("%-12s %10.2f %10.1f %16d" % (name, elapsed, len(data) / elapsed / 1e6, connected))
+
+
+if __name__ == "__main__":
+    main()
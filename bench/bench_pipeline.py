@@ -0,0 +1,62 @@
+"""
+Measures single-connection download throughput against a local fake peer
+with injected latency, for a range of request pipeline depths.
+
+Usage:
+    python -m bench.bench_pipeline [--latency 0.02] [--size 4M] [--windows 1,2,4,8,16,32]
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import time
+
+from app.main import PeerConnection, Torrent, _start_download, bencode
+from bench.bench_bencode_decode import parse_size
+from bench.fake_peer import FakePeer
+
+
+def synthetic_torrent(size, piece_length):
+    data = os.urandom(size)
+    pieces = b"".join(
+        hashlib.sha1(data[i : i + piece_length]).digest()
+        for i in range(0, size, piece_length)
+    )
+    metainfo = {
+        "announce": "http://127.0.0.1:1/announce",
+        "info": {"length": size, "name": "bench", "piece length": piece_length, "pieces": pieces},
+    }
+    return Torrent.from_bytes(bencode(metainfo)), data
+
+
+async def fetch_all(torrent, peer, window):
+    conn = await PeerConnection.open(peer, torrent.info_hash)
+    await _start_download(conn, torrent.piece_count)
+    for index in range(torrent.piece_count):
+        piece = await conn.request_piece(index, torrent.piece_size(index), window)
+        if hashlib.sha1(piece).digest() != torrent.piece_hashes[index]:
+            raise ValueError("Piece hash mismatch.")
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--latency", type=float, default=0.02, help="one-way delay in seconds")
+    parser.add_argument("--size", default="4M")
+    parser.add_argument("--piece-length", default="1M")
+    parser.add_argument("--windows", default="1,2,4,8,16,32")
+    args = parser.parse_args()
+
+    torrent, data = synthetic_torrent(parse_size(args.size), parse_size(args.piece_length))
+    print("latency %.0f ms, %d bytes" % (args.latency * 1000, torrent.length))
+    print("%8s %10s %10s" % ("window", "seconds", "MB/s"))
+    with FakePeer(data, torrent.piece_length, torrent.info_hash, args.latency) as peer:
+        for window in (int(w) for w in args.windows.split(",")):
+            start = time.perf_counter()
+            asyncio.run(fetch_all(torrent, peer.address, window))
+            elapsed = time.perf_counter() - start
+            print("%8d %10.3f %10.2f" % (window, elapsed, torrent.length / elapsed / 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Microbenchmark for the piece receive path: the original
+concatenate-and-slice receive loop versus ``PeerConnection.request_piece``,
+which receives blocks straight into one piece buffer.
+
+The fake peer runs in a child process so that tracemalloc only sees the
+client's allocations. Both paths use one outstanding request at a time, so
+the comparison isolates the receive path from pipelining.
+
+This comes at a cost. With one request in flight, the event-loop receive
+path gets about half the throughput of the blocking loop it replaced at
+256 KiB pieces, because every wait for data goes through the selector. The
+allocations it saves grow with the piece length, and at 4 MiB it is faster.
+The "pipelined" row keeps ``PIPELINE_DEPTH`` requests in flight, as
+downloads do, which closes only part of the gap at small pieces.
+
+Usage:
+    python -m bench.bench_receive [--size 16M] [--piece-lengths 256K,1M,4M]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import socket
+import struct
+import time
+import tracemalloc
+
+from app.main import PIPELINE_DEPTH, PeerConnection, _start_download, construct_message
+from bench.bench_bencode_decode import parse_size
+from bench.bench_pipeline import synthetic_torrent
+from bench.fake_peer import FakePeer
+
+
+def legacy_receive_message(s):
+    length = s.recv(4)
+    while not length or not int.from_bytes(length):
+        length = s.recv(4)
+    message = s.recv(int.from_bytes(length))
+    while len(message) < int.from_bytes(length):
+        message += s.recv(int.from_bytes(length) - len(message))
+    return length + message
+
+
+def legacy_fetch_piece(s, index, length):
+    piece = b""
+    for begin in range(0, length, 2**14):
+        block_length = min(2**14, length - begin)
+        s.send(construct_message(6, struct.pack(">III", index, begin, block_length)))
+        message = legacy_receive_message(s)
+        while message[4] != 7:
+            message = legacy_receive_message(s)
+        piece += message[13:]
+    return piece
+
+
+def legacy_session(torrent, address, measure):
+    host, port = address.rsplit(":", 1)
+    s = socket.create_connection((host, int(port)))
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    s.sendall(b"\x13BitTorrent protocol" + b"\x00" * 8 + torrent.info_hash + b"0" * 20)
+    s.recv(68)
+    legacy_receive_message(s)
+    s.sendall(construct_message(2, b""))
+    while legacy_receive_message(s)[4] != 1:
+        pass
+    result = measure(lambda index: legacy_fetch_piece(s, index, torrent.piece_size(index)))
+    s.close()
+    return result
+
+
+async def offset_session(torrent, address, measure, window=1):
+    conn = await PeerConnection.open(address, torrent.info_hash)
+    await _start_download(conn, torrent.piece_count)
+
+    async def fetch(index):
+        return await conn.request_piece(index, torrent.piece_size(index), window=window)
+
+    result = await measure(fetch)
+    conn.close()
+    return result
+
+
+def timed(torrent):
+    def measure(fetch):
+        start = time.perf_counter()
+        for index in range(torrent.piece_count):
+            fetch(index)
+        return time.perf_counter() - start
+
+    async def ameasure(fetch):
+        start = time.perf_counter()
+        for index in range(torrent.piece_count):
+            await fetch(index)
+        return time.perf_counter() - start
+
+    return measure, ameasure
+
+
+def transient_bytes(torrent):
+    """Peak memory allocated while fetching a piece, beyond the piece itself."""
+
+    def record(start, piece):
+        _, peak = tracemalloc.get_traced_memory()
+        return peak - start - len(piece)
+
+    def measure(fetch):
+        worst = 0
+        for index in range(torrent.piece_count):
+            start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            worst = max(worst, record(start, fetch(index)))
+        return worst
+
+    async def ameasure(fetch):
+        worst = 0
+        for index in range(torrent.piece_count):
+            start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            worst = max(worst, record(start, await fetch(index)))
+        return worst
+
+    return measure, ameasure
+
+
+def run_peer(data, piece_length, info_hash, ready):
+    peer = FakePeer(data, piece_length, info_hash).start()
+    ready.send(peer.address)
+    ready.recv()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", default="16M")
+    parser.add_argument("--piece-lengths", default="256K,1M,4M")
+    args = parser.parse_args()
+
+    print("%10s %-9s %10s %18s" % ("piece", "path", "MB/s", "peak extra bytes"))
+    context = multiprocessing.get_context("fork")
+    for piece_length in (parse_size(p) for p in args.piece_lengths.split(",")):
+        torrent, data = synthetic_torrent(parse_size(args.size), piece_length)
+        ours, theirs = context.Pipe()
+        child = context.Process(
+            target=run_peer, args=(data, piece_length, torrent.info_hash, theirs), daemon=True
+        )
+        child.start()
+        address = ours.recv()
+        for name, run in (
+            ("legacy", lambda m, am: legacy_session(torrent, address, m)),
+            ("offset", lambda m, am: asyncio.run(offset_session(torrent, address, am))),
+            ("pipelined", lambda m, am: asyncio.run(
+                offset_session(torrent, address, am, PIPELINE_DEPTH)
+            )),
+        ):
+            elapsed = run(*timed(torrent))
+            tracemalloc.start()
+            extra = run(*transient_bytes(torrent))
+            tracemalloc.stop()
+            print(
+                "%10d %-9s %10.1f %18d"
+                % (piece_length, name, torrent.length / elapsed / 1e6, extra)
+            )
+        ours.send(None)
+        child.join()
+    print(
+        "\nThe offset path trades throughput for allocations at small pieces:"
+        " each wait for data goes through the event loop."
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Measures the seeding server: download throughput from a local
+``SeedServer`` and the server's CPU time per MB uploaded, with blocks sent
+by ``os.sendfile`` versus read into Python and written with ``sendall``.
+
+The server runs in a child process, so its CPU time is measured apart from
+the downloading client. Every leecher's file is compared with the seeded
+one afterwards, and the benchmark fails on any difference.
+
+Usage:
+    python -m bench.bench_seed [--size 256M] [--piece-length 1M] [--leechers 1,4]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from app.main import (
+    PIPELINE_DEPTH,
+    Bitfield,
+    PieceScheduler,
+    PieceVerifier,
+    SeedServer,
+    Storage,
+    TransferStats,
+    _download_from_peer,
+    _store_verified,
+)
+from bench.bench_bencode_decode import parse_size
+from bench.bench_pipeline import synthetic_torrent
+
+
+def run_seed(torrent, path, use_sendfile, pipe):
+    if not use_sendfile:
+        # PeerConnection falls back to pread + sendall without it.
+        del os.sendfile
+
+    async def serve():
+        with Storage(torrent, path, readonly=True) as storage:
+            completed = Bitfield(torrent.piece_count)
+            for index in range(torrent.piece_count):
+                completed.add(index)
+            server = SeedServer(0, max_uploads=8)
+            server.add(torrent, storage, completed)
+            pipe.send(await server.start("127.0.0.1"))
+            await asyncio.get_running_loop().run_in_executor(None, pipe.recv)
+            await server.close()
+
+    asyncio.run(serve())
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    pipe.send(usage.ru_utime + usage.ru_stime)
+
+
+async def leech(torrent, port, path):
+    scheduler = PieceScheduler(torrent.piece_count)
+    with Storage(torrent, path) as storage:
+        verifier = PieceVerifier(torrent)
+        storing = asyncio.create_task(
+            _store_verified(verifier, scheduler, storage, TransferStats(torrent.length))
+        )
+        await _download_from_peer(torrent, ("127.0.0.1", port), scheduler, verifier, PIPELINE_DEPTH)
+        storing.cancel()
+        verifier.close()
+    if not scheduler.done:
+        raise RuntimeError("download did not complete")
+
+
+def check_copy(source, copy):
+    # Fails unless the leecher ended up with exactly the seeded bytes.
+    with open(source, "rb") as expected, open(copy, "rb") as actual:
+        offset = 0
+        while True:
+            chunk = expected.read(1 << 20)
+            if chunk != actual.read(len(chunk) or 1):
+                raise RuntimeError("%s differs from the seeded data near byte %d" % (copy, offset))
+            if not chunk:
+                return
+            offset += len(chunk)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", default="256M")
+    parser.add_argument("--piece-length", default="1M")
+    parser.add_argument("--leechers", default="1,4")
+    args = parser.parse_args()
+
+    torrent, data = synthetic_torrent(parse_size(args.size), parse_size(args.piece_length))
+    context = multiprocessing.get_context("fork")
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, "seed")
+        with open(source, "wb") as f:
+            f.write(data)
+        del data
+        print("%d bytes, %d pieces" % (torrent.length, torrent.piece_count))
+        print("%-10s %9s %10s %16s" % ("send", "leechers", "MB/s", "seed CPU ms/MB"))
+        for leechers in (int(n) for n in args.leechers.split(",")):
+            for name, use_sendfile in (("sendall", False), ("sendfile", True)):
+                ours, theirs = context.Pipe()
+                child = context.Process(target=run_seed, args=(torrent, source, use_sendfile, theirs))
+                child.start()
+                port = ours.recv()
+
+                copies = [os.path.join(directory, "leech%d" % i) for i in range(leechers)]
+
+                async def swarm():
+                    await asyncio.gather(*(leech(torrent, port, copy) for copy in copies))
+
+                start = time.perf_counter()
+                asyncio.run(swarm())
+                elapsed = time.perf_counter() - start
+                ours.send(None)
+                cpu = ours.recv()
+                child.join()
+                for copy in copies:
+                    check_copy(source, copy)
+                    # So the next run starts from nothing.
+                    os.remove(copy)
+                uploaded = torrent.length * leechers / 1e6
+                print("%-10s %9d %10.1f %16.2f" % (
+                    name, leechers, uploaded / elapsed, cpu * 1000 / uploaded
+                ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Measures many torrents downloaded at once: one ``download`` process per
+torrent versus a single ``TorrentSession`` running all of them. Every
+torrent has its own local fake swarm. Reports wall time, total CPU time
+and the sum of the processes' peak memory, from ``wait4``.
+
+The fake swarms run in a child process of their own, so neither their CPU
+time nor their memory is counted against the downloaders.
+
+With ``--download-rate``, a third run caps the session's download rate
+and reports the rate achieved and how evenly the torrents finished.
+
+Usage:
+    python -m bench.bench_session [--torrents 50] [--size 2M] [--peers 2] [--download-rate 8M]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench.bench_bencode_decode import parse_size
+from bench.swarm import FakeSwarm, SyntheticContent
+
+# Printed on stdout by the session child as each torrent completes.
+COMPLETED = "completed at "
+
+
+def child(directory, download_rate, filenames):
+    """Downloads every torrent in one session, then exits."""
+    from app.main import Torrent, TorrentSession
+
+    async def run():
+        session = TorrentSession(0, download_rate=float(download_rate) or None)
+        await session.start("127.0.0.1")
+        for filename in filenames:
+            torrent = Torrent.from_file(filename)
+            session.add(
+                torrent,
+                os.path.join(directory, torrent.info["name"].decode()),
+                lambda torrent: print(COMPLETED + repr(time.monotonic()), flush=True),
+            )
+        await session.wait_complete()
+        await session.close()
+
+    asyncio.run(run())
+
+
+def run_swarms(args, ready):
+    swarms = [
+        FakeSwarm(
+            SyntheticContent(parse_size(args.size), parse_size(args.piece_length), seed=i),
+            [{"latency": args.latency}] * args.peers,
+            name="bench%d" % i,
+        ).start()
+        for i in range(args.torrents)
+    ]
+    ready.send([swarm.metainfo for swarm in swarms])
+    ready.recv()
+    for swarm in swarms:
+        swarm.stop()
+
+
+def reap(processes):
+    # Waits for every process; returns the summed CPU time and peak RSS.
+    cpu = rss = 0
+    for process in processes:
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode:
+            raise RuntimeError("a download failed")
+        cpu += usage.ru_utime + usage.ru_stime
+        rss += usage.ru_maxrss
+    return cpu, rss
+
+
+def per_process(filenames, directory):
+    processes = [
+        subprocess.Popen(
+            [sys.executable, "-m", "app.main", "download", "-o",
+             os.path.join(directory, "p%d" % i), filename],
+            stdout=subprocess.DEVNULL,
+        )
+        for i, filename in enumerate(filenames)
+    ]
+    return reap(processes) + ([],)
+
+
+def one_session(filenames, directory, download_rate):
+    process = subprocess.Popen(
+        [sys.executable, "-m", "bench.bench_session", "--child", directory, str(download_rate)]
+        + filenames,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    finished = [
+        float(line[len(COMPLETED):]) for line in process.stdout if line.startswith(COMPLETED)
+    ]
+    return reap([process]) + (finished,)
+
+
+def main():
+    if sys.argv[1:2] == ["--child"]:
+        return child(sys.argv[2], sys.argv[3], sys.argv[4:])
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--torrents", type=int, default=50)
+    parser.add_argument("--size", default="2M")
+    parser.add_argument("--piece-length", default="256K")
+    parser.add_argument("--peers", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.01, help="one-way delay in seconds")
+    parser.add_argument("--download-rate", default=None, help="session cap in bytes per second")
+    args = parser.parse_args()
+
+    size = parse_size(args.size)
+    context = multiprocessing.get_context("fork")
+    ours, theirs = context.Pipe()
+    swarms = context.Process(target=run_swarms, args=(args, theirs), daemon=True)
+    swarms.start()
+    metainfos = ours.recv()
+    total = size * args.torrents / 1e6
+    runs = [("process per torrent", None), ("one session", 0)]
+    if args.download_rate:
+        runs.append(("session, capped", parse_size(args.download_rate)))
+    try:
+        print("%d torrents of %d bytes, %d peers each" % (args.torrents, size, args.peers))
+        print("%-20s %8s %8s %10s %12s %16s" % (
+            "", "seconds", "MB/s", "CPU s", "sum RSS MB", "finish spread s"
+        ))
+        with tempfile.TemporaryDirectory() as directory:
+            filenames = []
+            for i, metainfo in enumerate(metainfos):
+                filenames.append(os.path.join(directory, "bench%d.torrent" % i))
+                with open(filenames[-1], "wb") as f:
+                    f.write(metainfo)
+            for name, download_rate in runs:
+                output = tempfile.mkdtemp(dir=directory)
+                start = time.monotonic()
+                if download_rate is None:
+                    cpu, rss, finished = per_process(filenames, output)
+                else:
+                    cpu, rss, finished = one_session(filenames, output, download_rate)
+                elapsed = time.monotonic() - start
+                spread = "%16.2f" % (max(finished) - min(finished)) if finished else "%16s" % "-"
+                print("%-20s %8.2f %8.1f %10.2f %12.1f %s" % (
+                    name, elapsed, total / elapsed, cpu, rss / 1024, spread
+                ))
+    finally:
+        ours.send(None)
+        swarms.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Measures announce cost against local stand-in trackers: a fresh
+``requests.get`` per announce versus the pooled ``TrackerClient``, HTTP
+versus UDP announces, and how many announces reach the tracker when peers
+are asked for repeatedly.
+
+Usage:
+    python -m bench.bench_tracker [--announces 200]
+"""
+import argparse
+import time
+
+import requests
+
+from app.main import TrackerClient, Torrent, bencode
+from bench.fake_tracker import FakeTracker, FakeUDPTracker
+
+
+def torrent_for(url):
+    metainfo = {
+        "announce": url,
+        "info": {"length": 1, "name": "bench", "piece length": 16384, "pieces": b"\x00" * 20},
+    }
+    return Torrent.from_bytes(bencode(metainfo))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--announces", type=int, default=200)
+    args = parser.parse_args()
+    peers = ["127.0.0.%d:6881" % (i + 1) for i in range(50)]
+
+    with FakeTracker(peers) as tracker:
+        torrent = torrent_for(tracker.url)
+        params = dict(info_hash=torrent.info_hash, peer_id="0" * 20, port=6881,
+                      uploaded=0, downloaded=0, left=1, compact=1)
+        start = time.perf_counter()
+        for _ in range(args.announces):
+            requests.get(torrent.announce, params=params)
+        unpooled = time.perf_counter() - start
+        unpooled_connections = tracker.connections
+
+    with FakeTracker(peers) as tracker:
+        torrent = torrent_for(tracker.url)
+        client = TrackerClient()
+        start = time.perf_counter()
+        for _ in range(args.announces):
+            client.announce(torrent)
+        pooled = time.perf_counter() - start
+        pooled_connections = tracker.connections
+        client.close()
+
+    with FakeTracker(peers, interval=1800) as tracker:
+        torrent = torrent_for(tracker.url)
+        client = TrackerClient()
+        for _ in range(args.announces):
+            client.get_peers(torrent)
+        cached_announces = len(tracker.announces)
+        client.close()
+
+    with FakeUDPTracker(peers) as tracker:
+        torrent = torrent_for(tracker.url)
+        client = TrackerClient()
+        start = time.perf_counter()
+        for _ in range(args.announces):
+            announced = client.announce(torrent)
+        udp = time.perf_counter() - start
+        udp_packets = tracker.packets
+        assert len(announced) == len(peers)
+
+    # One lost packet: the client must retransmit after its first timeout.
+    with FakeUDPTracker(peers, drop=1) as tracker:
+        torrent = torrent_for(tracker.url)
+        client = TrackerClient(udp_timeout=0.05)
+        start = time.perf_counter()
+        client.announce(torrent)
+        retransmit = time.perf_counter() - start
+        retransmit_packets = tracker.packets
+
+    print("%-26s %10s %12s" % ("", "ms/announce", "connections"))
+    print("%-26s %10.2f %12d" % ("requests.get per announce", unpooled * 1000 / args.announces, unpooled_connections))
+    print("%-26s %10.2f %12d" % ("pooled TrackerClient", pooled * 1000 / args.announces, pooled_connections))
+    print("%-26s %10.2f %12s" % ("UDP TrackerClient", udp * 1000 / args.announces, "-"))
+    print("UDP: %d packets received for %d announces (connection ID reused)" % (udp_packets, args.announces))
+    print("UDP with first packet lost: %d packets, %.0f ms" % (retransmit_packets, retransmit * 1000))
+    print("get_peers x%d within the interval -> %d announce(s)" % (args.announces, cached_announces))
+
+
+if __name__ == "__main__":
+    main()
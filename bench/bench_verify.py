@@ -0,0 +1,116 @@
+"""
+Measures how piece hashing interacts with the receive loop: SHA-1 run
+inline on the event loop, as the downloader used to, versus the
+``PieceVerifier`` thread pool. Reports throughput and the longest stall
+of the event loop while pieces arrive from several local fake peers.
+
+The fake peers run in a child process so they do not compete with the
+client for the GIL.
+
+Usage:
+    python -m bench.bench_verify [--size 256M] [--piece-length 1M] [--peers 4]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+
+from app.main import (
+    PIPELINE_DEPTH,
+    PieceScheduler,
+    PieceVerifier,
+    Storage,
+    TransferStats,
+    _download_from_peer,
+    _store_verified,
+)
+from bench.bench_bencode_decode import parse_size
+from bench.bench_pipeline import synthetic_torrent
+from bench.fake_peer import FakePeer
+
+
+class InlineVerifier(PieceVerifier):
+    """Hashes on the event loop inside ``submit``: the old inline check."""
+
+    async def submit(self, index, piece, peer=None):
+        self.pending += 1
+        intact = self._check(index, piece)
+        if not intact and peer is not None:
+            self.failures[peer] = self.failures.get(peer, 0) + 1
+        self._results.put_nowait((index, piece, peer, intact))
+
+
+async def watch_loop(lags):
+    # Sleeps 1 ms at a time and records how late each wake-up is.
+    loop = asyncio.get_running_loop()
+    while True:
+        before = loop.time()
+        await asyncio.sleep(0.001)
+        lags.append(loop.time() - before - 0.001)
+
+
+async def fetch(torrent, addresses, verifier_class, path):
+    scheduler = PieceScheduler(torrent.piece_count)
+    stats = TransferStats(torrent.length)
+    lags = []
+    with Storage(torrent, path) as storage:
+        verifier = verifier_class(torrent)
+        storing = asyncio.create_task(_store_verified(verifier, scheduler, storage, stats))
+        watcher = asyncio.create_task(watch_loop(lags))
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            _download_from_peer(torrent, address, scheduler, verifier, PIPELINE_DEPTH)
+            for address in addresses
+        ))
+        elapsed = time.perf_counter() - start
+        watcher.cancel()
+        storing.cancel()
+        verifier.close()
+    if not scheduler.done:
+        raise RuntimeError("download did not complete")
+    return elapsed, max(lags, default=0.0)
+
+
+def run_peers(data, piece_length, info_hash, count, ready):
+    peers = [FakePeer(data, piece_length, info_hash).start() for _ in range(count)]
+    ready.send([peer.address for peer in peers])
+    ready.recv()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", default="256M")
+    parser.add_argument("--piece-length", default="1M")
+    parser.add_argument("--peers", type=int, default=4)
+    args = parser.parse_args()
+
+    torrent, data = synthetic_torrent(parse_size(args.size), parse_size(args.piece_length))
+    context = multiprocessing.get_context("fork")
+    ours, theirs = context.Pipe()
+    child = context.Process(
+        target=run_peers,
+        args=(data, torrent.piece_length, torrent.info_hash, args.peers, theirs),
+        daemon=True,
+    )
+    child.start()
+    addresses = ours.recv()
+    try:
+        print("%d bytes, %d pieces, %d peers" % (torrent.length, torrent.piece_count, args.peers))
+        print("%-16s %10s %16s" % ("hashing", "MB/s", "max loop stall ms"))
+        with tempfile.TemporaryDirectory() as directory:
+            for name, verifier_class in (("inline", InlineVerifier), ("thread pool", PieceVerifier)):
+                path = os.path.join(directory, name)
+                elapsed, stall = asyncio.run(fetch(torrent, addresses, verifier_class, path))
+                print("%-16s %10.1f %16.1f" % (
+                    name, torrent.length / elapsed / 1e6, stall * 1000
+                ))
+                os.remove(path)
+    finally:
+        ours.send(None)
+        child.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""
+A local stand-in for a seeding BitTorrent peer, used by the benchmarks.
+
+The peer speaks just enough of the wire protocol for the client: it answers
+the handshake, sends a full bitfield, unchokes on ``interested`` and serves
+``request`` messages from an in-memory copy of the torrent's content.
+Every reply is held back by ``latency`` seconds, measured from the moment the
+request arrived, so pipelined requests overlap the same way they would on a
+real link with that one-way delay. Given a ``rate``, replies on each
+connection are paced to that many bytes per second. With ``choke_every``,
+it chokes each connection after that many blocks, drops the requests that
+arrive while choked, and unchokes ``choke_time`` seconds later; with
+``corrupt``, that fraction of blocks has a byte flipped. Given ``pex`` addresses, it also answers
+the extension handshake (BEP 10) and gossips them through ut_pex. With
+``handshake_delay``, it sits on each new connection that long before
+answering the handshake, like an overloaded or unresponsive peer.
+"""
+import heapq
+import os
+import random
+import socket
+import struct
+import threading
+import time
+
+from app.main import bencode, decode_bencode_all
+from bench.fake_tracker import compact
+
+
+def _recv_exactly(conn, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    while view:
+        got = conn.recv_into(view)
+        if not got:
+            raise ConnectionError("peer closed the connection")
+        view = view[got:]
+    return bytes(buf)
+
+
+class FakePeer:
+    """
+    A seeder listening on 127.0.0.1 that serves ``data`` for one torrent.
+
+    Args:
+        data (bytes): The full content of the torrent.
+        piece_length (int): The torrent's piece length.
+        info_hash (bytes): The info hash to answer handshakes for.
+        latency (float): One-way delay, in seconds, applied to every reply.
+        pex (list): ``"ip:port"`` strings to send through ut_pex.
+        rate (float): Upload bandwidth per connection, in bytes per second;
+            unlimited if None.
+        choke_every (int): Blocks served between chokes; never chokes if 0.
+        choke_time (float): Seconds each choke lasts.
+        corrupt (float): The probability that a block is sent corrupted.
+        handshake_delay (float): Seconds to wait before answering a handshake.
+    """
+
+    def __init__(
+        self, data, piece_length, info_hash, latency=0.0, pex=(), rate=None,
+        choke_every=0, choke_time=0.5, corrupt=0.0, handshake_delay=0.0,
+    ):
+        self.data = data
+        self.piece_length = piece_length
+        self.info_hash = info_hash
+        self.latency = latency
+        self.rate = rate
+        self.choke_every = choke_every
+        self.choke_time = choke_time
+        self.corrupt = corrupt
+        self.handshake_delay = handshake_delay
+        self.pex = list(pex)
+        self.connections = 0
+        self.peer_id = b"-FK0001-" + os.urandom(12)
+        self.piece_count = (len(data) + piece_length - 1) // piece_length
+        self._listener = None
+        self._closing = threading.Event()
+
+    @property
+    def address(self):
+        return "127.0.0.1:%d" % self._listener.getsockname()[1]
+
+    def start(self):
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(("127.0.0.1", 0))
+        self._listener.listen(128)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._closing.set()
+        self._listener.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _accept_loop(self):
+        while not self._closing.is_set():
+            try:
+                conn, _ = self._listener.accept()
+            except OSError:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connections += 1
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _bitfield(self):
+        bitfield = bytearray((self.piece_count + 7) // 8)
+        for index in range(self.piece_count):
+            bitfield[index // 8] |= 0x80 >> (index % 8)
+        return bytes(bitfield)
+
+    def _serve(self, conn):
+        outbox = []
+        ready = threading.Condition()
+        done = threading.Event()
+        writer = threading.Thread(
+            target=self._write_loop, args=(conn, outbox, ready, done), daemon=True
+        )
+        try:
+            handshake = _recv_exactly(conn, 68)
+            if handshake[28:48] != self.info_hash:
+                return
+            if self.handshake_delay and self._closing.wait(self.handshake_delay):
+                return
+            extensions = bool(self.pex) and bool(handshake[25] & 0x10)
+            reserved = b"\x00\x00\x00\x00\x00\x10\x00\x00" if extensions else b"\x00" * 8
+            conn.sendall(handshake[:20] + reserved + self.info_hash + self.peer_id)
+            if extensions:
+                payload = b"\x00" + bencode({"m": {"ut_pex": 1}})
+                conn.sendall(struct.pack(">IB", len(payload) + 1, 20) + payload)
+            bitfield = self._bitfield()
+            conn.sendall(struct.pack(">IB", len(bitfield) + 1, 5) + bitfield)
+            writer.start()
+            sequence = 0
+            served = 0
+            choked_until = 0.0
+            rng = random.Random()
+            while True:
+                (length,) = struct.unpack(">I", _recv_exactly(conn, 4))
+                if length == 0:
+                    continue
+                message = _recv_exactly(conn, length)
+                if message[0] == 2:
+                    reply = struct.pack(">IB", 1, 1)
+                elif message[0] == 20 and extensions and message[1] == 0:
+                    remote_id = decode_bencode_all(message[2:])["m"].get("ut_pex")
+                    if not remote_id:
+                        continue
+                    payload = bytes([remote_id]) + bencode({"added": compact(self.pex)})
+                    reply = struct.pack(">IB", len(payload) + 1, 20) + payload
+                elif message[0] == 6:
+                    if time.monotonic() < choked_until:
+                        # A choked peer discards requests.
+                        continue
+                    index, begin, block_length = struct.unpack(">III", message[1:13])
+                    start = index * self.piece_length + begin
+                    block = self.data[start : start + block_length]
+                    if self.corrupt and rng.random() < self.corrupt:
+                        block = bytes([block[0] ^ 0xFF]) + block[1:]
+                    reply = struct.pack(">IBII", 9 + block_length, 7, index, begin) + block
+                    served += 1
+                    if self.choke_every and served % self.choke_every == 0:
+                        choked_until = time.monotonic() + self.choke_time
+                        reply += struct.pack(">IB", 1, 0)
+                        with ready:
+                            sequence += 1
+                            heapq.heappush(outbox, (
+                                choked_until + self.latency, sequence, struct.pack(">IB", 1, 1)
+                            ))
+                else:
+                    continue
+                with ready:
+                    sequence += 1
+                    heapq.heappush(outbox, (time.monotonic() + self.latency, sequence, reply))
+                    ready.notify()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            done.set()
+            with ready:
+                ready.notify()
+            conn.close()
+
+    def _write_loop(self, conn, outbox, ready, done):
+        # When the link is free again under the rate cap.
+        free_at = time.monotonic()
+        while True:
+            with ready:
+                while not outbox and not done.is_set():
+                    ready.wait()
+                if done.is_set():
+                    return
+                due, _, reply = outbox[0]
+                delay = due - time.monotonic()
+                if delay > 0:
+                    ready.wait(delay)
+                    continue
+                heapq.heappop(outbox)
+            if self.rate:
+                now = time.monotonic()
+                if free_at > now:
+                    time.sleep(free_at - now)
+                free_at = max(free_at, now) + len(reply) / self.rate
+            try:
+                conn.sendall(reply)
+            except OSError:
+                return
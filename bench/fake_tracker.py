@@ -0,0 +1,212 @@
+"""
+Local stand-ins for HTTP and UDP trackers, used by the benchmarks.
+
+They answer every announce with a fixed compact peer list and record what
+they were sent, so a benchmark can count announces, events, TCP connections
+and UDP packets.
+"""
+import http.server
+import os
+import socket
+import struct
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+from app.main import bencode
+
+
+def compact(peers):
+    """Packs ``"ip:port"`` strings into the compact peer format, skipping IPv6 ones."""
+    packed = []
+    for peer in peers:
+        host, port = peer.rsplit(":", 1)
+        if not host.startswith("["):
+            packed.append(socket.inet_aton(host) + struct.pack(">H", int(port)))
+    return b"".join(packed)
+
+
+def compact6(peers):
+    """Packs the ``"[ipv6]:port"`` strings into the 18-byte ``peers6`` format."""
+    packed = []
+    for peer in peers:
+        host, port = peer.rsplit(":", 1)
+        if host.startswith("["):
+            packed.append(
+                socket.inet_pton(socket.AF_INET6, host[1:-1]) + struct.pack(">H", int(port))
+            )
+    return b"".join(packed)
+
+
+class FakeTracker:
+    """
+    An HTTP tracker listening on 127.0.0.1.
+
+    Args:
+        peers (list): ``"ip:port"`` or ``"[ipv6]:port"`` strings to hand out.
+        interval (int): The re-announce interval to advertise.
+        latency (float): Seconds to wait before answering each announce.
+        failure (str, optional): If set, every announce fails with this reason.
+    """
+
+    def __init__(self, peers=(), interval=1800, latency=0.0, failure=None):
+        self.peers = list(peers)
+        self.interval = interval
+        self.latency = latency
+        self.failure = failure
+        self.announces = []
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/announce" % self._server.server_address[1]
+
+    def start(self):
+        tracker = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                # Headers and body go out in separate writes; keep Nagle from
+                # stalling the body on a kept-alive connection.
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                with tracker._lock:
+                    tracker.connections += 1
+
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                with tracker._lock:
+                    tracker.announces.append({k: v[0] for k, v in query.items()})
+                if tracker.latency:
+                    time.sleep(tracker.latency)
+                if tracker.failure:
+                    body = bencode({"failure reason": tracker.failure})
+                else:
+                    response = {"interval": tracker.interval, "peers": compact(tracker.peers)}
+                    peers6 = compact6(tracker.peers)
+                    if peers6:
+                        response["peers6"] = peers6
+                    body = bencode(response)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def events(self):
+        with self._lock:
+            return [announce.get("event") for announce in self.announces]
+
+
+class FakeUDPTracker:
+    """
+    A UDP tracker (BEP 15) listening on 127.0.0.1.
+
+    Args:
+        peers (list): ``"ip:port"`` strings to hand out.
+        interval (int): The re-announce interval to advertise.
+        latency (float): Seconds to wait before answering each packet.
+        drop (int): Silently drop this many of the first packets received, to
+            exercise retransmission.
+        failure (str, optional): If set, every announce fails with this reason.
+    """
+
+    def __init__(self, peers=(), interval=1800, latency=0.0, drop=0, failure=None):
+        self.peers = list(peers)
+        self.interval = interval
+        self.latency = latency
+        self.drop = drop
+        self.failure = failure
+        self.packets = 0
+        self.connects = 0
+        self.announces = []
+        self._connection_ids = set()
+        self._sock = None
+
+    @property
+    def url(self):
+        return "udp://127.0.0.1:%d/announce" % self._sock.getsockname()[1]
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(("127.0.0.1", 0))
+        threading.Thread(target=self._serve, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._sock.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _serve(self):
+        while True:
+            try:
+                packet, address = self._sock.recvfrom(65536)
+            except OSError:
+                return
+            self.packets += 1
+            if self.drop:
+                self.drop -= 1
+                continue
+            if self.latency:
+                time.sleep(self.latency)
+            reply = self._reply(packet)
+            if reply is not None:
+                try:
+                    self._sock.sendto(reply, address)
+                except OSError:
+                    return
+
+    def _reply(self, packet):
+        if len(packet) < 16:
+            return None
+        connection_id, action, transaction_id = struct.unpack_from(">QII", packet)
+        if action == 0 and connection_id == 0x41727101980:
+            self.connects += 1
+            new_id = int.from_bytes(os.urandom(8), "big")
+            self._connection_ids.add(new_id)
+            return struct.pack(">IIQ", 0, transaction_id, new_id)
+        if action == 1 and len(packet) >= 98:
+            if connection_id not in self._connection_ids:
+                return struct.pack(">II", 3, transaction_id) + b"unknown connection id"
+            fields = struct.unpack_from(">20s20sqqqIIIiH", packet, 16)
+            self.announces.append(
+                dict(zip(("info_hash", "peer_id", "downloaded", "left", "uploaded",
+                          "event", "ip", "key", "num_want", "port"), fields))
+            )
+            if self.failure:
+                return struct.pack(">II", 3, transaction_id) + self.failure.encode()
+            return struct.pack(
+                ">IIIII", 1, transaction_id, self.interval, 0, len(self.peers)
+            ) + compact(self.peers)
+        return None
+
+    def events(self):
+        names = {0: None, 1: "completed", 2: "started", 3: "stopped"}
+        return [names[announce["event"]] for announce in self.announces]
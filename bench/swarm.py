@@ -0,0 +1,119 @@
+"""
+A local swarm for the benchmarks: synthetic torrent content of any size, a
+``FakeTracker`` and a set of ``FakePeer`` seeders serving it.
+
+Content is pseudo-random but deterministic, generated a piece at a time, so
+a torrent of several GB costs no more memory than a few pieces.
+"""
+import functools
+import hashlib
+import random
+
+from app.main import Torrent, bencode
+from bench.fake_peer import FakePeer
+from bench.fake_tracker import FakeTracker
+
+
+class SyntheticContent:
+    """
+    The content of a synthetic torrent, sliceable like the ``bytes`` it stands in for.
+
+    Args:
+        length (int): The total size in bytes.
+        piece_length (int): The torrent's piece length.
+        seed (int): Selects the content; equal seeds give equal bytes.
+    """
+
+    def __init__(self, length, piece_length, seed=0):
+        self.length = length
+        self.piece_length = piece_length
+        self.seed = seed
+        self.piece_count = (length + piece_length - 1) // piece_length
+        # Thread-safe, so every peer of a swarm can share one instance.
+        self.piece = functools.lru_cache(maxsize=16)(self._generate)
+
+    def __len__(self):
+        return self.length
+
+    def _generate(self, index):
+        size = min(self.piece_length, self.length - index * self.piece_length)
+        return random.Random(self.seed * self.piece_count + index).randbytes(size)
+
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(self.length)
+        parts = []
+        while start < stop:
+            index, offset = divmod(start, self.piece_length)
+            part = self.piece(index)[offset : offset + stop - start]
+            parts.append(part)
+            start += len(part)
+        return b"".join(parts)
+
+    def metainfo(self, announce, name="bench"):
+        """
+        Builds the bencoded .torrent file for this content.
+
+        Args:
+            announce (str): The tracker url.
+            name (str): The suggested file name.
+
+        Returns:
+            bytes: The metainfo file.
+        """
+        pieces = b"".join(
+            hashlib.sha1(self.piece(index)).digest() for index in range(self.piece_count)
+        )
+        return bencode({
+            "announce": announce,
+            "info": {
+                "length": self.length,
+                "name": name,
+                "piece length": self.piece_length,
+                "pieces": pieces,
+            },
+        })
+
+
+class FakeSwarm:
+    """
+    A tracker and seeders for one torrent, all on 127.0.0.1.
+
+    Args:
+        content (SyntheticContent): What the peers serve.
+        peers (list): One dict of ``FakePeer`` keyword arguments (latency,
+            rate, choke_every, corrupt, ...) per peer.
+        name (str): The torrent's suggested file name.
+
+    Example:
+        >>> with FakeSwarm(content, [{"latency": 0.02}] * 4) as swarm:
+        ...     open("bench.torrent", "wb").write(swarm.metainfo)
+    """
+
+    def __init__(self, content, peers, name="bench"):
+        self.content = content
+        self.name = name
+        self.peer_options = list(peers)
+        self.tracker = FakeTracker()
+        self.peers = []
+        self.metainfo = None
+
+    def start(self):
+        self.tracker.start()
+        self.metainfo = self.content.metainfo(self.tracker.url, self.name)
+        info_hash = Torrent.from_bytes(self.metainfo).info_hash
+        for options in self.peer_options:
+            peer = FakePeer(self.content, self.content.piece_length, info_hash, **options)
+            self.peers.append(peer.start())
+        self.tracker.peers = [peer.address for peer in self.peers]
+        return self
+
+    def stop(self):
+        for peer in self.peers:
+            peer.stop()
+        self.tracker.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()